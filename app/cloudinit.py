@@ -0,0 +1,62 @@
+import os
+import json
+
+from typing import List
+
+
+def _quote(value):
+    # NOTE: a json string is a valid yaml scalar, no yaml dependency needed
+    return json.dumps(str(value))
+
+
+def render_join_user_data(hostname: str,
+                          username: str,
+                          password: str,
+                          ssh_keys: str = None,
+                          join_cmd: List[str] = []):
+    """
+    The user-data replaces the one proxmox generates, so the user is rendered here too.
+    """
+    lines = [
+        "#cloud-config",
+        f"hostname: {_quote(hostname)}",
+        "manage_etc_hosts: true",
+        "users:",
+        f"  - name: {_quote(username)}",
+        "    lock_passwd: false",
+        f"    plain_text_passwd: {_quote(password)}",
+        "    sudo: \"ALL=(ALL) NOPASSWD:ALL\"",
+        "    shell: \"/bin/bash\"",
+    ]
+    keys = [x.strip() for x in (ssh_keys or "").splitlines() if x.strip()]
+    if keys:
+        lines.append("    ssh_authorized_keys:")
+        lines.extend(f"      - {_quote(x)}" for x in keys)
+    lines.extend([
+        "ssh_pwauth: true",
+        "chpasswd:",
+        "  expire: false",
+        "runcmd:",
+        f"  - {json.dumps([str(x) for x in join_cmd])}",
+    ])
+    return "\n".join(lines) + "\n"
+
+
+def write_snippet(snippets_dir: str, filename: str, content: str):
+    """
+    Write the snippet to the snippets directory of a storage on this host.
+    """
+    os.makedirs(snippets_dir, exist_ok=True)
+    filepath = os.path.join(snippets_dir, filename)
+    # NOTE: the join token is a secret
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(content)
+    return filepath
+
+
+def remove_snippet(snippets_dir: str, filename: str):
+    try:
+        os.remove(os.path.join(snippets_dir, filename))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,42 @@
+import urllib3
+
+from app.cmd.core import Cmd
+from app.config import load_config
+from app.logger import Logger
+from app.controller.node import NodeController
+from app.service.autoscaler import AutoscalerService
+from app import config
+
+
+class AutoscalerCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("autoscaler", childs=[RunAutoscalerCmd()])
+
+
+class RunAutoscalerCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("run")
+
+    def _setup(self):
+        self.parser.add_argument("--once", action="store_true")
+        self.parser.add_argument("--dry-run", action="store_true")
+
+    def _run(self):
+        urllib3.disable_warnings()
+        log = self.logger()
+        args = self.parsed_args
+        cfg = load_config(log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
+        params = dict(cfg)
+        params.update(params.pop("autoscaler", {}))
+        interval = params.pop("interval", config.AUTOSCALER_INTERVAL)
+        params["dry_run"] = args.dry_run
+        service = AutoscalerService(nodectl, log=log)
+        if args.once:
+            decision = service.tick(**params)
+            self.print(decision["action"], decision["vm_id"] or "",
+                       decision["reason"])
+            return
+        service.run(interval=interval, **params)
@@ -1,8 +1,32 @@
 from __future__ import annotations
 
+import sys
 import argparse
 
 from typing import List, Mapping
+from app.logger import Logger
+
+
+class _ArgumentParser(argparse.ArgumentParser):
+    # NOTE: usage, help and errors go to the output of the command, e.g. a kp daemon client
+
+    stdout = None
+    stderr = None
+
+    def print_usage(self, file=None):
+        super().print_usage(file or self.stdout)
+
+    def print_help(self, file=None):
+        super().print_help(file or self.stdout)
+
+    def error(self, message):
+        self.print_usage(self.stderr or sys.stderr)
+        self.exit(2, f"{self.prog}: error: {message}\n")
+
+    def exit(self, status=0, message=None):
+        if message:
+            (self.stderr or sys.stderr).write(message)
+        sys.exit(status)
 
 
 class Cmd:
@@ -21,8 +45,11 @@ class Cmd:
         self.parent = parent
         self.childs = childs
         self.child_map: Mapping[str, Cmd] = {}
-        self.parser = argparse.ArgumentParser()
+        self.parser = _ArgumentParser()
         self.sub_level = sub_level
+        # NOTE: None is sys.stdout / sys.stderr
+        self.stdout = None
+        self.stderr = None
         self._setup()
         for child in childs:
             self.add_child(child.name, child)
@@ -55,8 +82,12 @@ class Cmd:
         """
         pass
 
-    def run(self, args: List[str]):
+    def run(self, args: List[str], stdout=None, stderr=None):
         self.args = args
+        self.stdout = stdout
+        self.stderr = stderr
+        self.parser.stdout = stdout
+        self.parser.stderr = stderr
         self.parsed_args = self.parser.parse_args(args)
         self._run()
         if self.has_child:
@@ -66,8 +97,9 @@ class Cmd:
         child = self.child_map.get(self.parsed_args.subcommand, None)
         if not child:
             raise KeyError(self.parsed_args.subcommand)
-        child.run(self.parsed_args.remains)
-        pass
+        child.run(self.parsed_args.remains,
+                  stdout=self.stdout,
+                  stderr=self.stderr)
 
     def _run(self):
         """
@@ -75,14 +107,21 @@ class Cmd:
         """
         pass
 
-    def tree(self, current_level=0, recursive=True):
+    def print(self, *args, **kwargs):
+        print(*args, file=self.stdout, **kwargs)
+
+    def logger(self):
+        return Logger.from_env(file=self.stdout)
+
+    def tree(self, current_level=0, recursive=True, stdout=None):
         name = self.name
         if len(self.aliases):
             name += f" ({','.join(self.aliases)})"
         print(
             current_level * "    ",
             name,
+            file=stdout,
         )
         if recursive:
             for child in self.childs:
-                child.tree(current_level + 1)
+                child.tree(current_level + 1, stdout=stdout)
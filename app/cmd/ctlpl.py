@@ -28,14 +28,10 @@ class CreateControlPlaneCmd(Cmd):
 
     def _run(self):
         urllib3.disable_warnings()
-        log = Logger.from_env()
+        log = self.logger()
 
         cfg = load_config(log=log)
-        proxmox_node = cfg["proxmox_node"]
-
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg),
-                                 proxmox_node,
-                                 log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
 
         service = ControlPlaneService(nodectl, log=log)
         service.create_control_plane(**cfg)
@@ -51,7 +47,7 @@ class DeleteControlPlaneCmd(Cmd):
 
     def _run(self):
         urllib3.disable_warnings()
-        log = Logger.from_env()
+        log = self.logger()
         cfg = load_config(log=log)
         args = self.parsed_args
         vm_id = args.vmid or os.getenv("VMID")
@@ -60,11 +56,7 @@ class DeleteControlPlaneCmd(Cmd):
         if not vm_id:
             raise ValueError("vm_id is missing")
 
-        proxmox_node = cfg["proxmox_node"]
-
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg),
-                                 proxmox_node,
-                                 log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
         clusterctl = ControlPlaneService(nodectl, log=log)
         clusterctl.delete_control_plane(vm_id, **cfg)
 
@@ -85,16 +77,13 @@ class CatKubeConfigCmd(Cmd):
         vm_id = args.vmid
         filepath = args.file_path
         urllib3.disable_warnings()
-        log = Logger.from_env()
+        log = self.logger()
 
         cfg = load_config(log=log)
-        proxmox_node = cfg["proxmox_node"]
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg),
-                                 proxmox_node,
-                                 log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
         ctlplvmctl = nodectl.ctlplvmctl(vm_id)
         _, stdout, _ = ctlplvmctl.cat_kubeconfig(filepath)
-        print(stdout)
+        self.print(stdout)
 
 
 class CopyKubeCertsCmd(Cmd):
@@ -111,14 +100,10 @@ class CopyKubeCertsCmd(Cmd):
         source_id = args.source
         dest_id = args.dest
         urllib3.disable_warnings()
-        log = Logger.from_env()
+        log = self.logger()
 
         cfg = load_config(log=log)
-        proxmox_node = cfg["proxmox_node"]
-
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg),
-                                 proxmox_node,
-                                 log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
 
         nodectl.ctlplvmctl(dest_id).ensure_cert_dirs()
 
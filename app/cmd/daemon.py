@@ -0,0 +1,36 @@
+import argparse
+import urllib3
+
+from app.cmd.core import Cmd
+from app.daemon import Daemon
+from app.logger import Logger
+from app import config
+
+
+def port(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid port {value!r} (--metrics-port or KP_METRICS_PORT)")
+
+
+class DaemonCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("daemon")
+
+    def _setup(self):
+        self.parser.add_argument("-s",
+                                 "--socket",
+                                 default=config.DAEMON_SOCKET)
+        self.parser.add_argument("--metrics-port",
+                                 type=port,
+                                 default=config.METRICS_PORT,
+                                 help="serve http /metrics, 0 disables it")
+
+    def _run(self):
+        urllib3.disable_warnings()
+        log = self.logger()
+        args = self.parsed_args
+        Daemon(args.socket, log=log, metrics_port=args.metrics_port).serve()
@@ -7,4 +7,4 @@ class TreeCmd(Cmd):
         super().__init__("tree", parent=parent)
 
     def _run(self):
-        self.parent.tree()
+        self.parent.tree(stdout=self.stdout)
@@ -1,11 +1,17 @@
+import os
 import sys
 
 from app.cmd.core import Cmd
+from app.cmd.autoscaler import AutoscalerCmd
 from app.cmd.ctlpl import ControlPlaneCmd
+from app.cmd.daemon import DaemonCmd
 from app.cmd.lb import LbCmd
+from app.cmd.reconcile import PlanCmd, ApplyCmd
 from app.cmd.help import TreeCmd
 from app.cmd.worker import WorkerCmd
 from app.cmd.vm import VmCmd
+from app import daemon
+from app import config
 
 
 class MainCmd(Cmd):
@@ -17,12 +23,25 @@ class MainCmd(Cmd):
                              LbCmd(),
                              WorkerCmd(),
                              VmCmd(),
+                             PlanCmd(),
+                             ApplyCmd(),
+                             AutoscalerCmd(),
+                             DaemonCmd(),
                              TreeCmd(parent=self)
                          ])
 
 
 def main():
-    MainCmd().run(sys.argv[1:])
+    argv = sys.argv[1:]
+    # NOTE: forward to a running kp daemon, KP_NO_DAEMON=1 forces a local run,
+    # so do KP_TRACE_FILE and KP_METRICS_FILE which are about this process
+    local = os.getenv(
+        "KP_NO_DAEMON") or config.TRACE_FILE or config.METRICS_FILE
+    if argv and argv[0] != "daemon" and not local:
+        exitcode = daemon.forward(argv)
+        if exitcode is not None:
+            sys.exit(exitcode)
+    MainCmd().run(argv)
 
 
 if __name__ == "__main__":
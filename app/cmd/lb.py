@@ -20,14 +20,9 @@ class CreateLbCmd(Cmd):
 
     def _run(self):
         urllib3.disable_warnings()
-        log = Logger.from_env()
+        log = self.logger()
         cfg = load_config(log=log)
-        proxmox_node = cfg["proxmox_node"]
-
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg,
-                                                                      log=log),
-                                 proxmox_node,
-                                 log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
 
         service = LbService(nodectl, log=log)
         service.create_lb(**cfg)
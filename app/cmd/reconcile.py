@@ -0,0 +1,93 @@
+import json
+import urllib3
+
+from app.cmd.core import Cmd
+from app.config import load_config
+from app.logger import Logger
+from app.controller.node import NodeController
+from app.service.reconcile import ReconcileService
+from app.error import *
+from app import config
+
+
+def load_cluster_spec(cfg: dict, spec_file=None):
+    if spec_file:
+        with open(spec_file, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+    if not cfg.get("cluster_spec"):
+        raise InvalidClusterSpec("no cluster_spec in config and no spec file")
+    return cfg["cluster_spec"]
+
+
+def print_plan(steps, stdout=None):
+    if not steps:
+        print("no changes", file=stdout)
+        return
+    for step in steps:
+        sign = "+" if step["action"] == "create" else "-"
+        line = [sign, step["role"], str(step["vm_id"])]
+        if step["vm_ip"]:
+            line.append(step["vm_ip"])
+        if step["deps"]:
+            line.append(f"(after: {', '.join(step['deps'])})")
+        print(" ".join(line), file=stdout)
+
+
+class PlanCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("plan")
+
+    def _setup(self):
+        self.parser.add_argument("-f", "--spec-file")
+
+    def _run(self):
+        urllib3.disable_warnings()
+        log = self.logger()
+        args = self.parsed_args
+        cfg = load_config(log=log)
+        cluster_spec = load_cluster_spec(cfg, args.spec_file)
+        nodectl = NodeController.from_config(cfg, log=log)
+        cfg.pop("cluster_spec", None)
+        service = ReconcileService(nodectl, log=log)
+        print_plan(service.plan(cluster_spec, **cfg), stdout=self.stdout)
+
+
+class ApplyCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("apply")
+
+    def _setup(self):
+        self.parser.add_argument("-f", "--spec-file")
+        self.parser.add_argument("--concurrency", type=int)
+
+    def _run(self):
+        urllib3.disable_warnings()
+        log = self.logger()
+        args = self.parsed_args
+        cfg = load_config(log=log)
+        cluster_spec = load_cluster_spec(cfg, args.spec_file)
+        concurrency = args.concurrency or cfg.get("provision_concurrency",
+                                                  config.PROVISION_CONCURRENCY)
+        nodectl = NodeController.from_config(cfg, log=log)
+        cfg.pop("cluster_spec", None)
+        cfg.pop("provision_concurrency", None)
+        service = ReconcileService(nodectl, log=log)
+        inventory = nodectl.inventory()
+        steps = service.plan(cluster_spec, inventory=inventory, **cfg)
+        print_plan(steps, stdout=self.stdout)
+        results = service.apply(steps,
+                                concurrency=concurrency,
+                                inventory=inventory,
+                                **cfg)
+        failed = 0
+        for step in steps:
+            r = results[step["name"]]
+            if r["error"]:
+                failed += 1
+                self.print(step["name"], "FAILED", r["error"])
+                continue
+            self.print(step["name"], "OK")
+        if failed:
+            raise Exception(f"{failed} of {len(steps)} steps failed")
@@ -1,16 +1,23 @@
 import os
+import json
+import functools
 import urllib3
 
 from app.cmd.core import Cmd
 from app.config import load_config
+from app import config
 from app.logger import Logger
 from app.controller.node import NodeController
+from app.service.vm import VmService
 
 
 class VmCmd(Cmd):
 
     def __init__(self) -> None:
-        super().__init__("vm", childs=[RebootVmCmd(), RemoveVmCmd()])
+        super().__init__("vm",
+                         childs=[RebootVmCmd(),
+                                 RemoveVmCmd(),
+                                 ExecVmCmd()])
 
 
 class RebootVmCmd(Cmd):
@@ -24,13 +31,10 @@ class RebootVmCmd(Cmd):
     def _run(self):
         urllib3.disable_warnings()
         args = self.parsed_args
-        log = Logger.from_env()
+        log = self.logger()
         ids = args.ids
         cfg = load_config(log=log)
-        proxmox_node = cfg["proxmox_node"]
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg),
-                                 proxmox_node,
-                                 log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
         for id in ids:
             vmctl = nodectl.vmctl(id)
             vmctl.reboot()
@@ -43,19 +47,96 @@ class RemoveVmCmd(Cmd):
 
     def _setup(self):
         self.parser.add_argument("ids", nargs="+")
+        self.parser.add_argument("--concurrency", type=int)
+        self.parser.add_argument("--max-unavailable", type=int)
 
     def _run(self):
         urllib3.disable_warnings()
         args = self.parsed_args
-        log = Logger.from_env()
+        log = self.logger()
         ids = args.ids
         cfg = load_config(log=log)
-        proxmox_node = cfg["proxmox_node"]
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg),
-                                 proxmox_node,
-                                 log=log)
-        for id in ids:
-            vmctl = nodectl.vmctl(id)
-            vmctl.shutdown()
-            vmctl.wait_for_shutdown()
-            vmctl.delete()
+        nodectl = NodeController.from_config(cfg, log=log)
+        concurrency = args.concurrency or cfg.get("delete_concurrency",
+                                                  config.DELETE_CONCURRENCY)
+        max_unavailable = args.max_unavailable or cfg.get(
+            "delete_max_unavailable", None)
+        results = VmService(nodectl, log=log).delete_vms(
+            ids, concurrency=concurrency, max_unavailable=max_unavailable)
+        print_delete_results(results, stdout=self.stdout)
+
+
+class ExecVmCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("exec")
+
+    def _setup(self):
+        self.parser.add_argument("ids", nargs="*")
+        self.parser.add_argument("-c",
+                                 "--command",
+                                 required=True,
+                                 help="run with sh -c in every vm")
+        self.parser.add_argument("--tag",
+                                 help="also every vm with this tag, e.g. " +
+                                 config.WORKER_TAG)
+        self.parser.add_argument("--concurrency", type=int)
+        self.parser.add_argument("--timeout",
+                                 type=int,
+                                 default=config.TIMEOUT,
+                                 help="seconds, per vm")
+        self.parser.add_argument("--json",
+                                 action="store_true",
+                                 help="one json object per line")
+
+    def _run(self):
+        urllib3.disable_warnings()
+        args = self.parsed_args
+        log = self.logger()
+        ids = [int(x) for x in args.ids]
+        cfg = load_config(log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
+        if args.tag:
+            for vm in nodectl.inventory().tagged(args.tag):
+                if int(vm["vmid"]) not in ids:
+                    ids.append(int(vm["vmid"]))
+        concurrency = args.concurrency or cfg.get("exec_concurrency",
+                                                  config.EXEC_CONCURRENCY)
+        results = VmService(nodectl, log=log).exec_vms(
+            ids, ["sh", "-c", args.command],
+            concurrency=concurrency,
+            timeout=args.timeout,
+            on_result=functools.partial(
+                print_exec_result_json if args.json else print_exec_result,
+                stdout=self.stdout))
+        failed = [r for r in results if r["error"] or r["exitcode"] != 0]
+        if failed:
+            raise Exception(f"{len(failed)} of {len(results)} vms failed")
+
+
+def print_exec_result(r, stdout=None):
+    if r["error"]:
+        print(r["vm_id"], "FAILED", r["duration"], r["error"], file=stdout)
+        return
+    print(r["vm_id"], "exitcode", r["exitcode"], r["duration"], file=stdout)
+    if r["stdout"]:
+        print(r["stdout"].rstrip("\n"), file=stdout)
+    if r["stderr"]:
+        print(r["stderr"].rstrip("\n"), file=stdout)
+
+
+def print_exec_result_json(r, stdout=None):
+    r = dict(r, error=str(r["error"]) if r["error"] else None)
+    print(json.dumps(r), file=stdout, flush=True)
+
+
+def print_delete_results(results, stdout=None):
+    failed = 0
+    for r in results:
+        if r["error"]:
+            failed += 1
+            print(r["vm_id"], "FAILED", r["duration"], r["error"], file=stdout)
+            continue
+        print(r["vm_id"], "OK", r["duration"], file=stdout)
+    if failed:
+        raise Exception(f"{failed} of {len(results)} vms failed")
@@ -3,9 +3,12 @@ import urllib3
 
 from app.cmd.core import Cmd
 from app.config import load_config
+from app import config
 from app.logger import Logger
 from app.controller.node import NodeController
 from app.service.worker import WorkerService
+from app.service.pool import WarmPoolService
+from app.cmd.vm import print_delete_results
 
 
 class WorkerCmd(Cmd):
@@ -16,6 +19,7 @@ class WorkerCmd(Cmd):
                              CreateWorkerCmd(),
                              DeleteWorkerCmd(),
                              JoinWorkerCmd(),
+                             PoolCmd(),
                          ],
                          aliases=["wk"])
 
@@ -25,20 +29,39 @@ class CreateWorkerCmd(Cmd):
     def __init__(self) -> None:
         super().__init__("create")
 
+    def _setup(self):
+        self.parser.add_argument("-n", "--count", type=int, default=1)
+        self.parser.add_argument("--concurrency", type=int)
+
     def _run(self):
         urllib3.disable_warnings()
-        log = Logger.from_env()
+        log = self.logger()
+        args = self.parsed_args
+        count = args.count
 
         cfg = load_config(log=log)
-        proxmox_node = cfg["proxmox_node"]
-
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg,
-                                                                      log=log),
-                                 proxmox_node,
-                                 log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
 
         service = WorkerService(nodectl, log=log)
-        service.create_worker(**cfg)
+        if count <= 1 and cfg.get("warm_pool_size", 0):
+            WarmPoolService(nodectl, log=log).create_worker(**cfg)
+            return
+        if count <= 1:
+            service.create_worker(**cfg)
+            return
+
+        concurrency = args.concurrency or cfg.get("provision_concurrency",
+                                                  config.PROVISION_CONCURRENCY)
+        results = service.create_workers(count, concurrency=concurrency, **cfg)
+        failed = 0
+        for r in results:
+            if r["error"]:
+                failed += 1
+                self.print(r["vm_id"], r["vm_ip"], "FAILED", r["error"])
+                continue
+            self.print(r["vm_id"], r["vm_ip"], "OK")
+        if failed:
+            raise Exception(f"{failed} of {count} workers failed")
 
 
 class DeleteWorkerCmd(Cmd):
@@ -47,26 +70,35 @@ class DeleteWorkerCmd(Cmd):
         super().__init__("delete", aliases=["remove", "rm"])
 
     def _setup(self):
-        self.parser.add_argument("vmid", type=int)
+        self.parser.add_argument("vmids", type=int, nargs="*")
+        self.parser.add_argument("--concurrency", type=int)
+        self.parser.add_argument("--max-unavailable", type=int)
 
     def _run(self):
         urllib3.disable_warnings()
-        log = Logger.from_env()
+        log = self.logger()
         args = self.parsed_args
-        vm_id = args.vmid or os.getenv("VMID")
-        log.debug("vm_id", vm_id)
+        vm_ids = args.vmids or ([os.getenv("VMID")]
+                                if os.getenv("VMID") else [])
+        log.debug("vm_ids", vm_ids)
 
-        if not vm_id:
+        if not vm_ids:
             raise ValueError("vm_id is missing")
 
         cfg = load_config(log=log)
-        proxmox_node = cfg["proxmox_node"]
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg),
-                                 proxmox_node,
-                                 log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
 
         service = WorkerService(nodectl, log=log)
-        service.delete_worker(vm_id, **cfg)
+        if len(vm_ids) == 1:
+            service.delete_worker(vm_ids[0], **cfg)
+            return
+        params = dict(cfg)
+        params["concurrency"] = args.concurrency or cfg.get(
+            "delete_concurrency", config.DELETE_CONCURRENCY)
+        params["max_unavailable"] = args.max_unavailable or cfg.get(
+            "delete_max_unavailable", None)
+        print_delete_results(service.delete_workers(vm_ids, **params),
+                             stdout=self.stdout)
 
 
 class JoinWorkerCmd(Cmd):
@@ -80,17 +112,61 @@ class JoinWorkerCmd(Cmd):
 
     def _run(self):
         urllib3.disable_warnings()
-        log = Logger.from_env()
+        log = self.logger()
         args = self.parsed_args
         worker_ids = args.workerids
         control_plane_id = args.ctlplid
         cfg = load_config(log=log)
-        proxmox_node = cfg["proxmox_node"]
-        nodectl = NodeController(NodeController.create_proxmox_client(**cfg),
-                                 proxmox_node,
-                                 log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
 
-        join_cmd = nodectl.ctlplvmctl(
-            control_plane_id).kubeadm().create_join_command()
+        workerservice = WorkerService(nodectl, log=log)
         for id in worker_ids:
-            nodectl.wkctl(id).exec(join_cmd)
+            workerservice.join_worker(id, control_plane_id)
+
+
+class PoolCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("pool", childs=[FillPoolCmd(), ListPoolCmd()])
+
+
+class FillPoolCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("fill")
+
+    def _setup(self):
+        self.parser.add_argument("-s", "--size", type=int)
+
+    def _run(self):
+        urllib3.disable_warnings()
+        log = self.logger()
+        args = self.parsed_args
+        cfg = load_config(log=log)
+        size = args.size
+        if size is None:
+            size = cfg.get("warm_pool_size", 0)
+        nodectl = NodeController.from_config(cfg, log=log)
+        cfg.pop("warm_pool_size", None)
+        service = WarmPoolService(nodectl, log=log)
+        for r in service.fill(size, **cfg):
+            if r["error"]:
+                self.print(r["vm_id"], r["vm_ip"], "FAILED", r["error"])
+                continue
+            self.print(r["vm_id"], r["vm_ip"], "OK")
+
+
+class ListPoolCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("list", aliases=["ls"])
+
+    def _run(self):
+        urllib3.disable_warnings()
+        log = self.logger()
+        cfg = load_config(log=log)
+        nodectl = NodeController.from_config(cfg, log=log)
+        service = WarmPoolService(nodectl, log=log)
+        for vm in service.list_warm(booting=True):
+            self.print(vm["vmid"], vm.get("name"), vm.get("status"),
+                       vm.get("tags"))
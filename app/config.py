@@ -15,3 +15,79 @@ def load_config(config_path=os.getenv("CONFIG_PATH"), log=Logger.DEBUG):
 
 KUBECONFIG = "/etc/kubernetes/admin.conf"
 TIMEOUT = 30 * 60  # 30 min
+
+# SECTION: polling
+POLL_INITIAL_INTERVAL = 0.1
+POLL_MAX_INTERVAL = 10  # interval_check overrides it
+POLL_BACKOFF_FACTOR = 2
+POLL_JITTER = 0.1  # +-10%
+POWER_POLL_MAX_INTERVAL = 5
+
+# SECTION: proxmox api
+HTTP_POOL_SIZE = 16  # keep-alive connections
+INVENTORY_MAX_WORKERS = 8  # concurrent vm config requests
+CLONE_STRATEGY = "auto"  # linked, full or auto
+PLACEMENT_STRATEGY = "none"  # binpack or spread, none keeps every vm on proxmox_node
+PLACEMENT_CPU_OVERCOMMIT = 4  # vcpus per physical cpu of a node
+LOCATE_TTL = 60  # seconds the node of a vm is trusted, vms migrate
+
+# SECTION: tags
+WORKER_TAG = "kp-worker"
+CONTROL_PLANE_TAG = "kp-control-plane"
+LB_TAG = "kp-lb"
+WARM_POOL_TAG = "kp-warm"
+WARM_POOL_FILL_TTL = 30 * 60
+
+# SECTION: concurrency
+PROVISION_CONCURRENCY = 4
+DELETE_CONCURRENCY = 4
+DELETE_SHUTDOWN_TIMEOUT = 3 * 60  # then proxmox stops the vm
+EXEC_CONCURRENCY = 16
+
+# SECTION: guest agent
+EXEC_TAIL_SIZE = 64 * 1024  # characters kept by exec_stream
+FILE_WRITE_MAX_SIZE = 60 * 1024  # maxLength of agent/file-write content
+TRANSFER_CHUNK_SIZE = 44 * 1024  # base64 of it fits FILE_WRITE_MAX_SIZE
+TRANSFER_READ_CHUNK_SIZE = 4 * 1024 * 1024  # qemu-ga caps exec output at 16MiB
+TRANSFER_CONCURRENCY = 4
+TRANSFER_RETRIES = 3
+
+# SECTION: join
+JOIN_MODE = "exec"  # or cloud-init
+JOIN_TIMEOUT = 15 * 60
+JOIN_TOKEN_TTL = 24 * 60 * 60  # kubeadm default
+JOIN_CERTIFICATE_KEY_TTL = 2 * 60 * 60  # fixed by kubeadm
+JOIN_REFRESH_MARGIN = 30 * 60
+JOIN_CACHE_PATH = os.getenv("KP_JOIN_CACHE",
+                            os.path.expanduser("~/.cache/kp/join.json"))
+SNIPPETS_STORAGE = "local"  # needs the snippets content type
+SNIPPETS_DIR = "/var/lib/vz/snippets"
+
+# SECTION: leases
+LEASE_DB_PATH = os.getenv("KP_LEASE_DB",
+                          os.path.expanduser("~/.cache/kp/leases.db"))
+LEASE_TTL = 60 * 60
+
+# SECTION: load balancer
+LB_UPDATE_MODE = "reload"  # or runtime, through the haproxy admin socket
+HAPROXY_ADMIN_SOCKET = "/run/haproxy/admin.sock"
+
+# SECTION: autoscaler
+AUTOSCALER_INTERVAL = 60
+AUTOSCALER_SCALE_UP_COOLDOWN = 3 * 60
+AUTOSCALER_SCALE_DOWN_COOLDOWN = 10 * 60
+AUTOSCALER_SCALE_DOWN_UTILIZATION = 0.5  # of the node allocatable cpu/memory
+
+# SECTION: daemon
+# NOTE: in a directory only this user can write to
+DAEMON_SOCKET = os.getenv(
+    "KP_SOCKET",
+    os.path.join(
+        os.getenv("XDG_RUNTIME_DIR") or f"/tmp/kp-{os.getuid()}", "kp.sock"))
+DAEMON_KEEPALIVE_INTERVAL = 15 * 60  # the password ticket lives 2h
+
+# SECTION: observability
+# NOTE: the textfile holds the metrics of the last run only, the daemon /metrics has the running totals
+METRICS_FILE = os.getenv("KP_METRICS_FILE")  # node-exporter textfile
+METRICS_PORT = os.getenv("KP_METRICS_PORT", "0")  # parsed by kp daemon
+TRACE_FILE = os.getenv("KP_TRACE_FILE")  # Chrome trace format
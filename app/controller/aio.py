@@ -0,0 +1,508 @@
+import json
+import time
+import asyncio
+import functools
+
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from app.logger import Logger
+from app.controller.node import NodeController
+from app.controller.task import TaskController
+from app.controller.vm import *
+from app.controller.vm import _KubeadmExecutor
+from app.error import *
+from app.poll import apoll
+from app import config
+from app import metrics
+from app import trace
+
+
+async def run_in(executor: ThreadPoolExecutor, fn, *args, **kwargs):
+    """
+    Run one blocking call (e.g. a proxmox http request) on executor, None is the loop default.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor,
+                                      functools.partial(fn, *args, **kwargs))
+
+
+class AsyncTaskController:
+
+    def __init__(self, taskctl: TaskController, executor=None) -> None:
+        self.taskctl = taskctl
+        self.executor = executor
+        self.upid = taskctl.upid
+        self.node = taskctl.node
+        self.log = taskctl.log
+
+    def __str__(self) -> str:
+        return self.upid
+
+    async def status(self):
+        return await run_in(self.executor, self.taskctl.status)
+
+    async def wait(self,
+                   timeout=config.TIMEOUT,
+                   interval_check=None,
+                   check=True):
+        """
+        Same as TaskController.wait, the waits between the status calls do not hold a thread.
+        """
+        taskctl = self.taskctl
+        node = self.node
+        upid = self.upid
+        log = self.log
+
+        async def is_stopped():
+            r = await self.status()
+            if r.get("status") != "stopped":
+                return None
+            return r
+
+        try:
+            r = await apoll(is_stopped,
+                            timeout=timeout,
+                            max_interval=interval_check)
+        except TimeoutError:
+            log.debug(node, "task", upid, "timeout")
+            raise
+        exitstatus = r.get("exitstatus", None)
+        duration = round(time.monotonic() - taskctl.started_at, 3)
+        log.debug(node, "task", upid, "exitstatus", exitstatus, "duration",
+                  duration)
+        if taskctl.on_done:
+            taskctl.on_done(exitstatus, duration)
+        if check and not TaskController.is_ok(exitstatus):
+            raise TaskFailedError(upid, exitstatus)
+        return exitstatus, duration
+
+
+class AsyncVmController:
+    """
+    Asyncio version of VmController, only the requests hold an executor thread.
+    """
+
+    sync_class = VmController
+
+    def __init__(self,
+                 api: ProxmoxAPI,
+                 node: str,
+                 vm_id: str,
+                 log=Logger.DEBUG,
+                 executor: ThreadPoolExecutor = None,
+                 **kwargs) -> None:
+        self.api = api
+        self.node = node
+        self.vm_id = vm_id
+        self.log = log
+        self.executor = executor
+        # NOTE: the sync controller does the requests that do not wait
+        self.sync = self.sync_class(api, node, vm_id, log=log, **kwargs)
+
+    async def call(self, fn, *args, **kwargs):
+        return await run_in(self.executor, fn, *args, **kwargs)
+
+    @trace.traced()
+    async def exec(self,
+                   cmd: List[str],
+                   timeout=config.TIMEOUT,
+                   interval_check=None):
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        started_at = time.monotonic()
+        pid = await self.call(self.sync.exec_start, cmd)
+
+        async def check():
+            status = await self.call(self.sync.exec_status, pid)
+            if not status:
+                log.debug(node, vm_id, "exec", pid, "wait",
+                          round(time.monotonic() - started_at, 1))
+            return status
+
+        try:
+            status = await apoll(check,
+                                 timeout=timeout,
+                                 max_interval=interval_check)
+        except TimeoutError:
+            log.debug(node, vm_id, "exec", pid, "timeout")
+            metrics.timeouts.inc(op="exec")
+            raise
+        return self.sync.exec_result(pid, status, started_at)
+
+    @trace.traced()
+    async def exec_stream(self,
+                          cmd: List[str],
+                          stdout=None,
+                          stderr=None,
+                          tail_size=config.EXEC_TAIL_SIZE,
+                          timeout=config.TIMEOUT,
+                          interval_check=None,
+                          chunk_size=config.TRANSFER_READ_CHUNK_SIZE):
+        """
+        Same as VmController.exec_stream.
+        """
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        sync = self.sync
+        paths = VmController.exec_stream_paths()
+        streams = [
+            OutputStream(stdout, tail_size=tail_size),
+            OutputStream(stderr, tail_size=tail_size)
+        ]
+        pid = await self.call(sync.exec_start,
+                              VmController.exec_stream_cmd(cmd, paths))
+
+        async def read_new():
+            read_pid = await self.call(
+                sync.exec_start,
+                VmController.exec_stream_read_cmd(streams, paths, chunk_size))
+            status = await apoll(lambda: self.call(sync.exec_status, read_pid),
+                                 timeout=timeout,
+                                 max_interval=1)
+            return sync.exec_stream_feed(pid, streams, status, chunk_size)
+
+        async def check():
+            status = await self.call(sync.exec_status, pid)
+            await read_new()
+            return status
+
+        try:
+            try:
+                status = await apoll(check,
+                                     timeout=timeout,
+                                     max_interval=interval_check)
+            except TimeoutError:
+                log.debug(node, vm_id, "exec", pid, "timeout")
+                metrics.timeouts.inc(op="exec_stream")
+                raise
+            while await read_new():
+                pass
+        finally:
+            for x in streams:
+                x.close()
+            # NOTE: a failed cleanup must not hide the error of cmd
+            try:
+                await self.exec(["rm", "-f", *paths], interval_check=1)
+            except Exception as err:
+                log.error(node, vm_id, "exec", pid, "rm", paths, err)
+        exitcode: int = status.get("exitcode", None)
+        log.debug(node, vm_id, "exec", pid, "exitcode", exitcode)
+        return exitcode, streams[0].tail, streams[1].tail
+
+    @trace.traced()
+    async def wait_for_guest_agent(self,
+                                   timeout=config.TIMEOUT,
+                                   interval_check=None):
+        api = self.api
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        started_at = time.monotonic()
+
+        async def check():
+            try:
+                await self.call(api.nodes(node).qemu(vm_id).agent.ping.post)
+                return True
+            except Exception as err:
+                log.debug(node, vm_id, "wait_for_guest_agent",
+                          round(time.monotonic() - started_at, 1))
+                return False
+
+        try:
+            await apoll(check, timeout=timeout, max_interval=interval_check)
+        except TimeoutError:
+            log.debug(node, vm_id, "wait_for_guest_agent", "timeout")
+            metrics.timeouts.inc(op="wait_for_guest_agent")
+            raise
+        log.debug(node, vm_id, "wait_for_guest_agent", "READY")
+
+    @trace.traced()
+    async def wait_for_shutdown(self,
+                                timeout=config.TIMEOUT,
+                                interval_check=None):
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        started_at = time.monotonic()
+
+        async def check():
+            log.debug(node, vm_id, "wait_for_shutdown",
+                      round(time.monotonic() - started_at, 1))
+            try:
+                r = await self.call(self.sync.current_status)
+                return r["status"] == "stopped"
+            except Exception as err:
+                log.debug("shutdown", err)
+                return False
+
+        try:
+            await apoll(check, timeout=timeout, max_interval=interval_check)
+        except TimeoutError:
+            log.debug(node, vm_id, "wait_for_shutdown", "timeout")
+            metrics.timeouts.inc(op="wait_for_shutdown")
+            raise
+
+    async def update_config(self, **kwargs):
+        return await self.call(self.sync.update_config, **kwargs)
+
+    async def current_config(self):
+        return await self.call(self.sync.current_config)
+
+    async def current_status(self):
+        return await self.call(self.sync.current_status)
+
+    async def resize_disk(self, disk: str, size: str):
+        return await self.call(self.sync.resize_disk, disk, size)
+
+    async def write_file(self, filepath: str, content: str, encode=True):
+        return await self.call(self.sync.write_file,
+                               filepath,
+                               content,
+                               encode=encode)
+
+    async def read_file(self, filepath: str):
+        return await self.call(self.sync.read_file, filepath)
+
+    async def task(self, fn, *args, **kwargs):
+        taskctl = await self.call(fn, *args, **kwargs)
+        return AsyncTaskController(taskctl, executor=self.executor)
+
+    async def startup(self):
+        return await self.task(self.sync.startup)
+
+    async def shutdown(self, timeout=None, force_stop=False):
+        return await self.task(self.sync.shutdown,
+                               timeout=timeout,
+                               force_stop=force_stop)
+
+    async def reboot(self):
+        return await self.task(self.sync.reboot)
+
+    async def delete(self):
+        return await self.task(self.sync.delete)
+
+
+class _AsyncKubeadmExecutor():
+
+    def __init__(self, vmctl: AsyncVmController) -> None:
+        self.vmctl = vmctl
+
+    async def reset(self, cmd=["kubeadm", "reset", "-f"]):
+        return await self.vmctl.exec(cmd)
+
+    async def init(self, control_plane_endpoint, pod_cidr, timeout=10 * 60):
+        cmd = _KubeadmExecutor.init_cmd(control_plane_endpoint, pod_cidr)
+        return await self.vmctl.exec(cmd, timeout=timeout)
+
+    async def create_join_credentials(self,
+                                      ttl=config.JOIN_TOKEN_TTL,
+                                      with_certificate_key=False,
+                                      timeout=config.TIMEOUT,
+                                      interval_check=3):
+        vmctl = self.vmctl
+        log = vmctl.log
+        now = time.time()
+        r = await vmctl.exec(_KubeadmExecutor.token_create_cmd(ttl),
+                             timeout=timeout,
+                             interval_check=interval_check)
+        credentials = _KubeadmExecutor.parse_join_credentials(*r, now, ttl)
+        if with_certificate_key:
+            r = await vmctl.exec(_KubeadmExecutor.upload_certs_cmd(),
+                                 timeout=timeout,
+                                 interval_check=interval_check)
+            _KubeadmExecutor.parse_certificate_key(credentials, *r, now)
+        log.debug("join_credentials", credentials["endpoint"],
+                  credentials["expires_at"])
+        return credentials
+
+
+class AsyncKubeVmController(AsyncVmController):
+
+    sync_class = KubeVmController
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._kubeadm = _AsyncKubeadmExecutor(self)
+
+    def kubeadm(self):
+        return self._kubeadm
+
+
+class AsyncControlPlaneVmController(AsyncKubeVmController):
+
+    sync_class = ControlPlaneVmController
+
+    async def drain_node(self,
+                         node_name: str,
+                         kubeconfig_filepath=config.KUBECONFIG,
+                         stdout=None,
+                         stderr=None):
+        cmd = [
+            "kubectl", f"--kubeconfig={kubeconfig_filepath}", "drain",
+            "--ignore-daemonsets", node_name
+        ]
+        return await self.exec_stream(cmd,
+                                      stdout=stdout,
+                                      stderr=stderr,
+                                      interval_check=5,
+                                      timeout=30 * 60)
+
+    async def delete_node(self,
+                          node_name,
+                          kubeconfig_filepath=config.KUBECONFIG):
+        cmd = [
+            "kubectl", f"--kubeconfig={kubeconfig_filepath}", "delete", "node",
+            node_name
+        ]
+        return await self.exec(cmd, interval_check=5)
+
+    async def get_pods_and_nodes(self, kubeconfig_filepath=config.KUBECONFIG):
+        cmd = [
+            "kubectl", f"--kubeconfig={kubeconfig_filepath}", "get",
+            "pods,nodes", "--all-namespaces", "-o", "json"
+        ]
+        exitcode, stdout, stderr = await self.exec(cmd, interval_check=3)
+        if exitcode != 0:
+            raise KubectlFailedError(stderr)
+        return json.loads(stdout)
+
+    async def ensure_cert_dirs(self, dirs=["/etc/kubernetes/pki/etcd"]):
+        for d in dirs:
+            await self.exec(["mkdir", "-p", d], interval_check=3)
+
+    async def cat_kubeconfig(self, filepath=config.KUBECONFIG):
+        return await self.exec(["cat", filepath])
+
+    async def apply_file(self,
+                         filepath: str,
+                         kubeconfig_filepath=config.KUBECONFIG):
+        cmd = [
+            "kubectl", "apply", f"--kubeconfig={kubeconfig_filepath}", "-f",
+            filepath
+        ]
+        return await self.exec(cmd)
+
+
+class AsyncWorkerVmController(AsyncKubeVmController):
+
+    sync_class = WorkerVmController
+
+
+class AsyncLbVmController(AsyncVmController):
+
+    sync_class = LbVmController
+
+    @property
+    def update_mode(self):
+        return self.sync.update_mode
+
+    async def reload_haproxy(self):
+        return await self.exec(["systemctl", "reload", "haproxy"],
+                               interval_check=3)
+
+    async def apply_backends(self,
+                             ops: List[tuple],
+                             validate=True,
+                             reload=True):
+        cmd = self.sync.apply_backends_cmd(ops,
+                                           validate=validate,
+                                           reload=reload)
+        return await self.exec(cmd, interval_check=3)
+
+
+class AsyncNodeController:
+    """
+    Asyncio version of NodeController, use it with `with` or `async with` to shut the executor down.
+    Example: vmctl = await asyncnodectl.vmctl(100)
+    """
+
+    def __init__(self,
+                 nodectl: NodeController,
+                 executor: ThreadPoolExecutor = None) -> None:
+        self.nodectl = nodectl
+        self.api = nodectl.api
+        self.node = nodectl.node
+        self.log = nodectl.log
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=config.HTTP_POOL_SIZE, thread_name_prefix="kp-http")
+
+    @staticmethod
+    def from_config(cfg: dict, log=Logger.DEBUG):
+        return AsyncNodeController(NodeController.from_config(cfg, log=log))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    async def call(self, fn, *args, **kwargs):
+        return await run_in(self.executor, fn, *args, **kwargs)
+
+    async def _controller(self, cls, vm_id, **kwargs):
+        # NOTE: locate may fetch the inventory, not on the event loop
+        node = await self.call(self.nodectl.locate, vm_id)
+        return cls(self.api,
+                   node,
+                   vm_id,
+                   log=self.log,
+                   executor=self.executor,
+                   **kwargs)
+
+    async def vmctl(self, vm_id):
+        return await self._controller(AsyncVmController, vm_id)
+
+    async def ctlplvmctl(self, vm_id):
+        return await self._controller(AsyncControlPlaneVmController, vm_id)
+
+    async def wkctl(self, vm_id):
+        return await self._controller(AsyncWorkerVmController, vm_id)
+
+    async def lbctl(self, vm_id):
+        return await self._controller(AsyncLbVmController,
+                                      vm_id,
+                                      update_mode=self.nodectl.lb_update_mode)
+
+    def taskctl(self, upid: str):
+        return AsyncTaskController(self.nodectl.taskctl(upid),
+                                   executor=self.executor)
+
+    async def inventory(self, max_workers=config.INVENTORY_MAX_WORKERS):
+        return await self.call(self.nodectl.inventory, max_workers=max_workers)
+
+    async def find_vm(self, vm_id: int, inventory=None):
+        inventory = inventory or await self.inventory()
+        return inventory.find(vm_id)
+
+    async def clone(self, old_id, new_id, **kwargs):
+        taskctl = await self.call(self.nodectl.clone, old_id, new_id, **kwargs)
+        return AsyncTaskController(taskctl, executor=self.executor)
+
+    async def place(self, template_id, new_vm_id, **kwargs):
+        return await self.call(self.nodectl.place, template_id, new_vm_id,
+                               **kwargs)
+
+    async def join_command(self,
+                           control_plane_vm_id,
+                           is_control_plane=False,
+                           with_certificate_key=False):
+        """
+        Through the join cache of the sync controller.
+        """
+        return await self.call(self.nodectl.join_command,
+                               control_plane_vm_id,
+                               is_control_plane=is_control_plane,
+                               with_certificate_key=with_certificate_key)
@@ -0,0 +1,106 @@
+import time
+import threading
+
+from typing import List, Mapping
+from proxmoxer import ProxmoxAPI
+from app.logger import Logger
+from app.poll import Backoff
+from app.error import *
+from app import config
+from app import metrics
+
+
+class ClusterController:
+    """
+    Every node of the cluster with its storages and vms, from one `/cluster/resources` call.
+    """
+
+    def __init__(self, api: ProxmoxAPI, log=Logger.DEBUG) -> None:
+        self.api = api
+        self.log = log
+
+    def resources(self):
+        """
+        Return {"nodes", "storages", "vms"} of the online nodes, raw `/cluster/resources` items.
+        """
+        api = self.api
+        log = self.log
+        r = api.cluster.resources.get()
+        nodes = [
+            x for x in r
+            if x.get("type") == "node" and x.get("status") == "online"
+        ]
+        online = set(x["node"] for x in nodes)
+        storages = [
+            x for x in r
+            if x.get("type") == "storage" and x.get("node") in online
+            and x.get("status", "available") == "available"
+        ]
+        vms = [x for x in r if x.get("type") == "qemu"]
+        metrics.cluster_nodes.set(len(nodes))
+        log.debug("cluster", "resources", len(nodes), "nodes", len(storages),
+                  "storages", len(vms), "vms")
+        return {"nodes": nodes, "storages": storages, "vms": vms}
+
+    def nodes(self):
+        return [x["node"] for x in self.resources()["nodes"]]
+
+
+class PowerWatcher:
+    """
+    Wait for many vms to stop with one `/cluster/resources` poll for all of them.
+    """
+
+    def __init__(self,
+                 api: ProxmoxAPI,
+                 max_interval=config.POWER_POLL_MAX_INTERVAL,
+                 log=Logger.DEBUG) -> None:
+        self.api = api
+        self.max_interval = max_interval
+        self.log = log
+        self.lock = threading.Lock()
+        self.watched: Mapping[int, threading.Event] = {}
+        self.thread: threading.Thread = None
+
+    def wait_stopped(self, vm_id, timeout=config.TIMEOUT):
+        """
+        Return True once the vm is stopped (or gone), False after timeout seconds.
+        """
+        vm_id = int(vm_id)
+        with self.lock:
+            event = self.watched.setdefault(vm_id, threading.Event())
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run,
+                                               name="power-watcher",
+                                               daemon=True)
+                self.thread.start()
+        stopped = event.wait(timeout)
+        if not stopped:
+            with self.lock:
+                if self.watched.get(vm_id) is event:
+                    del self.watched[vm_id]
+        return stopped
+
+    def _run(self):
+        api = self.api
+        log = self.log
+        backoff = Backoff(max_interval=self.max_interval)
+        while True:
+            with self.lock:
+                if not self.watched:
+                    self.thread = None
+                    return
+            try:
+                r = api.cluster.resources.get(type="vm")
+                status = {int(x["vmid"]): x.get("status") for x in r}
+            except Exception as err:
+                log.error("power_watcher", err)
+                status = None
+            if status is not None:
+                with self.lock:
+                    for vm_id in list(self.watched):
+                        if status.get(vm_id, "stopped") == "stopped":
+                            log.debug("power_watcher", vm_id, "stopped")
+                            self.watched.pop(vm_id).set()
+                            backoff.reset()
+            time.sleep(backoff.next())
@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Mapping
+from proxmoxer import ProxmoxAPI
+from app.logger import Logger
+from app.error import *
+from app import config
+from app import util
+
+
+class Inventory:
+    """
+    Point-in-time view of the vms from one `/cluster/resources` call, ips are fetched once on demand.
+    """
+
+    def __init__(self,
+                 api: ProxmoxAPI,
+                 node: str,
+                 vms: List[dict],
+                 max_workers=config.INVENTORY_MAX_WORKERS,
+                 log=Logger.DEBUG,
+                 cluster_wide=False) -> None:
+        self.api = api
+        self.node = node
+        self.vms = vms
+        self.cluster_wide = cluster_wide
+        self.max_workers = max_workers
+        self.log = log
+        self._ips: Mapping[int, str] = None
+
+    def ids(self):
+        return set(int(vm["vmid"]) for vm in self.vms)
+
+    def node_vms(self, node: str = None):
+        node = node or self.node
+        return [vm for vm in self.vms if vm.get("node") == node]
+
+    def managed_vms(self):
+        """
+        The vms kp looks at: every vm of the cluster with placement on, the ones of node otherwise.
+        """
+        if self.cluster_wide:
+            return self.vms
+        return self.node_vms()
+
+    def tagged(self, *tags: str):
+        wanted = set(tags)
+        return [
+            vm for vm in self.managed_vms() if wanted.intersection(
+                util.ProxmoxUtil.split_tags(vm.get("tags", None)))
+        ]
+
+    def find(self, vm_id):
+        for vm in self.managed_vms():
+            if str(vm["vmid"]) == str(vm_id):
+                self.log.debug("vm", vm)
+                return vm
+        raise VmNotFoundError(vm_id)
+
+    def _fetch_ip(self, vm: dict):
+        api = self.api
+        vm_id = vm["vmid"]
+        r = api.nodes(vm["node"]).qemu(vm_id).config.get()
+        ifconfig0 = r.get("ipconfig0", None)
+        if not ifconfig0: return None
+        return util.ProxmoxUtil.extract_ip(ifconfig0)
+
+    def ips(self):
+        if self._ips is not None:
+            return self._ips
+        log = self.log
+        # NOTE: with placement every node shares the vm network, an ip is taken wherever its vm lives
+        vms = self.managed_vms()
+        ips = {}
+        if vms:
+            workers = max(1, min(self.max_workers, len(vms)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for vm, ip in zip(vms, pool.map(self._fetch_ip, vms)):
+                    if ip: ips[int(vm["vmid"])] = ip
+        log.debug(self.node, "inventory", "ips", ips)
+        self._ips = ips
+        return ips
@@ -0,0 +1,70 @@
+import requests
+
+from app.logger import Logger
+from app.poll import poll
+from app.error import *
+from app import config
+from app import metrics
+from app import trace
+
+
+class KubeApiController:
+    """
+    Kubernetes api with the bootstrap token of a join command, which can get nodes.
+    """
+
+    def __init__(self,
+                 endpoint: str,
+                 token: str,
+                 scheme="https",
+                 log=Logger.DEBUG) -> None:
+        self.endpoint = endpoint
+        self.token = token
+        self.scheme = scheme
+        self.log = log
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        # NOTE: the ca cert is not known here, only its hash, same as proxmox_verify_ssl=False
+        self.session.verify = False
+
+    @staticmethod
+    def from_credentials(credentials: dict, log=Logger.DEBUG):
+        return KubeApiController(credentials["endpoint"],
+                                 credentials["token"],
+                                 log=log)
+
+    def get_node(self, node_name: str, timeout=10):
+        """
+        Return the node object, None if it is not registered yet.
+        """
+        log = self.log
+        url = f"{self.scheme}://{self.endpoint}/api/v1/nodes/{node_name}"
+        r = self.session.get(url, timeout=timeout)
+        log.debug("kube", "get node", node_name, r.status_code)
+        if r.status_code == 404:
+            return None
+        if r.status_code != 200:
+            raise KubectlFailedError(
+                f"get node {node_name}: {r.status_code} {r.text}")
+        return r.json()
+
+    @trace.traced("wait_for_node")
+    def wait_for_node(self,
+                      node_name: str,
+                      timeout=config.JOIN_TIMEOUT,
+                      interval=5):
+        log = self.log
+
+        def check():
+            try:
+                return self.get_node(node_name)
+            except requests.RequestException as err:
+                # NOTE: e.g. the load balancer is not ready yet, keep polling
+                log.debug("kube", "get node", node_name, err)
+                return None
+
+        try:
+            return poll(check, timeout=timeout, max_interval=interval)
+        except TimeoutError:
+            metrics.timeouts.inc(op="wait_for_node")
+            raise KubectlFailedError(f"node {node_name} not found")
@@ -1,17 +1,93 @@
-from proxmoxer import ProxmoxAPI
+import os
+import time
+import socket
+import threading
+import ipaddress
+import requests
+
+from proxmoxer import ProxmoxAPI, ResourceException
+from typing import List, Mapping, Set
 from app.logger import Logger
 from app.controller.vm import *
+from app.controller.inventory import Inventory
+from app.controller.task import TaskController
+from app.controller.cluster import ClusterController
+from app.placement import Scheduler, STRATEGIES
+from app.lease import LeaseStore
+from app.joincache import JoinCache
+from app.ippool import IpPool
 from app.error import *
+from app import config
+from app import metrics
+from app import trace
 from app import util
 
 
 class NodeController:
 
-    def __init__(self, api: ProxmoxAPI, node: str, log=Logger.DEBUG) -> None:
+    def __init__(self,
+                 api: ProxmoxAPI,
+                 node: str,
+                 log=Logger.DEBUG,
+                 leases: LeaseStore = None,
+                 join_cache: JoinCache = None,
+                 placement=config.PLACEMENT_STRATEGY,
+                 lb_update_mode=config.LB_UPDATE_MODE,
+                 proxmox_host=None) -> None:
+        if placement not in STRATEGIES:
+            raise InvalidPlacementStrategy(placement)
+        if lb_update_mode not in ["reload", "runtime"]:
+            raise InvalidLbUpdateMode(lb_update_mode)
         self.api = api
         self.node = node
         self.log = log
-        pass
+        self.leases = leases
+        self.join_cache = join_cache
+        self.placement = placement
+        self.lb_update_mode = lb_update_mode
+        self.proxmox_host = proxmox_host
+        self.clone_timings: Mapping[str, List[float]] = {}
+        # NOTE: vm id -> (node, seen at), from the inventories and the clones
+        self.vm_nodes: Mapping[int, tuple] = {}
+        # NOTE: vm id -> when the inventory did not know it, not looked up again before the ttl
+        self.unlocated: Mapping[int, float] = {}
+        # NOTE: placed vms that do not show up in /cluster/resources yet
+        self.placed: List[dict] = []
+        self.placement_lock = threading.Lock()
+
+    @staticmethod
+    def from_config(cfg: dict, log=Logger.DEBUG):
+        """
+        An empty lease_db_path or join_cache_path disables the leases or the join cache.
+        """
+        leases = None
+        lease_db_path = cfg.get("lease_db_path", config.LEASE_DB_PATH)
+        if lease_db_path:
+            leases = LeaseStore(lease_db_path,
+                                ttl=cfg.get("lease_ttl", config.LEASE_TTL),
+                                log=log)
+        join_cache = None
+        join_cache_path = cfg.get("join_cache_path", config.JOIN_CACHE_PATH)
+        if join_cache_path:
+            join_cache = JoinCache(join_cache_path,
+                                   ttl=cfg.get("join_token_ttl",
+                                               config.JOIN_TOKEN_TTL),
+                                   log=log)
+        api = NodeController.create_proxmox_client(**cfg, log=log)
+        return NodeController(api,
+                              cfg["proxmox_node"],
+                              log=log,
+                              leases=leases,
+                              join_cache=join_cache,
+                              placement=cfg.get("placement",
+                                                config.PLACEMENT_STRATEGY),
+                              lb_update_mode=cfg.get("lb_update_mode",
+                                                     config.LB_UPDATE_MODE),
+                              proxmox_host=cfg.get("proxmox_host"))
+
+    # NOTE: set to a dict by long running processes (kp daemon) to reuse one authenticated session
+    client_cache: Mapping[tuple, ProxmoxAPI] = None
+    client_cache_lock = threading.Lock()
 
     @staticmethod
     def create_proxmox_client(proxmox_host,
@@ -22,44 +98,311 @@ class NodeController:
                               proxmox_verify_ssl=False,
                               log=Logger.DEBUG,
                               **kwargs):
+        cache = NodeController.client_cache
+        key = (proxmox_host, proxmox_user, proxmox_token_name)
+        if cache is None:
+            return NodeController._new_proxmox_client(proxmox_host,
+                                                      proxmox_user,
+                                                      proxmox_password,
+                                                      proxmox_token_name,
+                                                      proxmox_token_value,
+                                                      proxmox_verify_ssl, log)
+        with NodeController.client_cache_lock:
+            if key not in cache:
+                cache[key] = NodeController._new_proxmox_client(
+                    proxmox_host, proxmox_user, proxmox_password,
+                    proxmox_token_name, proxmox_token_value,
+                    proxmox_verify_ssl, log)
+            else:
+                log.debug("using cached proxmox client")
+            return cache[key]
+
+    @staticmethod
+    def _new_proxmox_client(proxmox_host,
+                            proxmox_user,
+                            proxmox_password=None,
+                            proxmox_token_name=None,
+                            proxmox_token_value=None,
+                            proxmox_verify_ssl=False,
+                            log=Logger.DEBUG):
         # TODO: verify later with ca cert
         if proxmox_token_name:
             log.debug("using proxmox_token_name")
-            return ProxmoxAPI(proxmox_host,
-                              user=proxmox_user,
-                              token_name=proxmox_token_name,
-                              token_value=proxmox_token_value,
-                              verify_ssl=proxmox_verify_ssl)
-        log.debug("using proxmox_password")
-        return ProxmoxAPI(
-            proxmox_host,
-            user=proxmox_user,
-            password=proxmox_password,
-            verify_ssl=False,
-        )
+            api = ProxmoxAPI(proxmox_host,
+                             user=proxmox_user,
+                             token_name=proxmox_token_name,
+                             token_value=proxmox_token_value,
+                             verify_ssl=proxmox_verify_ssl)
+        else:
+            log.debug("using proxmox_password")
+            api = ProxmoxAPI(
+                proxmox_host,
+                user=proxmox_user,
+                password=proxmox_password,
+                verify_ssl=False,
+            )
+        # NOTE: size the keep-alive pool for the concurrent callers (batch provisioning, inventory)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=config.HTTP_POOL_SIZE,
+            pool_maxsize=config.HTTP_POOL_SIZE)
+        session = api._store["session"]
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        trace.tracer.instrument_session(session)
+        metrics.instrument_session(session)
+        return api
+
+    def locate(self, vm_id, ttl=config.LOCATE_TTL):
+        """
+        The node of the vm as seen by inventory or clone in the last ttl seconds, proxmox_node otherwise.
+        """
+        vm_id = int(vm_id)
+        now = time.monotonic()
+        node, seen_at = self.vm_nodes.get(vm_id, (self.node, None))
+        if self.placement == "none" or (seen_at is not None
+                                        and now - seen_at < ttl):
+            return node
+        if now - self.unlocated.get(vm_id, now - ttl) < ttl:
+            return self.node
+        self.inventory()
+        node, seen_at = self.vm_nodes.get(vm_id, (self.node, None))
+        if seen_at is None or seen_at < now:
+            # NOTE: gone or not created yet
+            self.vm_nodes.pop(vm_id, None)
+            self.unlocated[vm_id] = now
+            return self.node
+        return node
 
     def vmctl(self, vm_id):
-        return VmController(self.api, self.node, vm_id, log=self.log)
+        return VmController(self.api, self.locate(vm_id), vm_id, log=self.log)
 
     def ctlplvmctl(self, vm_id):
         return ControlPlaneVmController(self.api,
-                                        self.node,
+                                        self.locate(vm_id),
                                         vm_id,
                                         log=self.log)
 
     def wkctl(self, vm_id):
-        return WorkerVmController(self.api, self.node, vm_id, log=self.log)
+        return WorkerVmController(self.api,
+                                  self.locate(vm_id),
+                                  vm_id,
+                                  log=self.log)
 
     def lbctl(self, vm_id):
-        return LbVmController(self.api, self.node, vm_id, log=self.log)
+        return LbVmController(self.api,
+                              self.locate(vm_id),
+                              vm_id,
+                              log=self.log,
+                              update_mode=self.lb_update_mode)
+
+    @trace.traced(vm_id_arg="control_plane_vm_id")
+    def join_command(self,
+                     control_plane_vm_id,
+                     is_control_plane=False,
+                     with_certificate_key=False):
+        """
+        Build the kubeadm join command from the cached credentials of the control plane.
+        """
+        join_cache = self.join_cache
+        ctlplvmctl = self.ctlplvmctl(control_plane_vm_id)
+        kubeadm = ctlplvmctl.kubeadm()
+        if not join_cache:
+            credentials = kubeadm.create_join_credentials(
+                with_certificate_key=with_certificate_key)
+        else:
+            credentials = join_cache.get(
+                self.join_cache_key(control_plane_vm_id),
+                lambda ttl, with_certificate_key: kubeadm.
+                create_join_credentials(
+                    ttl=ttl, with_certificate_key=with_certificate_key),
+                with_certificate_key=with_certificate_key)
+        return util.KubeUtil.build_join_command(
+            credentials, is_control_plane=is_control_plane)
+
+    def join_cache_key(self, control_plane_vm_id):
+        """
+        Proxmox host, control plane vm id and ip, so other clusters do not share credentials.
+        """
+        r = self.ctlplvmctl(control_plane_vm_id).current_config()
+        endpoint = util.ProxmoxUtil.extract_ip(r.get("ipconfig0", "ip=/"))
+        return JoinCache.key(self.proxmox_host, control_plane_vm_id, endpoint)
 
-    def clone(self, old_id, new_id):
+    def check_snippets_storage(self,
+                               node: str,
+                               storage: str,
+                               snippets_dir=config.SNIPPETS_DIR):
+        """
+        snippets_dir must be where storage keeps its snippets, a vm on another node only sees them on a shared storage.
+        """
+        log = self.log
+        try:
+            r = self.api.storage(storage).get()
+        except ResourceException as err:
+            raise SnippetStorageError(node, storage, err)
+        if "snippets" not in (r.get("content") or "").split(","):
+            raise SnippetStorageError(node, storage,
+                                      "no snippets content type")
+        if not r.get("path"):
+            raise SnippetStorageError(node, storage, "not a file storage")
+        storage_dir = os.path.join(r["path"], "snippets")
+        if os.path.realpath(snippets_dir) != os.path.realpath(storage_dir):
+            raise SnippetStorageError(
+                node, storage,
+                f"snippets_dir {snippets_dir} is not its {storage_dir}")
+        if node == socket.gethostname().split(".")[0]:
+            return
+        for x in self.api.cluster.resources.get(type="storage"):
+            if x.get("storage") == storage and x.get("node") == node:
+                log.debug(node, "snippets storage", storage, "shared",
+                          x.get("shared"))
+                if x.get("shared"):
+                    return
+        raise SnippetStorageError(node, storage)
+
+    def can_linked_clone(self, vm_id):
         api = self.api
-        node = self.node
+        node = self.locate(vm_id)
         log = self.log
-        r = api.nodes(node).qemu(old_id).clone.post(newid=new_id)
-        log.debug(node, "clone", old_id, new_id)
-        return r
+        r = api.nodes(node).qemu(vm_id).config.get()
+        if not r.get("template", 0):
+            log.debug(node, "can_linked_clone", vm_id, "not a template")
+            return False
+        r = api.nodes(node).qemu(vm_id).feature.get(feature="clone")
+        log.debug(node, "can_linked_clone", vm_id, r)
+        return bool(r.get("hasFeature", 0))
+
+    def _record_clone_timing(self, strategy: str):
+
+        def on_done(exitstatus, duration):
+            self.clone_timings.setdefault(strategy, []).append(duration)
+            self.log.info(self.node, "clone", strategy, exitstatus, "duration",
+                          duration)
+
+        return on_done
+
+    @trace.traced(vm_id_arg="new_id")
+    def clone(self,
+              old_id,
+              new_id,
+              strategy=config.CLONE_STRATEGY,
+              storage=None,
+              target=None):
+        """
+        strategy: "linked", "full" or "auto", auto falls back to a full clone.
+        """
+        api = self.api
+        node = self.locate(old_id)
+        log = self.log
+        if strategy not in ["linked", "full", "auto"]:
+            raise InvalidCloneStrategy(strategy)
+        extra = {}
+        if target and target != node:
+            extra["target"] = target
+        self.vm_nodes[int(new_id)] = (target or node, time.monotonic())
+        fallback = strategy == "auto"
+        if strategy == "auto":
+            linked = not storage and self.can_linked_clone(old_id)
+            strategy = "linked" if linked else "full"
+            log.debug(node, "clone", old_id, "auto", strategy)
+        if strategy == "linked":
+            try:
+                r = api.nodes(node).qemu(old_id).clone.post(newid=new_id,
+                                                            full=0,
+                                                            **extra)
+                log.debug(node, "clone", "linked", old_id, new_id, r)
+                taskctl = TaskController(api, r, log=log)
+                if fallback:
+                    # NOTE: proxmox removes the new vm when the clone task fails
+                    exitstatus, _ = taskctl.wait(check=False)
+                    if not TaskController.is_ok(exitstatus):
+                        raise TaskFailedError(r, exitstatus)
+                taskctl.on_done = self._record_clone_timing("linked")
+                return taskctl
+            except (ResourceException, TaskFailedError) as err:
+                if not fallback:
+                    raise
+                log.warn(node, "clone", "linked", old_id, new_id, err,
+                         "fallback to full clone")
+                metrics.retries.inc(op="clone")
+        params = {"newid": new_id, "full": 1, **extra}
+        if storage:
+            params["storage"] = storage
+        r = api.nodes(node).qemu(old_id).clone.post(**params)
+        log.debug(node, "clone", "full", old_id, new_id, r)
+        return TaskController(api,
+                              r,
+                              on_done=self._record_clone_timing("full"),
+                              log=log)
+
+    @trace.traced(vm_id_arg="new_vm_id")
+    def place(self,
+              template_id,
+              new_vm_id,
+              anti_affinity_tag=None,
+              storage=None):
+        """
+        Choose the node of new_vm_id, None when placement is "none".
+        """
+        log = self.log
+        if self.placement == "none":
+            return None
+        with self.placement_lock:
+            resources = ClusterController(self.api, log=log).resources()
+            vms = resources["vms"]
+            seen = set(int(x["vmid"]) for x in vms)
+            self.placed = [x for x in self.placed if x["vmid"] not in seen]
+            template = {}
+            for vm in vms:
+                if int(vm["vmid"]) == int(template_id):
+                    template = vm
+            scheduler = Scheduler(resources["nodes"],
+                                  resources["storages"],
+                                  [x for x in vms if not x.get("template")] +
+                                  self.placed,
+                                  strategy=self.placement)
+            request = {
+                "cpu": template.get("maxcpu", 0),
+                "memory": template.get("maxmem", 0),
+                "disk": template.get("maxdisk", 0),
+            }
+            nodes = None
+            reason = None
+            local = self.unshared_storages(template, resources["storages"])
+            if local:
+                # NOTE: proxmox clones to another node only from shared storage
+                nodes = [template["node"]]
+                reason = (f"template {template_id} disks on"
+                          f" {', '.join(sorted(local))} are not shared,"
+                          f" only {template['node']} can clone it")
+                log.debug("place", template_id, "not shared", local)
+            node = scheduler.place(**request,
+                                   storage=storage,
+                                   anti_affinity_tag=anti_affinity_tag,
+                                   nodes=nodes,
+                                   reason=reason)
+            self.placed.append({
+                "vmid": int(new_vm_id),
+                "node": node,
+                "maxcpu": request["cpu"],
+                "maxmem": request["memory"],
+                "tags": anti_affinity_tag,
+            })
+            log.debug("place", template_id, anti_affinity_tag, node)
+            return node
+
+    def unshared_storages(self, template: dict, storages: List[dict]):
+        """
+        The storages of the template disks that are not shared, from its /cluster/resources item.
+        """
+        api = self.api
+        if not template.get("node"):
+            return set()
+        r = api.nodes(template["node"]).qemu(template["vmid"]).config.get()
+        shared = set(x["storage"] for x in storages if x.get("shared"))
+        return util.ProxmoxUtil.disk_storages(r) - shared
+
+    def taskctl(self, upid: str):
+        return TaskController(self.api, upid, log=self.log)
 
     def list_vm(self):
         api = self.api
@@ -70,60 +413,184 @@ class NodeController:
         log.debug(node, "list_vm", len(vm_list), vm_list)
         return vm_list
 
-    def find_vm(self, vm_id: int):
+    @trace.traced()
+    def inventory(self, max_workers=config.INVENTORY_MAX_WORKERS):
         api = self.api
         node = self.node
         log = self.log
-        r = api.nodes(node).qemu.get()
-        vm_list = r
-        for x in vm_list:
-            id = x["vmid"]
-            if str(id) == str(vm_id):
-                log.debug("vm", x)
-                return x
+        seen_at = time.monotonic()
+        r = api.cluster.resources.get(type="vm")
+        vms = [x for x in r if x.get("type", "qemu") == "qemu"]
+        for vm in vms:
+            self.vm_nodes[int(vm["vmid"])] = (vm.get("node", node), seen_at)
+        log.debug(node, "inventory", len(vms))
+        metrics.cluster_vms.set(len(vms))
+        return Inventory(api,
+                         node,
+                         vms,
+                         max_workers=max_workers,
+                         log=log,
+                         cluster_wide=self.placement != "none")
 
-        raise VmNotFoundError(vm_id)
+    def find_vm(self, vm_id: int, inventory: Inventory = None):
+        inventory = inventory or self.inventory()
+        return inventory.find(vm_id)
 
     def describe_network(self, network: str):
+        """
+        The bridge on proxmox_node, with placement on the first node that has an address on it.
+        """
         api = self.api
-        node = self.node
         log = self.log
-        r = api.nodes(node).network(network).get()
-        log.debug(node, "describe_network", r)
-        return r
+        nodes = [self.node]
+        if self.placement != "none":
+            resources = ClusterController(api, log=log).resources()
+            nodes.extend(x["node"] for x in resources["nodes"]
+                         if x["node"] != self.node)
+        described = None
+        error = None
+        for node in nodes:
+            try:
+                r = api.nodes(node).network(network).get()
+            except ResourceException as err:
+                log.debug(node, "describe_network", network, err)
+                error = error or err
+                continue
+            log.debug(node, "describe_network", r)
+            if r.get("cidr"):
+                return r
+            described = described or r
+        if described:
+            return described
+        raise error
+
+    def vm_network(self, vm_network_name: str, preserved_ips=[]):
+        """
+        Return (IpPool without preserved ips, gateway ip, preserved_ips + gateway ip) of a vm bridge.
+        """
+        log = self.log
+        r = self.describe_network(vm_network_name)
+        network_interface = ipaddress.IPv4Interface(r["cidr"])
+        network_gw_ip = str(network_interface.ip) or r["address"]
+        preserved_ips = list(preserved_ips) + [network_gw_ip]
+        log.debug("preserved_ips", preserved_ips)
+        ip_pool = IpPool(network_interface.network, preserved_ips)
+        return ip_pool, network_gw_ip, preserved_ips
+
+    def new_vm_id(self,
+                  id_range=[0, 9999],
+                  preserved_ids=[],
+                  inventory: Inventory = None):
+        return self.new_vm_ids(1, id_range, preserved_ids, inventory)[0]
 
-    def new_vm_id(self, id_range=[0, 9999], preserved_ids=[]):
+    def new_vm_ids(self,
+                   count: int,
+                   id_range=[0, 9999],
+                   preserved_ids=[],
+                   inventory: Inventory = None,
+                   reserve=True):
+        """
+        With reserve=False the ids are not leased, only the leased ones are skipped.
+        """
         log = self.log
+        inventory = inventory or self.inventory()
         exist_ids = set()
         exist_ids.update(preserved_ids)
-        vm_list = self.list_vm()
-        for vm in vm_list:
-            id = vm["vmid"]
-            exist_ids.add(id)
+        exist_ids.update(inventory.ids())
         log.debug("exist_ids", exist_ids)
-        new_id = util.find_missing_number(id_range[0], id_range[1], exist_ids)
-        if not new_id:
-            log.error("Can't find new vm id")
-            raise CanNotGetNewVmId()
-        log.debug("new_id", new_id)
-        return new_id
-
-    def new_vm_ip(self, ip_pool=[], preserved_ips=[]):
+        leases = self.leases
+        if leases and not reserve:
+            exist_ids.update(int(x) for x in leases.leased("vm_id"))
+        elif leases:
+            leases.reconcile("vm_id")
+            size = id_range[1] - id_range[0] + 1
+            new_ids = leases.acquire("vm_id", size, lambda i: id_range[0] + i,
+                                     exist_ids, count)
+            if len(new_ids) < count:
+                leases.release("vm_id", new_ids)
+                log.error("Can't find new vm id")
+                raise CanNotGetNewVmId()
+            log.debug("new_ids", new_ids)
+            return new_ids
+        new_ids = []
+        for _ in range(count):
+            new_id = util.find_missing_number(id_range[0], id_range[1],
+                                              exist_ids)
+            if not new_id:
+                log.error("Can't find new vm id")
+                raise CanNotGetNewVmId()
+            exist_ids.add(new_id)
+            new_ids.append(new_id)
+        log.debug("new_ids", new_ids)
+        return new_ids
+
+    def claim_leases(self, vm_ids=[], vm_ips=[]):
+        """
+        Lease the given vm ids and ips, raise LeaseTakenError if another run has one of them.
+        """
+        leases = self.leases
+        if not leases:
+            return
+        taken = leases.claim("vm_id", vm_ids)
+        if taken:
+            raise LeaseTakenError("vm_id", taken)
+        taken = leases.claim("vm_ip", vm_ips)
+        if taken:
+            leases.release("vm_id", vm_ids)
+            raise LeaseTakenError("vm_ip", taken)
+
+    def release_leases(self, vm_ids=[], vm_ips=[]):
+        leases = self.leases
+        if not leases:
+            return
+        leases.release("vm_id", vm_ids)
+        leases.release("vm_ip", vm_ips)
+
+    def new_vm_ip(self,
+                  ip_pool: IpPool,
+                  preserved_ips=[],
+                  inventory: Inventory = None):
+        return self.new_vm_ips(1, ip_pool, preserved_ips, inventory)[0]
+
+    def new_vm_ips(self,
+                   count: int,
+                   ip_pool: IpPool,
+                   preserved_ips=[],
+                   inventory: Inventory = None,
+                   reserve=True):
         log = self.log
-        exist_ips = set()
-        exist_ips.update(preserved_ips)
-        vm_list = self.list_vm()
-        for vm in vm_list:
-            id = vm["vmid"]
-            config = self.vmctl(id).current_config()
-            ifconfig0 = config.get("ipconfig0", None)
-            if not ifconfig0: continue
-            ip = util.ProxmoxUtil.extract_ip(ifconfig0)
-            if ip: exist_ips.add(ip)
+        inventory = inventory or self.inventory()
+        exist_ips = inventory.ips().values()
+        for ip in preserved_ips:
+            ip_pool.reserve_range(ip)
+        for ip in exist_ips:
+            ip_pool.reserve(ip)
         log.debug("exist_vm_ips", exist_ips)
-        new_ip = util.find_missing(ip_pool, exist_ips)
-        if not new_ip:
-            log.error("Can't find new ip")
-            raise CanNotGetNewVmIp()
-        log.debug("new_ip", new_ip)
-        return new_ip
+        leases = self.leases
+        if leases and not reserve:
+            for ip in leases.leased("vm_ip"):
+                ip_pool.reserve(ip)
+        elif leases:
+            leases.reconcile("vm_ip")
+            new_ips = leases.acquire("vm_ip",
+                                     len(ip_pool),
+                                     lambda i: ip_pool.at(i)
+                                     if ip_pool.is_free_at(i) else None,
+                                     count=count)
+            for ip in new_ips:
+                ip_pool.reserve(ip)
+            if len(new_ips) < count:
+                leases.release("vm_ip", new_ips)
+                log.error("Can't find new ip")
+                raise CanNotGetNewVmIp()
+            log.debug("new_ips", new_ips)
+            return new_ips
+        new_ips = []
+        for _ in range(count):
+            new_ip = ip_pool.allocate()
+            if not new_ip:
+                log.error("Can't find new ip")
+                raise CanNotGetNewVmIp()
+            new_ips.append(new_ip)
+        log.debug("new_ips", new_ips)
+        return new_ips
@@ -0,0 +1,76 @@
+import time
+
+from proxmoxer import ProxmoxAPI
+from app.logger import Logger
+from app.error import *
+from app.poll import poll
+from app import config
+from app import metrics
+from app import trace
+
+
+class TaskController:
+    """
+    Handle to an asynchronous proxmox task, e.g. the UPID returned by clone, start, shutdown or delete.
+    """
+
+    def __init__(self,
+                 api: ProxmoxAPI,
+                 upid: str,
+                 on_done=None,
+                 log=Logger.DEBUG) -> None:
+        self.api = api
+        self.upid = upid
+        # UPID:{node}:{pid}:{pstart}:{starttime}:{type}:{id}:{user}:
+        self.node = upid.split(":")[1]
+        self.log = log
+        self.on_done = on_done
+        self.started_at = time.monotonic()
+
+    def __str__(self) -> str:
+        return self.upid
+
+    def status(self):
+        api = self.api
+        node = self.node
+        upid = self.upid
+        log = self.log
+        r = api.nodes(node).tasks(upid).status.get()
+        log.debug(node, "task", upid, r.get("status"), r.get("exitstatus"))
+        return r
+
+    @trace.traced("task_wait")
+    def wait(self, timeout=config.TIMEOUT, interval_check=None, check=True):
+        """
+        Return (exitstatus, duration in seconds), raise TaskFailedError if check.
+        """
+        node = self.node
+        upid = self.upid
+        log = self.log
+
+        def is_stopped():
+            r = self.status()
+            if r.get("status") != "stopped":
+                return None
+            return r
+
+        try:
+            r = poll(is_stopped, timeout=timeout, max_interval=interval_check)
+        except TimeoutError:
+            log.debug(node, "task", upid, "timeout")
+            metrics.timeouts.inc(op="task_wait")
+            raise
+        exitstatus = r.get("exitstatus", None)
+        duration = round(time.monotonic() - self.started_at, 3)
+        log.debug(node, "task", upid, "exitstatus", exitstatus, "duration",
+                  duration)
+        if self.on_done:
+            self.on_done(exitstatus, duration)
+        if check and not TaskController.is_ok(exitstatus):
+            raise TaskFailedError(upid, exitstatus)
+        return exitstatus, duration
+
+    @staticmethod
+    def is_ok(exitstatus: str):
+        if not exitstatus: return False
+        return exitstatus == "OK" or exitstatus.startswith("WARNINGS")
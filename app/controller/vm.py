@@ -1,10 +1,23 @@
+import json
 import time
+import uuid
+import shlex
+import codecs
+import base64
+import hashlib
+import binascii
 
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 from proxmoxer import ProxmoxAPI
 from app.logger import Logger
+from app.controller.task import TaskController
 from app.error import *
+from app.poll import poll
 from app import config
+from app import metrics
+from app import trace
+from app import util
 
 
 class VmController:
@@ -19,81 +32,227 @@ class VmController:
         self.vm_id = vm_id
         self.log = log
 
-    def exec(self, cmd: List[str], timeout=config.TIMEOUT, interval_check=10):
+    def exec_start(self, cmd: List[str]):
+        """
+        Start cmd in the guest and return its pid, see exec_status.
+        """
         api = self.api
         node = self.node
         vm_id = self.vm_id
         log = self.log
-        duration = 0
         r = api.nodes(node).qemu(vm_id).agent.exec.post(command=cmd)
         log.debug(node, vm_id, "exec", cmd, r)
-        pid = r["pid"]
-        exited = 0
-        stdout: str = None
-        stderr: str = None
-        exitcode: int = None
-        while True:
-            log.debug(node, vm_id, "exec", pid, "wait", duration)
-            time.sleep(interval_check)
-            duration += interval_check
-            if duration > timeout:
-                log.debug(node, vm_id, "exec", pid, "timeout")
-                raise TimeoutError()
-            status = api.nodes(node).qemu(vm_id).agent("exec-status").get(
-                pid=pid)
-            exited = status["exited"]
-            stdout = status.get("out-data", None)
-            stderr = status.get("err-data", None)
-            exitcode = status.get("exitcode", None)
-            if exited: break
+        return r["pid"]
+
+    def exec_status(self, pid):
+        """
+        The exec-status of pid once it exited, None while it is running.
+        """
+        api = self.api
+        node = self.node
+        vm_id = self.vm_id
+        metrics.exec_polls.inc()
+        status = api.nodes(node).qemu(vm_id).agent("exec-status").get(pid=pid)
+        if not status["exited"]:
+            return None
+        return status
+
+    @trace.traced()
+    def exec(self,
+             cmd: List[str],
+             timeout=config.TIMEOUT,
+             interval_check=None):
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        started_at = time.monotonic()
+        pid = self.exec_start(cmd)
+
+        def check():
+            status = self.exec_status(pid)
+            if not status:
+                log.debug(node, vm_id, "exec", pid, "wait",
+                          round(time.monotonic() - started_at, 1))
+            return status
+
+        try:
+            status = poll(check, timeout=timeout, max_interval=interval_check)
+        except TimeoutError:
+            log.debug(node, vm_id, "exec", pid, "timeout")
+            metrics.timeouts.inc(op="exec")
+            raise
+        return self.exec_result(pid, status, started_at)
+
+    def exec_result(self, pid, status: dict, started_at: float):
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        stdout: str = status.get("out-data", None)
+        stderr: str = status.get("err-data", None)
+        exitcode: int = status.get("exitcode", None)
+        duration = round(time.monotonic() - started_at, 1)
         log.debug(node, vm_id, "exec", pid, "duration", duration)
         log.debug(node, vm_id, "exec", pid, "exitcode", exitcode)
+        # NOTE: no concatenation here, the output is only formatted when debug is on
         if stdout:
-            log.debug(node, vm_id, "exec", pid, "stdout\n" + str(stdout))
+            log.debug(node, vm_id, "exec", pid, "stdout\n", stdout)
         if stderr:
-            log.debug(node, vm_id, "exec", pid, "stderr\n" + str(stderr))
+            log.debug(node, vm_id, "exec", pid, "stderr\n", stderr)
         return exitcode, stdout, stderr
 
-    def wait_for_guest_agent(self, timeout=config.TIMEOUT, interval_check=15):
+    @staticmethod
+    def exec_stream_paths():
+        """
+        The guest files of the output of one exec_stream.
+        """
+        prefix = f"/tmp/kp-exec-{uuid.uuid4().hex[:12]}"
+        return [prefix + ".out", prefix + ".err"]
+
+    @staticmethod
+    def exec_stream_cmd(cmd: List[str], paths: List[str]):
+        return [
+            "sh", "-c", f"exec \"$@\" >{paths[0]} 2>{paths[1]}", "sh", *cmd
+        ]
+
+    @staticmethod
+    def exec_stream_read_cmd(streams: List, paths: List[str], chunk_size: int):
+        """
+        Print the next chunk of every file base64 encoded, one line each.
+        """
+        script = "; ".join(f"tail -c +{x.offset + 1} {path} 2>/dev/null"
+                           f" | head -c {chunk_size} | base64 -w0; echo"
+                           for x, path in zip(streams, paths))
+        return ["sh", "-c", script]
+
+    def exec_stream_feed(self, pid, streams: List, status: dict,
+                         chunk_size: int):
+        """
+        Feed the output of an exec_stream_read_cmd, return True when a read was full, there may be more to read.
+        """
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        out = status.get("out-data", None)
+        more = False
+        for x, line in zip(streams, (out or "").split("\n")):
+            data = base64.b64decode(line.strip())
+            if data:
+                log.debug(node, vm_id, "exec", pid, "read", x.offset,
+                          len(data))
+            x.feed(data)
+            more = more or len(data) >= chunk_size
+        return more
+
+    @trace.traced()
+    def exec_stream(self,
+                    cmd: List[str],
+                    stdout=None,
+                    stderr=None,
+                    tail_size=config.EXEC_TAIL_SIZE,
+                    timeout=config.TIMEOUT,
+                    interval_check=None,
+                    chunk_size=config.TRANSFER_READ_CHUNK_SIZE):
+        """
+        Like exec, the output is read from files in the guest while cmd runs.
+        """
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        paths = VmController.exec_stream_paths()
+        streams = [
+            OutputStream(stdout, tail_size=tail_size),
+            OutputStream(stderr, tail_size=tail_size)
+        ]
+        pid = self.exec_start(VmController.exec_stream_cmd(cmd, paths))
+
+        def read_new():
+            # NOTE: not through exec, which would log every base64 chunk
+            read_pid = self.exec_start(
+                VmController.exec_stream_read_cmd(streams, paths, chunk_size))
+            status = poll(lambda: self.exec_status(read_pid),
+                          timeout=timeout,
+                          max_interval=1)
+            return self.exec_stream_feed(pid, streams, status, chunk_size)
+
+        def check():
+            status = self.exec_status(pid)
+            read_new()
+            return status
+
+        try:
+            try:
+                status = poll(check,
+                              timeout=timeout,
+                              max_interval=interval_check)
+            except TimeoutError:
+                log.debug(node, vm_id, "exec", pid, "timeout")
+                metrics.timeouts.inc(op="exec_stream")
+                raise
+            while read_new():
+                pass
+        finally:
+            for x in streams:
+                x.close()
+            # NOTE: a failed cleanup must not hide the error of cmd
+            try:
+                self.exec(["rm", "-f", *paths], interval_check=1)
+            except Exception as err:
+                log.error(node, vm_id, "exec", pid, "rm", paths, err)
+        exitcode: int = status.get("exitcode", None)
+        log.debug(node, vm_id, "exec", pid, "exitcode", exitcode)
+        return exitcode, streams[0].tail, streams[1].tail
+
+    @trace.traced()
+    def wait_for_guest_agent(self,
+                             timeout=config.TIMEOUT,
+                             interval_check=None):
         api = self.api
         node = self.node
         vm_id = self.vm_id
         log = self.log
-        duration = 0
-        while True:
-            time.sleep(interval_check)
-            duration += interval_check
-            if duration > timeout:
-                log.debug(node, vm_id, "wait_for_guest_agent", "timeout")
-                raise TimeoutError()
+        started_at = time.monotonic()
+
+        def check():
             try:
                 api.nodes(node).qemu(vm_id).agent.ping.post()
-                break
+                return True
             except Exception as err:
-                log.debug(node, vm_id, "wait_for_guest_agent", duration)
+                log.debug(node, vm_id, "wait_for_guest_agent",
+                          round(time.monotonic() - started_at, 1))
+                return False
+
+        try:
+            poll(check, timeout=timeout, max_interval=interval_check)
+        except TimeoutError:
+            log.debug(node, vm_id, "wait_for_guest_agent", "timeout")
+            metrics.timeouts.inc(op="wait_for_guest_agent")
+            raise
         log.debug(node, vm_id, "wait_for_guest_agent", "READY")
 
-    def wait_for_shutdown(self, timeout=config.TIMEOUT, interval_check=15):
+    @trace.traced()
+    def wait_for_shutdown(self, timeout=config.TIMEOUT, interval_check=None):
         api = self.api
         node = self.node
         vm_id = self.vm_id
         log = self.log
-        status = None
-        duration = 0
-        while True:
-            log.debug(node, vm_id, "wait_for_shutdown", duration)
-            time.sleep(interval_check)
-            duration += interval_check
-            if duration > timeout:
-                log.debug(node, vm_id, "wait_for_shutdown", "timeout")
-                raise TimeoutError()
+        started_at = time.monotonic()
+
+        def check():
+            log.debug(node, vm_id, "wait_for_shutdown",
+                      round(time.monotonic() - started_at, 1))
             try:
                 r = api.nodes(node).qemu(vm_id).status.current.get()
-                status = r["status"]
-                if status == "stopped":
-                    break
+                return r["status"] == "stopped"
             except Exception as err:
                 log.debug("shutdown", err)
+                return False
+
+        try:
+            poll(check, timeout=timeout, max_interval=interval_check)
+        except TimeoutError:
+            log.debug(node, vm_id, "wait_for_shutdown", "timeout")
+            metrics.timeouts.inc(op="wait_for_shutdown")
+            raise
 
     def update_config(self, **kwargs):
         api = self.api
@@ -138,16 +297,24 @@ class VmController:
         log = self.log
         r = api.nodes(node).qemu(vm_id).status.start.post()
         log.debug(node, vm_id, "startup", r)
-        return r
+        return TaskController(api, r, log=log)
 
-    def shutdown(self):
+    def shutdown(self, timeout=None, force_stop=False):
+        """
+        force_stop makes proxmox stop the vm when it is still running after timeout seconds.
+        """
         api = self.api
         node = self.node
         vm_id = self.vm_id
         log = self.log
-        r = api.nodes(node).qemu(vm_id).status.shutdown.post()
+        params = {}
+        if timeout:
+            params["timeout"] = int(timeout)
+        if force_stop:
+            params["forceStop"] = 1
+        r = api.nodes(node).qemu(vm_id).status.shutdown.post(**params)
         log.debug(node, vm_id, "shutdown", r)
-        return r
+        return TaskController(api, r, log=log)
 
     def reboot(self):
         api = self.api
@@ -156,15 +323,20 @@ class VmController:
         log = self.log
         r = api.nodes(node).qemu(vm_id).status.reboot.post()
         log.debug(node, vm_id, "reboot", r)
-        return r
+        return TaskController(api, r, log=log)
 
-    def write_file(self, filepath: str, content: str):
+    def write_file(self, filepath: str, content: str, encode=True):
+        """
+        encode=False when content is already base64, e.g. binary files.
+        """
         api = self.api
         node = self.node
         vm_id = self.vm_id
         log = self.log
-        r = api.nodes(node).qemu(vm_id).agent("file-write").post(
-            content=content, file=filepath)
+        params = dict(content=content, file=filepath)
+        if not encode:
+            params["encode"] = 0
+        r = api.nodes(node).qemu(vm_id).agent("file-write").post(**params)
         log.debug(node, vm_id, "write_file", filepath, r)
         return r
 
@@ -175,7 +347,7 @@ class VmController:
         log = self.log
         r = api.nodes(node).qemu(vm_id).delete()
         log.debug(node, vm_id, "delete", r)
-        return r
+        return TaskController(api, r, log=log)
 
     def read_file(self, filepath: str):
         api = self.api
@@ -186,25 +358,285 @@ class VmController:
         log.debug(node, vm_id, "read_file", r)
         return r
 
+    @trace.traced()
+    def pack_files(self, filepaths: List[str], timeout=config.TIMEOUT):
+        """
+        Return (payload, sha256 of the archive) of the files, tar, gzip and base64.
+        """
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        members = " ".join(shlex.quote(x.lstrip("/")) for x in filepaths)
+        script = (f"f=$(mktemp) && tar -C / -czf \"$f\" {members}"
+                  " && sha256sum \"$f\" | cut -d' ' -f1 && base64 -w0 \"$f\";"
+                  " code=$?; rm -f \"$f\"; exit $code")
+        exitcode, stdout, stderr = self.exec(["sh", "-c", script],
+                                             timeout=timeout)
+        if exitcode != 0:
+            raise FileTransferError(stderr)
+        sha256, _, payload = (stdout or "").strip().partition("\n")
+        payload = payload.strip()
+        try:
+            actual = hashlib.sha256(base64.b64decode(payload)).hexdigest()
+        except binascii.Error:
+            actual = None
+        if actual != sha256:
+            raise ChecksumMismatchError("pack_files", sha256, actual)
+        log.debug(node, vm_id, "pack_files", len(filepaths), len(payload))
+        return payload, sha256
+
+    @trace.traced()
+    def unpack_files(self, payload: str, sha256: str, timeout=config.TIMEOUT):
+        """
+        Write a pack_files payload (with one file-write if it fits), verify and unpack it with one exec.
+        """
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        archive = f"/tmp/kp-{sha256[:16]}.tgz"
+        if len(payload) > config.FILE_WRITE_MAX_SIZE:
+            self.upload_file(archive, base64.b64decode(payload))
+        else:
+            self.write_file(archive, payload, encode=False)
+        script = (f"echo '{sha256}  {archive}' | sha256sum -c -"
+                  f" && tar -C / -xzpf {archive}; code=$?; rm -f {archive};"
+                  " exit $code")
+        exitcode, stdout, stderr = self.exec(["sh", "-c", script],
+                                             timeout=timeout)
+        if exitcode != 0:
+            if "FAILED" in (stdout or ""):
+                raise ChecksumMismatchError(archive, sha256, stdout.strip())
+            raise FileTransferError(stderr)
+        log.debug(node, vm_id, "unpack_files", archive)
+
+    @trace.traced()
+    def upload_file(self,
+                    filepath: str,
+                    content,
+                    chunk_size=config.TRANSFER_CHUNK_SIZE,
+                    concurrency=config.TRANSFER_CONCURRENCY,
+                    retries=config.TRANSFER_RETRIES,
+                    resume=True):
+        """
+        Write content in checked base64 parts, resend the missing or corrupt ones.
+        """
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        data = content.encode() if isinstance(content, str) else content
+        sha256 = hashlib.sha256(data).hexdigest()
+        chunks = [
+            data[i:i + chunk_size] for i in range(0, len(data), chunk_size)
+        ] or [b""]
+        prefix = f"{filepath}.kp-{sha256[:12]}"
+        parts = [(f"{prefix}.{i}", hashlib.sha256(x).hexdigest())
+                 for i, x in enumerate(chunks)]
+
+        def send(i):
+            self.write_file(parts[i][0],
+                            base64.b64encode(chunks[i]).decode(),
+                            encode=False)
+
+        pending = set(range(len(chunks)))
+        if resume and len(chunks) > 1:
+            pending = self._assemble_parts(filepath, sha256, prefix, parts)
+        attempt = 0
+        while pending:
+            if attempt > retries:
+                raise FileTransferError(
+                    f"{filepath} {len(pending)} parts failed after {retries} retries"
+                )
+            log.debug(node, vm_id, "upload_file", filepath, "send",
+                      len(pending), "of", len(chunks))
+            if attempt:
+                metrics.retries.inc(len(pending), op="upload_file")
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+                futures = [(i, pool.submit(send, i)) for i in sorted(pending)]
+                for i, future in futures:
+                    try:
+                        future.result()
+                    except Exception as err:
+                        log.error(node, vm_id, "upload_file", parts[i][0], err)
+            pending = self._assemble_parts(filepath, sha256, prefix, parts)
+            attempt += 1
+        log.debug(node, vm_id, "upload_file", filepath, len(data), sha256)
+        return sha256
+
+    def _assemble_parts(self, filepath: str, sha256: str, prefix: str,
+                        parts: List[tuple]):
+        """
+        Return the indexes of the parts that are missing or corrupt, an empty set once filepath is in place.
+        """
+        manifest = " ".join(shlex.quote(f"{h}  {p}") for p, h in parts)
+        names = " ".join(shlex.quote(p) for p, _ in parts)
+        tmp = shlex.quote(f"{prefix}.tmp")
+        script = (
+            f"printf '%s\\n' {manifest} | sha256sum -c --quiet - 2>&1 || exit 3;"
+            f" cat {names} > {tmp}"
+            f" && echo {shlex.quote(f'{sha256}  {prefix}.tmp')} | sha256sum -c --quiet -"
+            f" && mv {tmp} {shlex.quote(filepath)} && rm -f {names}"
+            f" || {{ rm -f {tmp}; exit 4; }}")
+        exitcode, stdout, stderr = self.exec(["sh", "-c", script])
+        if exitcode == 0:
+            return set()
+        if exitcode != 3:
+            raise ChecksumMismatchError(filepath, sha256, stderr or stdout)
+        index = {p: i for i, (p, _) in enumerate(parts)}
+        bad = set()
+        for line in (stdout or "").splitlines():
+            for token in line.split(": "):
+                if token in index:
+                    bad.add(index[token])
+        return bad or set(range(len(parts)))
+
+    @trace.traced()
+    def download_file(self,
+                      filepath: str,
+                      chunk_size=config.TRANSFER_READ_CHUNK_SIZE,
+                      concurrency=config.TRANSFER_CONCURRENCY,
+                      retries=config.TRANSFER_RETRIES):
+        """
+        Read filepath in checked chunks, without the file-read truncation.
+        """
+        node = self.node
+        vm_id = self.vm_id
+        log = self.log
+        q = shlex.quote(filepath)
+        exitcode, stdout, stderr = self.exec(
+            ["sh", "-c", f"stat -c %s {q} && sha256sum {q} | cut -d' ' -f1"])
+        if exitcode != 0:
+            raise FileTransferError(stderr)
+        size, sha256 = stdout.split()
+        count = max(1, -(-int(size) // chunk_size))
+
+        def fetch(i):
+            script = (
+                f"t=$(mktemp) && dd if={q} of=\"$t\" bs={chunk_size} skip={i}"
+                " count=1 status=none && sha256sum \"$t\" | cut -d' ' -f1"
+                " && base64 -w0 \"$t\"; code=$?; rm -f \"$t\"; exit $code")
+            for attempt in range(retries + 1):
+                exitcode, stdout, stderr = self.exec(["sh", "-c", script])
+                if exitcode == 0:
+                    h, _, payload = (stdout or "").strip().partition("\n")
+                    try:
+                        chunk = base64.b64decode(payload.strip())
+                    except binascii.Error:
+                        chunk = None
+                    if chunk is not None and hashlib.sha256(
+                            chunk).hexdigest() == h:
+                        return chunk
+                log.error(node, vm_id, "download_file", filepath, i, "attempt",
+                          attempt, stderr)
+                metrics.retries.inc(op="download_file")
+            raise FileTransferError(
+                f"{filepath} chunk {i} failed after {retries} retries")
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            data = b"".join(pool.map(fetch, range(count)))
+        actual = hashlib.sha256(data).hexdigest()
+        if actual != sha256:
+            raise ChecksumMismatchError(filepath, sha256, actual)
+        log.debug(node, vm_id, "download_file", filepath, len(data))
+        return data
+
+
+class OutputStream:
+    """
+    Decoded output of exec_stream, passed on to sink with only the last tail_size characters kept.
+    """
+
+    def __init__(self, sink=None, tail_size=config.EXEC_TAIL_SIZE) -> None:
+        self.tail_size = tail_size
+        self.tail = ""
+        # NOTE: bytes read so far, a chunk may end inside an utf-8 character
+        self.offset = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.file = None
+        self.write = sink
+        if isinstance(sink, str):
+            self.file = open(sink, "w", encoding="utf-8")
+            self.write = self.file.write
+        elif hasattr(sink, "write"):
+            self.write = sink.write
+
+    def feed(self, data: bytes, final=False):
+        self.offset += len(data)
+        text = self.decoder.decode(data, final)
+        if not text:
+            return
+        if self.write:
+            self.write(text)
+        # NOTE: [-0:] would keep everything
+        if self.tail_size > 0:
+            self.tail = (self.tail + text)[-self.tail_size:]
+
+    def close(self):
+        self.feed(b"", final=True)
+        if self.file:
+            self.file.close()
+
 
 class _KubeadmExecutor():
 
     def __init__(self, vmctl: VmController) -> None:
         self.vmctl = vmctl
 
-    def reset(self, cmd=["kubeadm", "reset", "-f"]):
-        vmctl = self.vmctl
-        return vmctl.exec(cmd)
-
-    def init(self, control_plane_endpoint, pod_cidr, timeout=10 * 60):
-        vmctl = self.vmctl
-        cmd = [
+    @staticmethod
+    def init_cmd(control_plane_endpoint, pod_cidr):
+        return [
             "kubeadm",
             "init",
             f"--control-plane-endpoint={control_plane_endpoint}"
             f"--pod-network-cidr={pod_cidr}",
         ]
-        return vmctl.exec(cmd, timeout=timeout)
+
+    @staticmethod
+    def token_create_cmd(ttl):
+        return [
+            "kubeadm", "token", "create", f"--ttl={int(ttl)}s",
+            "--print-join-command"
+        ]
+
+    @staticmethod
+    def upload_certs_cmd():
+        return ["kubeadm", "init", "phase", "upload-certs", "--upload-certs"]
+
+    @staticmethod
+    def parse_join_credentials(exitcode, stdout, stderr, now, ttl):
+        if exitcode != 0:
+            raise FailedToCreateJoinCmd(stderr)
+        credentials = util.KubeUtil.parse_join_command(stdout.strip())
+        credentials["expires_at"] = now + ttl
+        credentials["certificate_key"] = None
+        credentials["certificate_key_expires_at"] = None
+        return credentials
+
+    @staticmethod
+    def parse_certificate_key(credentials, exitcode, stdout, stderr, now):
+        if exitcode != 0:
+            raise FailedToCreateJoinCmd(stderr)
+        # NOTE: the key is the last line of the output
+        credentials["certificate_key"] = stdout.strip().split()[-1]
+        credentials[
+            "certificate_key_expires_at"] = now + config.JOIN_CERTIFICATE_KEY_TTL
+        return credentials
+
+    def reset(self, cmd=["kubeadm", "reset", "-f"]):
+        vmctl = self.vmctl
+        return vmctl.exec(cmd)
+
+    def init(self,
+             control_plane_endpoint,
+             pod_cidr,
+             timeout=10 * 60,
+             stdout=None,
+             stderr=None):
+        vmctl = self.vmctl
+        cmd = self.init_cmd(control_plane_endpoint, pod_cidr)
+        return vmctl.exec_stream(cmd,
+                                 stdout=stdout,
+                                 stderr=stderr,
+                                 timeout=timeout)
 
     def create_join_command(
             self,
@@ -225,6 +657,30 @@ class _KubeadmExecutor():
         log.debug("join_cmd", join_cmd)
         return join_cmd
 
+    def create_join_credentials(self,
+                                ttl=config.JOIN_TOKEN_TTL,
+                                with_certificate_key=False,
+                                timeout=config.TIMEOUT,
+                                interval_check=3):
+        """
+        Return {"endpoint", "token", "ca_cert_hash", "expires_at", "certificate_key", ...}
+        """
+        vmctl = self.vmctl
+        log = vmctl.log
+        now = time.time()
+        r = vmctl.exec(self.token_create_cmd(ttl),
+                       timeout=timeout,
+                       interval_check=interval_check)
+        credentials = self.parse_join_credentials(*r, now, ttl)
+        if with_certificate_key:
+            r = vmctl.exec(self.upload_certs_cmd(),
+                           timeout=timeout,
+                           interval_check=interval_check)
+            self.parse_certificate_key(credentials, *r, now)
+        log.debug("join_credentials", credentials["endpoint"],
+                  credentials["expires_at"])
+        return credentials
+
 
 class KubeVmController(VmController):
 
@@ -251,13 +707,19 @@ class ControlPlaneVmController(KubeVmController):
 
     def drain_node(self,
                    node_name: str,
-                   kubeconfig_filepath=config.KUBECONFIG):
+                   kubeconfig_filepath=config.KUBECONFIG,
+                   stdout=None,
+                   stderr=None):
         cmd = [
             "kubectl", f"--kubeconfig={kubeconfig_filepath}", "drain",
             "--ignore-daemonsets", node_name
         ]
         # 30 mins should be enough
-        return self.exec(cmd, interval_check=5, timeout=30 * 60)
+        return self.exec_stream(cmd,
+                                stdout=stdout,
+                                stderr=stderr,
+                                interval_check=5,
+                                timeout=30 * 60)
 
     def delete_node(self, node_name, kubeconfig_filepath=config.KUBECONFIG):
         cmd = [
@@ -266,6 +728,19 @@ class ControlPlaneVmController(KubeVmController):
         ]
         return self.exec(cmd, interval_check=5)
 
+    def get_pods_and_nodes(self, kubeconfig_filepath=config.KUBECONFIG):
+        """
+        One kubectl call for every pod and node, return the parsed List object.
+        """
+        cmd = [
+            "kubectl", f"--kubeconfig={kubeconfig_filepath}", "get",
+            "pods,nodes", "--all-namespaces", "-o", "json"
+        ]
+        exitcode, stdout, stderr = self.exec(cmd, interval_check=3)
+        if exitcode != 0:
+            raise KubectlFailedError(stderr)
+        return json.loads(stdout)
+
     def ensure_cert_dirs(self, dirs=["/etc/kubernetes/pki/etcd"]):
         for d in dirs:
             self.exec(["mkdir", "-p", d], interval_check=3)
@@ -298,8 +773,12 @@ class LbVmController(VmController):
                  api: ProxmoxAPI,
                  node: str,
                  vm_id: str,
-                 log=Logger.DEBUG) -> None:
+                 log=Logger.DEBUG,
+                 update_mode=config.LB_UPDATE_MODE) -> None:
         super().__init__(api, node, vm_id, log)
+        if update_mode not in ["reload", "runtime"]:
+            raise InvalidLbUpdateMode(update_mode)
+        self.update_mode = update_mode
 
     def add_backend(self, backend_name: str, server_name: str,
                     server_endpoint):
@@ -320,3 +799,25 @@ class LbVmController(VmController):
 
     def reload_haproxy(self):
         self.exec(["systemctl", "reload", "haproxy"], interval_check=3)
+
+    def apply_backends(self, ops: List[tuple], validate=True, reload=True):
+        """
+        Apply ("add" | "rm" | "drain", backend_name, server_name, ...) ops in one exec.
+        """
+        cmd = self.apply_backends_cmd(ops, validate=validate, reload=reload)
+        return self.exec(cmd, interval_check=3)
+
+    def apply_backends_cmd(self, ops: List[tuple], validate=True, reload=True):
+        cmd = [
+            "/usr/local/bin/config_haproxy.py", "-c",
+            "/etc/haproxy/haproxy.cfg", "apply"
+        ]
+        if validate:
+            cmd.append("--validate")
+        if reload:
+            cmd.append("--reload")
+        if self.update_mode == "runtime":
+            cmd.extend(["--runtime", "--socket", config.HAPROXY_ADMIN_SOCKET])
+        for op in ops:
+            cmd.extend(str(x) for x in op)
+        return cmd
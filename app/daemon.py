@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import stat
+import socket
+import struct
+import threading
+import traceback
+import socketserver
+
+from typing import List
+from app.controller.node import NodeController
+from app.config import load_config
+from app.logger import Logger
+from app.error import *
+from app import config
+from app import metrics
+
+# NOTE: what a command reads from the environment, CONFIG_PATH is read once at import time
+FORWARDED_ENV = [
+    "CONFIG_PATH", "LOGGER", "VMID", "KP_LEASE_DB", "KP_JOIN_CACHE"
+]
+
+
+class _ClientStream:
+    """
+    Output of one request, sent to its client or to fallback once the client is gone.
+    """
+
+    def __init__(self, send, key: str, fallback) -> None:
+        self.send = send
+        self.key = key
+        self.fallback = fallback
+
+    def write(self, data: str):
+        if not self.send({self.key: data}):
+            return self.fallback.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _peer_uid(sock: socket.socket):
+    # NOTE: linux only, elsewhere only the owner of the socket file is checked
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+def _check_owner(socket_path: str):
+    """
+    Return why socket_path must not be used, None if it is a socket of this user.
+    """
+    try:
+        st = os.lstat(socket_path)
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISSOCK(st.st_mode):
+        return "not a socket"
+    if st.st_uid != os.getuid():
+        return f"owned by uid {st.st_uid}"
+    return None
+
+
+def _private_dir(socket_path: str):
+    dirname = os.path.dirname(os.path.abspath(socket_path))
+    os.makedirs(dirname, mode=0o700, exist_ok=True)
+    st = os.stat(dirname)
+    # NOTE: in a directory others can write to, they could put their own socket there first
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise DaemonSocketError(socket_path,
+                                f"{dirname} is not private to this user")
+
+
+def _env_mismatch(request: dict):
+    """
+    Return why the command of the request must not run in the daemon, None if it can.
+    """
+    if request.get("cwd") != os.getcwd():
+        return "cwd"
+    env = request.get("env") or {}
+    for key in FORWARDED_ENV:
+        if env.get(key) != os.getenv(key):
+            return key
+    return None
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        uid = _peer_uid(self.request)
+        if uid is not None and uid != os.getuid():
+            self.server.log.error("daemon", "refuse", "uid", uid)
+            return
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        argv: List[str] = request.get("argv", [])
+        lock = threading.Lock()
+        closed = threading.Event()
+
+        def send(msg: dict):
+            with lock:
+                if closed.is_set():
+                    return False
+                try:
+                    self.wfile.write((json.dumps(msg) + "\n").encode())
+                    self.wfile.flush()
+                except OSError:
+                    closed.set()
+                    return False
+            return True
+
+        mismatch = _env_mismatch(request)
+        if mismatch:
+            self.server.log.debug("daemon", "refuse", argv, mismatch,
+                                  "differs")
+            send({"refused": mismatch})
+            return
+        stdout = _ClientStream(send, "stdout", sys.stdout)
+        stderr = _ClientStream(send, "stderr", sys.stderr)
+        exitcode = 0
+        try:
+            self.server.run_command(argv, stdout, stderr)
+        except SystemExit as err:
+            exitcode = err.code if isinstance(err.code, int) else 1
+        except Exception as err:
+            traceback.print_exc(file=stderr)
+            exitcode = 1
+        send({"exitcode": exitcode})
+        # NOTE: threads still running, e.g. a warm pool refill, write to the daemon output from now on
+        closed.set()
+
+
+def _run_command(argv: List[str], stdout, stderr):
+    # NOTE: import here, app.cmd.index imports this module for the client side
+    from app.cmd.index import MainCmd
+    MainCmd().run(argv, stdout=stdout, stderr=stderr)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    """
+    Serves kp commands over a unix socket with one pooled proxmox session.
+    """
+
+    def __init__(self,
+                 socket_path=config.DAEMON_SOCKET,
+                 log=Logger.DEBUG,
+                 metrics_port=0) -> None:
+        self.socket_path = socket_path
+        self.log = log
+        self.metrics_port = metrics_port
+
+    def keepalive(self, cfg: dict, interval=config.DAEMON_KEEPALIVE_INTERVAL):
+        log = self.log
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    api = NodeController.create_proxmox_client(**cfg, log=log)
+                    # proxmoxer renews the ticket on a request once it is older than an hour
+                    api.version.get()
+                except Exception as err:
+                    log.error("daemon", "keepalive", err)
+
+        threading.Thread(target=loop, name="kp-keepalive", daemon=True).start()
+        return stop
+
+    def serve(self):
+        log = self.log
+        socket_path = self.socket_path
+        NodeController.client_cache = {}
+        cfg = load_config(log=log)
+        api = NodeController.create_proxmox_client(**cfg, log=log)
+        log.debug("daemon", "proxmox", api.version.get())
+        stop_keepalive = self.keepalive(cfg)
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = metrics.registry.serve(self.metrics_port)
+            log.info("daemon", "metrics", self.metrics_port)
+
+        server = self.listen()
+        log.info("daemon", "listening", socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            stop_keepalive.set()
+            if metrics_server:
+                metrics_server.shutdown()
+            server.server_close()
+            os.remove(socket_path)
+
+    def listen(self, run_command=_run_command):
+        """
+        Bind the socket, raise DaemonRunningError if another daemon answers on it.
+        """
+        log = self.log
+        socket_path = self.socket_path
+        _private_dir(socket_path)
+        reason = _check_owner(socket_path)
+        if reason:
+            raise DaemonSocketError(socket_path, reason)
+        if os.path.exists(socket_path):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                client.connect(socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                log.debug("daemon", "remove stale socket", socket_path)
+                if os.path.exists(socket_path):
+                    os.remove(socket_path)
+            else:
+                raise DaemonRunningError(socket_path)
+            finally:
+                client.close()
+        server = _Server(socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o600)
+        server.log = log
+        server.run_command = run_command
+        return server
+
+
+def forward(argv: List[str],
+            socket_path=config.DAEMON_SOCKET,
+            stdout=None,
+            stderr=None):
+    """
+    Return the exit code, None if there is no daemon or it refused the command.
+    """
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    if not os.path.exists(socket_path):
+        return None
+    reason = _check_owner(socket_path)
+    if reason:
+        stderr.write(f"kp: not using daemon socket {socket_path}, {reason}\n")
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        client.close()
+        return None
+    uid = _peer_uid(client)
+    if uid is not None and uid != os.getuid():
+        client.close()
+        stderr.write(
+            f"kp: not using daemon socket {socket_path}, served by uid {uid}\n"
+        )
+        return None
+    request = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": {
+            x: os.getenv(x)
+            for x in FORWARDED_ENV
+        },
+    }
+    with client, client.makefile("rwb") as f:
+        f.write((json.dumps(request) + "\n").encode())
+        f.flush()
+        for line in f:
+            msg = json.loads(line)
+            if "refused" in msg:
+                return None
+            if "stdout" in msg:
+                stdout.write(msg["stdout"])
+                stdout.flush()
+            if "stderr" in msg:
+                stderr.write(msg["stderr"])
+                stderr.flush()
+            if "exitcode" in msg:
+                return msg["exitcode"]
+    return 1
@@ -20,3 +20,119 @@ class FailedToCreateJoinCmd(Exception):
 
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
+
+
+class TaskFailedError(Exception):
+
+    def __init__(self, upid: str, exitstatus: str) -> None:
+        super().__init__(f"task {upid} failed: {exitstatus}")
+        self.upid = upid
+        self.exitstatus = exitstatus
+
+
+class InvalidCloneStrategy(Exception):
+
+    def __init__(self, strategy: str) -> None:
+        super().__init__(f"invalid clone strategy {strategy}")
+
+
+class InvalidJoinMode(Exception):
+
+    def __init__(self, join_mode: str) -> None:
+        super().__init__(f"invalid join mode {join_mode}")
+
+
+class DependencyFailedError(Exception):
+
+    def __init__(self, name: str) -> None:
+        super().__init__(f"skipped, dependency {name} failed")
+
+
+class KubectlFailedError(Exception):
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class ChecksumMismatchError(Exception):
+
+    def __init__(self, filepath: str, expected: str, actual: str) -> None:
+        super().__init__(
+            f"checksum mismatch {filepath} expected {expected} got {actual}")
+        self.filepath = filepath
+        self.expected = expected
+        self.actual = actual
+
+
+class FileTransferError(Exception):
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class InvalidPlacementStrategy(Exception):
+
+    def __init__(self, strategy: str) -> None:
+        super().__init__(f"invalid placement strategy {strategy}")
+
+
+class InvalidLbUpdateMode(Exception):
+
+    def __init__(self, update_mode: str) -> None:
+        super().__init__(f"invalid lb update mode {update_mode}")
+
+
+class NoNodeAvailableError(Exception):
+
+    def __init__(self, cpu, memory, disk=0, storage=None, reason=None) -> None:
+        msg = f"no node fits cpu {cpu} memory {memory} disk {disk} storage {storage}"
+        super().__init__(f"{msg}, {reason}" if reason else msg)
+
+
+class DaemonRunningError(Exception):
+
+    def __init__(self, socket_path: str) -> None:
+        super().__init__(f"a kp daemon is already listening on {socket_path}")
+
+
+class InvalidClusterSpec(Exception):
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class SnippetStorageError(Exception):
+
+    def __init__(self, node: str, storage: str, reason=None) -> None:
+        reason = reason or f"not shared with node {node}"
+        super().__init__(
+            f"snippets storage {storage}: {reason}, cloud-init join needs it")
+
+
+class JoinFailedError(Exception):
+
+    def __init__(self, vm_id, exitcode: int, stderr: str) -> None:
+        super().__init__(
+            f"vm {vm_id} failed to join, exitcode {exitcode}: {stderr}")
+        self.vm_id = vm_id
+        self.exitcode = exitcode
+
+
+class LeasesRequiredError(Exception):
+
+    def __init__(self, feature: str) -> None:
+        super().__init__(f"{feature} needs leases, set lease_db_path")
+
+
+class DaemonSocketError(Exception):
+
+    def __init__(self, socket_path: str, reason: str) -> None:
+        super().__init__(f"daemon socket {socket_path}: {reason}")
+
+
+class LeaseTakenError(Exception):
+
+    def __init__(self, kind: str, values=[]) -> None:
+        super().__init__(
+            f"{kind} {', '.join(str(x) for x in values)} leased by another run"
+        )
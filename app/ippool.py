@@ -0,0 +1,113 @@
+import ipaddress
+
+from typing import List
+
+
+class IpPool:
+    """
+    Host addresses of a network as a bitmap of offsets.
+    """
+
+    def __init__(self,
+                 network: ipaddress.IPv4Network,
+                 preserved_ips: List[str] = []) -> None:
+        self.network = network
+        if network.num_addresses <= 2:
+            # NOTE: /31 and /32 have no network and broadcast address
+            self.first = int(network.network_address)
+            self.size = network.num_addresses
+        else:
+            self.first = int(network.network_address) + 1
+            self.size = network.num_addresses - 2
+        self.bitmap = bytearray((self.size + 7) // 8)
+        self.used = 0
+        self.cursor = 0
+        for x in preserved_ips:
+            self.reserve_range(x)
+
+    @staticmethod
+    def from_cidr(cidr: str, preserved_ips: List[str] = []):
+        """
+        Example: "192.168.56.1/24", the host bits are ignored
+        """
+        network = ipaddress.IPv4Interface(cidr).network
+        return IpPool(network, preserved_ips)
+
+    def __len__(self):
+        return self.size
+
+    def free_count(self):
+        return self.size - self.used
+
+    def offset(self, ip: str):
+        i = int(ipaddress.IPv4Address(ip)) - self.first
+        if i < 0 or i >= self.size:
+            return None
+        return i
+
+    def at(self, i: int):
+        return str(ipaddress.IPv4Address(self.first + i))
+
+    def is_free_at(self, i: int):
+        return not self.bitmap[i >> 3] & (1 << (i & 7))
+
+    def is_free(self, ip: str):
+        i = self.offset(ip)
+        return i is not None and self.is_free_at(i)
+
+    def _set(self, i: int):
+        if self.is_free_at(i):
+            self.bitmap[i >> 3] |= 1 << (i & 7)
+            self.used += 1
+
+    def _clear(self, i: int):
+        if not self.is_free_at(i):
+            self.bitmap[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+            self.used -= 1
+
+    def reserve(self, ip: str):
+        i = self.offset(ip)
+        if i is not None:
+            self._set(i)
+
+    def reserve_range(self, value: str):
+        """
+        value is an ip, a "first-last" range or a cidr, addresses outside the pool are ignored.
+        """
+        if "-" in value:
+            first, last = value.split("-", 1)
+            start = int(ipaddress.IPv4Address(first.strip())) - self.first
+            end = int(ipaddress.IPv4Address(last.strip())) - self.first
+        elif "/" in value:
+            network = ipaddress.IPv4Network(value, strict=False)
+            start = int(network.network_address) - self.first
+            end = int(network.broadcast_address) - self.first
+        else:
+            self.reserve(value)
+            return
+        for i in range(max(start, 0), min(end, self.size - 1) + 1):
+            self._set(i)
+
+    def release(self, ip: str):
+        i = self.offset(ip)
+        if i is not None:
+            self._clear(i)
+
+    def allocate(self):
+        """
+        Mark the next free address as used and return it, None if the pool is full.
+        """
+        if self.used >= self.size:
+            return None
+        size = self.size
+        i = self.cursor
+        for _ in range(size):
+            if i & 7 == 0 and self.bitmap[i >> 3] == 0xFF and i + 8 <= size:
+                i = (i + 8) % size
+                continue
+            if self.is_free_at(i):
+                self._set(i)
+                self.cursor = (i + 1) % size
+                return self.at(i)
+            i = (i + 1) % size
+        return None
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import threading
+
+from app.logger import Logger
+from app import config
+
+
+class JoinCache:
+    """
+    Kubeadm join credentials per control plane, kept in a json file.
+    """
+
+    def __init__(self,
+                 path=config.JOIN_CACHE_PATH,
+                 ttl=config.JOIN_TOKEN_TTL,
+                 refresh_margin=config.JOIN_REFRESH_MARGIN,
+                 clock=time.time,
+                 log=Logger.DEBUG) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self.log = log
+        self.lock = threading.Lock()
+        self.refreshing = set()
+
+    @staticmethod
+    def key(proxmox_host, control_plane_vm_id, endpoint):
+        return f"{proxmox_host or ''}/{control_plane_vm_id}/{endpoint or ''}"
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, entries: dict):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # NOTE: put from a background refresh too, a write cut short only leaves the tmp file behind
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}"
+        # NOTE: tokens are secrets, keep the file private to the user
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _remaining(self, entry: dict, with_certificate_key=False):
+        now = self.clock()
+        remaining = (entry.get("expires_at") or 0) - now
+        if with_certificate_key:
+            if not entry.get("certificate_key"):
+                return 0
+            remaining = min(remaining,
+                            (entry.get("certificate_key_expires_at") or 0) -
+                            now)
+        return remaining
+
+    def put(self, key, credentials: dict):
+        with self.lock:
+            entries = self._load()
+            entries[str(key)] = credentials
+            self._save(entries)
+
+    def invalidate(self, key):
+        with self.lock:
+            entries = self._load()
+            if entries.pop(str(key), None) is not None:
+                self._save(entries)
+
+    def get(self, key, create, with_certificate_key=False):
+        """
+        create(ttl, with_certificate_key) makes new credentials.
+        """
+        log = self.log
+        with self.lock:
+            entry = self._load().get(str(key))
+        remaining = self._remaining(entry,
+                                    with_certificate_key) if entry else 0
+        if remaining <= 0:
+            log.debug("join_cache", key, "miss")
+            credentials = create(self.ttl, with_certificate_key)
+            self.put(key, credentials)
+            return credentials
+        if remaining < self.refresh_margin:
+            self.refresh_in_background(key, create, with_certificate_key)
+        log.debug("join_cache", key, "hit", int(remaining))
+        return entry
+
+    def refresh_in_background(self, key, create, with_certificate_key=False):
+        log = self.log
+        with self.lock:
+            if key in self.refreshing:
+                return None
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.put(key, create(self.ttl, with_certificate_key))
+                log.debug("join_cache", key, "refreshed")
+            except Exception as err:
+                log.error("join_cache", key, "refresh", err)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        thread = threading.Thread(target=refresh,
+                                  name="join-cache-refresh",
+                                  daemon=True)
+        thread.start()
+        return thread
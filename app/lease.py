@@ -0,0 +1,155 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+from app.logger import Logger
+from app import config
+
+
+class LeaseStore:
+    """
+    Sqlite backed leases on vm ids and ips, shared by every kp process on this host.
+    """
+
+    def __init__(self,
+                 path=config.LEASE_DB_PATH,
+                 ttl=config.LEASE_TTL,
+                 log=Logger.DEBUG) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.log = log
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS leases ("
+                         "kind TEXT, value TEXT, owner TEXT, expires_at REAL,"
+                         " PRIMARY KEY (kind, value))")
+            conn.execute("CREATE INDEX IF NOT EXISTS leases_expires_at"
+                         " ON leases (kind, expires_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cursors ("
+                         "kind TEXT PRIMARY KEY, position INTEGER)")
+
+    def _connect(self):
+        # NOTE: one connection per call, connections must not cross threads
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    @staticmethod
+    def owner():
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+    def acquire(self,
+                kind: str,
+                size: int,
+                value_at,
+                taken=set(),
+                count=1,
+                ttl=None):
+        """
+        Lease up to count free values among value_at(0) ... value_at(size - 1).
+        """
+        log = self.log
+        now = time.time()
+        taken = set(str(x) for x in taken)
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT position FROM cursors WHERE kind = ?",
+                               (kind, )).fetchone()
+            start = row[0] % size if row and size else 0
+            position = start
+            values = []
+            owner = LeaseStore.owner()
+            for step in range(size):
+                if len(values) >= count:
+                    break
+                i = (start + step) % size
+                value = value_at(i)
+                if value is None or str(value) in taken:
+                    continue
+                # NOTE: one primary key lookup, an expired lease is taken over
+                r = conn.execute(
+                    "INSERT INTO leases VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (kind, value) DO UPDATE"
+                    " SET owner = excluded.owner, expires_at = excluded.expires_at"
+                    " WHERE leases.expires_at <= ?",
+                    (kind, str(value), owner, now + (ttl or self.ttl), now))
+                if not r.rowcount:
+                    continue
+                values.append(value)
+                position = i + 1
+            conn.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?)",
+                         (kind, position))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        log.debug("lease", kind, "acquire", values)
+        return values
+
+    def claim(self, kind: str, values=[], ttl=None):
+        """
+        Lease every one of values or none, return the values someone else has.
+        """
+        now = time.time()
+        taken = []
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            owner = LeaseStore.owner()
+            for value in values:
+                r = conn.execute(
+                    "INSERT INTO leases VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (kind, value) DO UPDATE"
+                    " SET owner = excluded.owner, expires_at = excluded.expires_at"
+                    " WHERE leases.expires_at <= ?",
+                    (kind, str(value), owner, now + (ttl or self.ttl), now))
+                if not r.rowcount:
+                    taken.append(value)
+            conn.execute("ROLLBACK" if taken else "COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        self.log.debug("lease", kind, "claim", values, "taken", taken)
+        return taken
+
+    def leased(self, kind: str):
+        """
+        Return the values of kind under an unexpired lease.
+        """
+        now = time.time()
+        return [x[1] for x in self.list(kind) if x[3] > now]
+
+    def release(self, kind: str, values=[]):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM leases WHERE kind = ? AND value = ?",
+                             [(kind, str(x)) for x in values])
+        self.log.debug("lease", kind, "release", values)
+
+    def reconcile(self, kind: str):
+        """
+        Drop the expired leases of kind.
+        """
+        # NOTE: not when the value shows up in an inventory, a caller with an older one would hand it out again
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM leases WHERE kind = ? AND expires_at <= ?",
+                (kind, now))
+
+    def list(self, kind: str = None):
+        with self._connect() as conn:
+            if kind:
+                rows = conn.execute(
+                    "SELECT kind, value, owner, expires_at FROM leases"
+                    " WHERE kind = ?", (kind, ))
+            else:
+                rows = conn.execute(
+                    "SELECT kind, value, owner, expires_at FROM leases")
+            return rows.fetchall()
@@ -23,19 +23,23 @@ class Logger:
     DEBUG: Logger
 
     @staticmethod
-    def from_env():
+    def from_env(file=None):
         level = (os.getenv("LOGGER") or "").upper()
-        if level == "DEBUG": return Logger.DEBUG
-        if level == "INFO": return Logger.INFO
-        if level == "WARN": return Logger.WARN
-        return Logger.ERROR
-
-    def __init__(self):
-        pass
+        log = Logger.ERROR
+        if level == "DEBUG": log = Logger.DEBUG
+        if level == "INFO": log = Logger.INFO
+        if level == "WARN": log = Logger.WARN
+        if file is None:
+            return log
+        return type(log)(file=file)
+
+    def __init__(self, file=None):
+        # NOTE: None is sys.stdout
+        self.file = file
 
     def error(self, *msg):
         msg = to_string(msg)
-        print(f"{now()} [ERROR] {msg}")
+        print(f"{now()} [ERROR] {msg}", file=self.file)
 
     def warn(self, *msg):
         pass
@@ -51,21 +55,21 @@ class WarnLogger(Logger):
 
     def warn(self, *msg):
         msg = to_string(msg)
-        print(f"{now()} [WARM] {msg}")
+        print(f"{now()} [WARM] {msg}", file=self.file)
 
 
 class InfoLogger(WarnLogger):
 
     def info(self, *msg):
         msg = to_string(msg)
-        print(f"{now()} [INFO] {msg}")
+        print(f"{now()} [INFO] {msg}", file=self.file)
 
 
 class DebugLogger(InfoLogger):
 
     def debug(self, *msg):
         msg = to_string(msg)
-        print(f"{now()} [DEBUG] {msg}")
+        print(f"{now()} [DEBUG] {msg}", file=self.file)
 
 
 Logger.ERROR = Logger()
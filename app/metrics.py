@@ -0,0 +1,217 @@
+import os
+import atexit
+import bisect
+import threading
+import http.server
+
+from typing import List, Mapping
+from app import config
+
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n",
+                                                    "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """
+    Values are kept per label values tuple, in the order of label_names.
+    """
+
+    type = None
+
+    def __init__(self, name: str, help: str, label_names: List[str] = []):
+        self.name = name
+        self.help = help
+        self.label_names = list(label_names)
+        self.lock = threading.Lock()
+        self.values: Mapping[tuple, object] = {}
+
+    def key(self, labels: dict):
+        return tuple(labels.get(x, "") for x in self.label_names)
+
+    def labels_text(self, key: tuple, extra=""):
+        pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.label_names, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}"
+        ]
+        with self.lock:
+            items = sorted(self.values.items())
+            for key, value in items:
+                lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key: tuple, value):
+        return [f"{self.name}{self.labels_text(key)} {value}"]
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 help: str,
+                 label_names: List[str] = [],
+                 buckets=BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            # NOTE: [count per bucket (+Inf last), sum], made cumulative on render
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][i] += 1
+            state[1] += value
+
+    def render_value(self, key: tuple, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for le, count in zip(self.buckets + ["+Inf"], counts):
+            cumulative += count
+            labels = self.labels_text(key, f'le="{le}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = self.labels_text(key)
+        lines.append(f"{self.name}_sum{labels} {round(total, 6)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, filepath: str):
+        """
+        For the node-exporter textfile collector, the file is replaced at once so it is never read half written.
+        """
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, filepath)
+
+    def serve(self, port: int, host=""):
+        """
+        Serve GET /metrics in a background thread, return the server.
+        """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever,
+                         name="kp-metrics",
+                         daemon=True).start()
+        return server
+
+
+registry = Registry()
+
+http_request_duration = registry.register(
+    Histogram("kp_http_request_duration_seconds",
+              "Proxmox api requests by method and path", ["method", "path"],
+              buckets=[0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]))
+http_errors = registry.register(
+    Counter("kp_http_errors_total", "Proxmox api responses with status >= 400",
+            ["method", "path", "status"]))
+phase_duration = registry.register(
+    Histogram("kp_phase_duration_seconds",
+              "Provisioning and teardown phases by outcome",
+              ["phase", "outcome"]))
+exec_polls = registry.register(
+    Counter("kp_exec_polls_total", "agent exec-status calls"))
+retries = registry.register(
+    Counter("kp_retries_total", "Retried operations", ["op"]))
+timeouts = registry.register(
+    Counter("kp_timeouts_total", "Waits that timed out", ["op"]))
+cluster_nodes = registry.register(
+    Gauge("kp_cluster_nodes", "Online proxmox nodes"))
+cluster_vms = registry.register(
+    Gauge("kp_cluster_vms", "Qemu vms of the cluster"))
+warm_pool_size = registry.register(
+    Gauge("kp_warm_pool_vms", "Booted and not joined workers"))
+workers = registry.register(Gauge("kp_workers", "Worker vms"))
+
+
+def instrument_session(session):
+    """
+    Time every request of a requests session, e.g. the one of a ProxmoxAPI.
+    """
+    # NOTE: import here, app.trace imports this module
+    from app.trace import http_path
+
+    def on_response(r, *args, **kwargs):
+        method = r.request.method
+        path = http_path(r.request.url)
+        http_request_duration.observe(r.elapsed.total_seconds(),
+                                      method=method,
+                                      path=path)
+        if r.status_code >= 400:
+            http_errors.inc(method=method, path=path, status=r.status_code)
+
+    session.hooks["response"].append(on_response)
+
+
+# NOTE: per run metrics, the counters of the previous run are not carried over
+if config.METRICS_FILE:
+    atexit.register(lambda: registry.write_textfile(config.METRICS_FILE))
@@ -0,0 +1,98 @@
+from typing import List, Mapping
+from app.error import *
+from app import config
+from app import util
+
+STRATEGIES = ["none", "binpack", "spread"]
+
+
+class Scheduler:
+    """
+    Choose the node of a new vm from what the vms on each node were given.
+    """
+
+    def __init__(self,
+                 nodes: List[dict],
+                 storages: List[dict] = [],
+                 vms: List[dict] = [],
+                 strategy="binpack",
+                 cpu_overcommit=config.PLACEMENT_CPU_OVERCOMMIT) -> None:
+        if strategy not in ["binpack", "spread"]:
+            raise InvalidPlacementStrategy(strategy)
+        self.strategy = strategy
+        self.nodes: Mapping[str, dict] = {}
+        for x in nodes:
+            self.nodes[x["node"]] = {
+                "cpu": x.get("maxcpu", 0) * cpu_overcommit,
+                "memory": x.get("maxmem", 0),
+                "cpu_used": 0,
+                "memory_used": 0,
+                "tags": {},
+            }
+        self.storages: Mapping[tuple, int] = {}
+        for x in storages:
+            self.storages[(
+                x["node"],
+                x["storage"])] = x.get("maxdisk", 0) - x.get("disk", 0)
+        for vm in vms:
+            self.add(vm.get("node"),
+                     cpu=vm.get("maxcpu", 0),
+                     memory=vm.get("maxmem", 0),
+                     tags=util.ProxmoxUtil.split_tags(vm.get("tags", None)))
+
+    def add(self, node: str, cpu=0, memory=0, disk=0, storage=None, tags=[]):
+        state = self.nodes.get(node)
+        if not state:
+            return
+        state["cpu_used"] += cpu
+        state["memory_used"] += memory
+        for tag in tags:
+            state["tags"][tag] = state["tags"].get(tag, 0) + 1
+        if storage and (node, storage) in self.storages:
+            self.storages[(node, storage)] -= disk
+
+    def fits(self, node: str, cpu=0, memory=0, disk=0, storage=None):
+        state = self.nodes[node]
+        if state["cpu_used"] + cpu > state["cpu"]:
+            return False
+        if state["memory_used"] + memory > state["memory"]:
+            return False
+        if storage:
+            free = self.storages.get((node, storage), None)
+            if free is None or free < disk:
+                return False
+        return True
+
+    def place(self,
+              cpu=0,
+              memory=0,
+              disk=0,
+              storage=None,
+              anti_affinity_tag=None,
+              nodes=None,
+              reason=None):
+        """
+        Return the chosen node among nodes (every node by default) and account the vm to it, raise NoNodeAvailableError if none fits.
+        """
+        candidates = []
+        for node, state in self.nodes.items():
+            if nodes is not None and node not in nodes:
+                continue
+            if not self.fits(node, cpu, memory, disk, storage):
+                continue
+            affinity = state["tags"].get(anti_affinity_tag,
+                                         0) if anti_affinity_tag else 0
+            memory_left = state["memory"] - state["memory_used"] - memory
+            if self.strategy == "spread":
+                memory_left = -memory_left
+            candidates.append((affinity, memory_left, node))
+        if not candidates:
+            raise NoNodeAvailableError(cpu, memory, disk, storage, reason)
+        _, _, node = min(candidates)
+        self.add(node,
+                 cpu=cpu,
+                 memory=memory,
+                 disk=disk,
+                 storage=storage,
+                 tags=[anti_affinity_tag] if anti_affinity_tag else [])
+        return node
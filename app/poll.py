@@ -0,0 +1,83 @@
+import time
+import random
+import asyncio
+
+from app import config
+
+
+class Backoff:
+    """
+    Exponential delays with jitter: initial, initial * factor, ... up to max_interval.
+    """
+
+    def __init__(self,
+                 initial=config.POLL_INITIAL_INTERVAL,
+                 max_interval=config.POLL_MAX_INTERVAL,
+                 factor=config.POLL_BACKOFF_FACTOR,
+                 jitter=config.POLL_JITTER) -> None:
+        self.initial = initial
+        self.max_interval = max(max_interval, initial)
+        self.factor = factor
+        self.jitter = jitter
+        self.current = initial
+
+    def reset(self):
+        self.current = self.initial
+
+    def next(self):
+        delay = self.current
+        self.current = min(self.current * self.factor, self.max_interval)
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0)
+
+
+def poll(check,
+         timeout=config.TIMEOUT,
+         max_interval=None,
+         initial=config.POLL_INITIAL_INTERVAL,
+         factor=config.POLL_BACKOFF_FACTOR,
+         jitter=config.POLL_JITTER,
+         sleep=time.sleep,
+         clock=time.monotonic):
+    """
+    Call check() with backoff until it returns a truthy value, raise TimeoutError.
+    """
+    backoff = Backoff(initial=initial,
+                      max_interval=max_interval or config.POLL_MAX_INTERVAL,
+                      factor=factor,
+                      jitter=jitter)
+    deadline = clock() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        remain = deadline - clock()
+        if remain <= 0:
+            raise TimeoutError()
+        sleep(min(backoff.next(), remain))
+
+
+async def apoll(check,
+                timeout=config.TIMEOUT,
+                max_interval=None,
+                initial=config.POLL_INITIAL_INTERVAL,
+                factor=config.POLL_BACKOFF_FACTOR,
+                jitter=config.POLL_JITTER,
+                clock=time.monotonic):
+    """
+    Same as poll with a coroutine function check.
+    """
+    backoff = Backoff(initial=initial,
+                      max_interval=max_interval or config.POLL_MAX_INTERVAL,
+                      factor=factor,
+                      jitter=jitter)
+    deadline = clock() + timeout
+    while True:
+        result = await check()
+        if result:
+            return result
+        remain = deadline - clock()
+        if remain <= 0:
+            raise TimeoutError()
+        await asyncio.sleep(min(backoff.next(), remain))
@@ -0,0 +1,215 @@
+import time
+
+from typing import List
+from app.controller.node import NodeController
+from app.service.worker import WorkerService
+from app.service.pool import WarmPoolService
+from app.service.reconcile import ReconcileService
+from app.logger import Logger
+from app.error import *
+from app import config
+from app import metrics
+from app import util
+
+
+def is_unschedulable(pod: dict):
+    for condition in pod.get("status", {}).get("conditions", []):
+        if condition.get("type") == "PodScheduled" and condition.get(
+                "reason") == "Unschedulable":
+            return True
+    return False
+
+
+def summarize(cluster: dict, log=Logger.DEBUG):
+    """
+    Return {"pending": pods, "nodes": {name: {...}}} from the kubectl List.
+    """
+
+    def quantity(value, *what):
+        try:
+            return util.KubeUtil.parse_quantity(value)
+        except ValueError as err:
+            # NOTE: counted as 0, a node without allocatable is never scaled down
+            log.warn("autoscaler", "skip", *what, err)
+            return 0
+
+    nodes = {}
+    pods = []
+    for item in cluster.get("items", []):
+        if item.get("kind") == "Node":
+            allocatable = item.get("status", {}).get("allocatable", {})
+            name = item["metadata"]["name"]
+            nodes[name] = {
+                "cpu": quantity(allocatable.get("cpu"), name, "cpu"),
+                "memory": quantity(allocatable.get("memory"), name, "memory"),
+                "cpu_requests": 0,
+                "memory_requests": 0,
+                "pods": 0,
+            }
+        if item.get("kind") == "Pod":
+            pods.append(item)
+
+    pending = 0
+    for pod in pods:
+        phase = pod.get("status", {}).get("phase")
+        node_name = pod.get("spec", {}).get("nodeName")
+        if phase == "Pending" and not node_name:
+            if is_unschedulable(pod):
+                pending += 1
+            continue
+        if phase in ["Succeeded", "Failed"] or node_name not in nodes:
+            continue
+        node = nodes[node_name]
+        node["pods"] += 1
+        for container in pod.get("spec", {}).get("containers", []):
+            requests = container.get("resources", {}).get("requests", {})
+            pod_name = pod.get("metadata", {}).get("name")
+            node["cpu_requests"] += quantity(requests.get("cpu"), pod_name,
+                                             "cpu")
+            node["memory_requests"] += quantity(requests.get("memory"),
+                                                pod_name, "memory")
+    return {"pending": pending, "nodes": nodes}
+
+
+def utilization(node: dict):
+    cpu = node["cpu_requests"] / node["cpu"] if node["cpu"] else 1
+    memory = node["memory_requests"] / node["memory"] if node["memory"] else 1
+    return max(cpu, memory)
+
+
+def decide(summary: dict,
+           workers: dict,
+           min_workers=0,
+           max_workers=10,
+           scale_down_utilization=config.AUTOSCALER_SCALE_DOWN_UTILIZATION,
+           last_scale_up=None,
+           last_scale_down=None,
+           scale_up_cooldown=config.AUTOSCALER_SCALE_UP_COOLDOWN,
+           scale_down_cooldown=config.AUTOSCALER_SCALE_DOWN_COOLDOWN,
+           now=None):
+    """
+    Return {"action": "up" | "down" | "none", "vm_id", "reason"}.
+    """
+    now = now if now is not None else time.time()
+    count = len(workers)
+    if count < min_workers:
+        return {"action": "up", "vm_id": None, "reason": "below min_workers"}
+    if summary["pending"]:
+        if count >= max_workers:
+            return {
+                "action": "none",
+                "vm_id": None,
+                "reason": "at max_workers"
+            }
+        if last_scale_up and now - last_scale_up < scale_up_cooldown:
+            return {
+                "action": "none",
+                "vm_id": None,
+                "reason": "scale up cooldown"
+            }
+        return {
+            "action": "up",
+            "vm_id": None,
+            "reason": f"{summary['pending']} pending pods"
+        }
+    if count <= min_workers:
+        return {"action": "none", "vm_id": None, "reason": "at min_workers"}
+    last_scale = max(last_scale_up or 0, last_scale_down or 0)
+    if last_scale and now - last_scale < scale_down_cooldown:
+        return {
+            "action": "none",
+            "vm_id": None,
+            "reason": "scale down cooldown"
+        }
+    candidates = []
+    for name, vm_id in workers.items():
+        node = summary["nodes"].get(name)
+        if not node:
+            continue
+        value = utilization(node)
+        if value < scale_down_utilization:
+            candidates.append((value, -int(vm_id), name))
+    if not candidates:
+        return {"action": "none", "vm_id": None, "reason": "no idle worker"}
+    value, vm_id, name = min(candidates)
+    return {
+        "action": "down",
+        "vm_id": -vm_id,
+        "reason": f"{name} utilization {round(value, 2)}"
+    }
+
+
+class AutoscalerService:
+
+    def __init__(self, nodectl: NodeController, log=Logger.DEBUG) -> None:
+        self.nodectl = nodectl
+        self.log = log
+        self.last_scale_up = None
+        self.last_scale_down = None
+
+    def workers(self, inventory):
+        """
+        Return {vm name: vm id} of the joined kp workers, vm names are the kube node names.
+        """
+        state = ReconcileService(self.nodectl,
+                                 log=self.log).current_state(inventory)
+        worker_ids = set(state["worker"])
+        return {
+            vm["name"]: int(vm["vmid"])
+            for vm in inventory.managed_vms() if int(vm["vmid"]) in worker_ids
+        }
+
+    def tick(self,
+             control_plane_vm_id: int,
+             min_workers=0,
+             max_workers=10,
+             scale_down_utilization=config.AUTOSCALER_SCALE_DOWN_UTILIZATION,
+             scale_up_cooldown=config.AUTOSCALER_SCALE_UP_COOLDOWN,
+             scale_down_cooldown=config.AUTOSCALER_SCALE_DOWN_COOLDOWN,
+             dry_run=False,
+             **kwargs):
+        nodectl = self.nodectl
+        log = self.log
+        inventory = nodectl.inventory()
+        workers = self.workers(inventory)
+        metrics.workers.set(len(workers))
+        cluster = nodectl.ctlplvmctl(control_plane_vm_id).get_pods_and_nodes()
+        summary = summarize(cluster, log=log)
+        decision = decide(summary,
+                          workers,
+                          min_workers=min_workers,
+                          max_workers=max_workers,
+                          scale_down_utilization=scale_down_utilization,
+                          last_scale_up=self.last_scale_up,
+                          last_scale_down=self.last_scale_down,
+                          scale_up_cooldown=scale_up_cooldown,
+                          scale_down_cooldown=scale_down_cooldown)
+        log.info("autoscaler", decision["action"], decision["reason"])
+        if dry_run or decision["action"] == "none":
+            return decision
+
+        if decision["action"] == "up":
+            self.last_scale_up = time.time()
+            if kwargs.get("warm_pool_size", 0):
+                vm_id = WarmPoolService(nodectl, log=log).create_worker(
+                    control_plane_vm_id=control_plane_vm_id, **kwargs)
+            else:
+                vm_id = WorkerService(nodectl, log=log).create_worker(
+                    control_plane_vm_id=control_plane_vm_id, **kwargs)
+            decision["vm_id"] = vm_id
+            return decision
+
+        self.last_scale_down = time.time()
+        WorkerService(nodectl, log=log).delete_worker(
+            decision["vm_id"], control_plane_vm_id=control_plane_vm_id)
+        return decision
+
+    def run(self, interval=config.AUTOSCALER_INTERVAL, **kwargs):
+        log = self.log
+        while True:
+            started_at = time.monotonic()
+            try:
+                self.tick(**kwargs)
+            except Exception as err:
+                log.error("autoscaler", err)
+            time.sleep(max(interval - (time.monotonic() - started_at), 0))
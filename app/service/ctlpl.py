@@ -1,8 +1,10 @@
 import os
-import ipaddress
 
+from concurrent.futures import ThreadPoolExecutor
 from app.controller.node import NodeController
 from app.logger import Logger
+from app import config
+from app import trace
 from app import util
 from app.error import *
 
@@ -14,6 +16,7 @@ class ControlPlaneService:
         self.log = log
         pass
 
+    @trace.traced(vm_id_arg="dest_id")
     def copy_kube_certs(self,
                         source_id,
                         dest_id,
@@ -26,19 +29,57 @@ class ControlPlaneService:
                             "/etc/kubernetes/pki/front-proxy-ca.key",
                             "/etc/kubernetes/pki/etcd/ca.crt",
                             "/etc/kubernetes/pki/etcd/ca.key",
-                        ]):
+                        ],
+                        bundle=True):
+        """
+        bundle moves the certs in one checked archive.
+        """
         # https://kubernetes.io/docs/setup/production-environment/tools/kubeadm/high-availability/#manual-certs
         nodectl = self.nodectl
         log = self.log
         sourcectl = nodectl.vmctl(source_id)
-        destctl = nodectl.vmctl(dest_id)
+        destctl = nodectl.ctlplvmctl(dest_id)
 
+        if bundle:
+            payload, sha256 = sourcectl.pack_files(certs)
+            destctl.unpack_files(payload, sha256)
+            return
+
+        destctl.ensure_cert_dirs()
         for cert in certs:
             r = sourcectl.read_file(cert)
-            content = r["content"]
-            # TODO: check truncated content https://pve.proxmox.com/pve-docs/api-viewer/index.html#/nodes/{node}/qemu/{vmid}/agent/file-read
-            r = destctl.write_file(cert, content)
+            if r.get("truncated", False):
+                raise FileTransferError(f"{cert} is truncated")
+            destctl.write_file(cert, r["content"])
+
+    def add_lb_backend(self, lbctl, vm_id, vm_ip):
+        log = self.log
+        exitcode, _, stderr = lbctl.apply_backends([("add", "control-plane",
+                                                     vm_id, f"{vm_ip}:6443")])
+        if exitcode != 0:
+            log.error(stderr)
+            raise Exception("some thing wrong with add_backend")
 
+    def remove_lb_backend(self, lbctl, backend_future, vm_id):
+        log = self.log
+        if backend_future.exception():
+            return
+        try:
+            exitcode, _, stderr = lbctl.apply_backends([("rm", "control-plane",
+                                                         vm_id)])
+            if exitcode != 0:
+                log.error(stderr)
+        except Exception as err:
+            log.error("remove_lb_backend", vm_id, err)
+
+    def detect_control_plane_endpoint(self, lbctl):
+        lb_config = lbctl.current_config()
+        lb_ifconfig0 = lb_config.get("ipconfig0", None)
+        if not lb_ifconfig0:
+            raise Exception("can not detect the control_plane_endpoint")
+        return util.ProxmoxUtil.extract_ip(lb_ifconfig0)
+
+    @trace.traced()
     def create_control_plane(self,
                              vm_network_name,
                              control_plane_template_id,
@@ -53,7 +94,14 @@ class ControlPlaneService:
                              cni_manifest_file=None,
                              control_plane_vm_id=None,
                              load_balancer_vm_id=None,
+                             clone_strategy=config.CLONE_STRATEGY,
+                             clone_storage=None,
+                             reserved_vm_id=None,
+                             reserved_vm_ip=None,
                              **kwargs):
+        """
+        The endpoint, the lb backend and the join command are prepared while the vm clones.
+        """
         nodectl = self.nodectl
         log = self.log
 
@@ -61,95 +109,119 @@ class ControlPlaneService:
         if load_balancer_vm_id:
             is_multiple_control_planes = True
 
-        r = nodectl.describe_network(vm_network_name)
-        network_interface = ipaddress.IPv4Interface(r["cidr"])
-        network_gw_ip = str(network_interface.ip) or r["address"]
-        vm_network = network_interface.network
-        ip_pool = []
-        for ip in vm_network.hosts():
-            ip_pool.append(str(ip))
-        preserved_ips.append(network_gw_ip)
-        log.debug("preserved_ips", preserved_ips)
-
-        new_vm_id = nodectl.new_vm_id(vm_id_range)
-        new_vm_ip = nodectl.new_vm_ip(ip_pool, preserved_ips)
-        new_vm_name = f"{vm_name_prefix}{new_vm_id}"
-
-        nodectl.clone(control_plane_template_id, new_vm_id)
-
-        ctlplvmctl = nodectl.ctlplvmctl(new_vm_id)
-        ctlplvmctl.update_config(
-            name=new_vm_name,
-            ciuser=vm_username,
-            cipassword=vm_password,
-            agent="enabled=1,fstrim_cloned_disks=1",
-            net0=f"virtio,bridge={vm_network_name}",
-            ipconfig0=f"ip={new_vm_ip}/24,gw={network_gw_ip}",
-            sshkeys=util.ProxmoxUtil.encode_sshkeys(vm_ssh_keys),
-        )
-        ctlplvmctl.resize_disk(disk="scsi0", size="+20G")
-        ctlplvmctl.startup()
-        ctlplvmctl.wait_for_guest_agent()
-
-        # SECTION: standalone control plane
-        if not is_multiple_control_planes:
-            exitcode, _, _ = ctlplvmctl.kubeadm().init(
-                control_plane_endpoint=new_vm_id, pod_cidr=pod_cidr)
-
-            if not cni_manifest_file:
-                log.debug("skip apply cni step")
-                return new_vm_id
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            network_future = executor.submit(nodectl.vm_network,
+                                             vm_network_name, preserved_ips)
+            inventory_future = None
+            if not reserved_vm_id or not reserved_vm_ip:
+                inventory_future = executor.submit(nodectl.inventory)
+            ip_pool, network_gw_ip, preserved_ips = network_future.result()
+            network_prefixlen = ip_pool.network.prefixlen
 
-            cni_filepath = "/root/cni.yaml"
-            with open(cni_manifest_file, "r", encoding="utf-8") as f:
-                ctlplvmctl.write_file(cni_filepath, f.read())
-                ctlplvmctl.apply_file(cni_filepath)
-            return new_vm_id
+            new_vm_id = reserved_vm_id
+            new_vm_ip = reserved_vm_ip
+            if inventory_future:
+                inventory = inventory_future.result()
+                new_vm_id = new_vm_id or nodectl.new_vm_id(vm_id_range,
+                                                           inventory=inventory)
+                new_vm_ip = new_vm_ip or nodectl.new_vm_ip(
+                    ip_pool, preserved_ips, inventory=inventory)
+            new_vm_name = f"{vm_name_prefix}{new_vm_id}"
 
-        # SECTION: stacked control plane
-        lbctl = nodectl.lbctl(load_balancer_vm_id)
-        exitcode, _, stderr = lbctl.add_backend("control-plane", new_vm_id,
-                                                f"{new_vm_ip}:6443")
-        if exitcode != 0:
-            log.error(stderr)
-            raise Exception("some thing wrong with add_backend")
-        lbctl.reload_haproxy()
-
-        # No previous control plane, init a new one
-        if not control_plane_vm_id:
-            control_plane_endpoint = apiserver_endpoint
-            if not control_plane_endpoint:
-                lb_config = lbctl.current_config()
-                lb_ifconfig0 = lb_config.get("ipconfig0", None)
-                if not lb_ifconfig0:
-                    raise Exception(
-                        "can not detect the control_plane_endpoint")
-                vm_ip = util.ProxmoxUtil.extract_ip(lb_ifconfig0)
-                control_plane_endpoint = vm_ip
-            exitcode, _, _ = ctlplvmctl.kubeadm().init(
-                control_plane_endpoint=control_plane_endpoint,
-                pod_cidr=pod_cidr)
-
-            if not cni_manifest_file:
-                log.debug("skip ini cni step")
-                return new_vm_id
+            # SECTION: prefetch, nothing here needs the new vm to be up
+            backend_future = None
+            endpoint_future = None
+            join_cmd_future = None
+            if is_multiple_control_planes:
+                lbctl = nodectl.lbctl(load_balancer_vm_id)
+                backend_future = executor.submit(self.add_lb_backend, lbctl,
+                                                 new_vm_id, new_vm_ip)
+                if not control_plane_vm_id and not apiserver_endpoint:
+                    endpoint_future = executor.submit(
+                        self.detect_control_plane_endpoint, lbctl)
+                if control_plane_vm_id:
+                    join_cmd_future = executor.submit(nodectl.join_command,
+                                                      control_plane_vm_id,
+                                                      is_control_plane=True)
+
+            # NOTE: the backend is added while the vm clones, it goes away again if the vm does not come up
+            try:
+                target = nodectl.place(
+                    control_plane_template_id,
+                    new_vm_id,
+                    anti_affinity_tag=config.CONTROL_PLANE_TAG,
+                    storage=clone_storage)
+                nodectl.clone(control_plane_template_id,
+                              new_vm_id,
+                              strategy=clone_strategy,
+                              storage=clone_storage,
+                              target=target).wait()
+
+                ctlplvmctl = nodectl.ctlplvmctl(new_vm_id)
+                ctlplvmctl.update_config(
+                    name=new_vm_name,
+                    ciuser=vm_username,
+                    cipassword=vm_password,
+                    agent="enabled=1,fstrim_cloned_disks=1",
+                    net0=f"virtio,bridge={vm_network_name}",
+                    ipconfig0=
+                    f"ip={new_vm_ip}/{network_prefixlen},gw={network_gw_ip}",
+                    sshkeys=util.ProxmoxUtil.encode_sshkeys(vm_ssh_keys),
+                    tags=config.CONTROL_PLANE_TAG,
+                )
+                ctlplvmctl.resize_disk(disk="scsi0", size="+20G")
+                ctlplvmctl.startup().wait()
+                ctlplvmctl.wait_for_guest_agent()
+
+                # SECTION: standalone control plane
+                if not is_multiple_control_planes:
+                    exitcode, _, _ = ctlplvmctl.kubeadm().init(
+                        control_plane_endpoint=new_vm_id, pod_cidr=pod_cidr)
+
+                    if not cni_manifest_file:
+                        log.debug("skip apply cni step")
+                        return new_vm_id
+
+                    cni_filepath = "/root/cni.yaml"
+                    with open(cni_manifest_file, "r", encoding="utf-8") as f:
+                        ctlplvmctl.upload_file(cni_filepath, f.read())
+                        ctlplvmctl.apply_file(cni_filepath)
+                    return new_vm_id
+
+                # SECTION: stacked control plane
+                backend_future.result()
 
-            cni_filepath = "/root/cni.yaml"
-            with open(cni_manifest_file, "r", encoding="utf-8") as f:
-                ctlplvmctl.write_file(cni_filepath, f.read())
-                ctlplvmctl.apply_file(cni_filepath)
-            return new_vm_id
-
-        # There are previous control plane prepare new control plane
-        ctlplvmctl.ensure_cert_dirs()
-        self.copy_kube_certs(control_plane_vm_id, new_vm_id)
-        existed_ctlplvmctl = nodectl.ctlplvmctl(control_plane_vm_id)
-        join_cmd = existed_ctlplvmctl.kubeadm().create_join_command(
-            is_control_plane=True)
-        log.debug("join_cmd", " ".join(join_cmd))
-        ctlplvmctl.exec(join_cmd, timeout=20 * 60)
-        return new_vm_id
+                # No previous control plane, init a new one
+                if not control_plane_vm_id:
+                    control_plane_endpoint = apiserver_endpoint
+                    if endpoint_future:
+                        control_plane_endpoint = endpoint_future.result()
+                    exitcode, _, _ = ctlplvmctl.kubeadm().init(
+                        control_plane_endpoint=control_plane_endpoint,
+                        pod_cidr=pod_cidr)
 
+                    if not cni_manifest_file:
+                        log.debug("skip ini cni step")
+                        return new_vm_id
+
+                    cni_filepath = "/root/cni.yaml"
+                    with open(cni_manifest_file, "r", encoding="utf-8") as f:
+                        ctlplvmctl.upload_file(cni_filepath, f.read())
+                        ctlplvmctl.apply_file(cni_filepath)
+                    return new_vm_id
+
+                # There are previous control plane prepare new control plane
+                self.copy_kube_certs(control_plane_vm_id, new_vm_id)
+                join_cmd = join_cmd_future.result()
+                log.debug("join_cmd", " ".join(join_cmd))
+                ctlplvmctl.exec(join_cmd, timeout=20 * 60)
+                return new_vm_id
+            except Exception:
+                if backend_future:
+                    self.remove_lb_backend(lbctl, backend_future, new_vm_id)
+                raise
+
+    @trace.traced(vm_id_arg="vm_id")
     def delete_control_plane(self,
                              vm_id,
                              load_balancer_vm_id=None,
@@ -160,6 +232,15 @@ class ControlPlaneService:
         vm = nodectl.find_vm(vm_id)
         vm_name = vm["name"]
         ctlplvmctl = nodectl.ctlplvmctl(vm_id)
+        lbctl = nodectl.lbctl(
+            load_balancer_vm_id) if load_balancer_vm_id else None
+        if lbctl and lbctl.update_mode == "runtime":
+            # NOTE: no new connections go to the api server while it is reset
+            exitcode, _, stderr = lbctl.apply_backends([
+                ("drain", "control-plane", vm_id)
+            ])
+            if exitcode != 0:
+                log.error(str(stderr))
         # kubeadm reset is needed when deploying stacked control plane
         # https://kubernetes.io/docs/reference/setup-tools/kubeadm/kubeadm-reset/#reset-workflow
         # Remove the control plane with etcd will avoid this error
@@ -169,16 +250,15 @@ class ControlPlaneService:
         except Exception as err:
             log.error(err)
 
-        if load_balancer_vm_id:
+        if lbctl:
             if control_plane_vm_id:
                 nodectl.ctlplvmctl(control_plane_vm_id).delete_node(vm_name)
-            lbctl = nodectl.lbctl(load_balancer_vm_id)
-            exitcode, stdout, stderr = lbctl.rm_backend("control-plane", vm_id)
+            exitcode, stdout, stderr = lbctl.apply_backends([
+                ("rm", "control-plane", vm_id)
+            ])
             if exitcode != 0:
                 log.error(str(stderr))
-            lbctl.reload_haproxy()
 
-        ctlplvmctl.shutdown()
-        ctlplvmctl.wait_for_shutdown()
-        ctlplvmctl.delete()
+        ctlplvmctl.shutdown().wait()
+        ctlplvmctl.delete().wait()
         return vm_id
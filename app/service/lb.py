@@ -1,8 +1,9 @@
 import os
-import ipaddress
 
 from app.controller.node import NodeController
 from app.logger import Logger
+from app import config
+from app import trace
 from app import util
 
 
@@ -13,6 +14,7 @@ class LbService:
         self.log = log
         pass
 
+    @trace.traced()
     def create_lb(self,
                   vm_network_name,
                   lb_template_id,
@@ -24,23 +26,34 @@ class LbService:
                   vm_ssh_keys=None,
                   haproxy_cfg=None,
                   haproxy_cfg_path="/etc/haproxy/haproxy.cfg",
+                  clone_strategy=config.CLONE_STRATEGY,
+                  clone_storage=None,
+                  reserved_vm_id=None,
+                  reserved_vm_ip=None,
                   **kwargs):
         nodectl = self.nodectl
         log = self.log
-        r = nodectl.describe_network(vm_network_name)
-        network_interface = ipaddress.IPv4Interface(r["cidr"])
-        network_gw_ip = str(network_interface.ip) or r["address"]
-        vm_network = network_interface.network
-        ip_pool = []
-        for ip in vm_network.hosts():
-            ip_pool.append(str(ip))
-        preserved_ips.append(network_gw_ip)
-        log.debug("preserved_ips", preserved_ips)
+        ip_pool, network_gw_ip, preserved_ips = nodectl.vm_network(
+            vm_network_name, preserved_ips)
+        network_prefixlen = ip_pool.network.prefixlen
 
-        new_vm_id = nodectl.new_vm_id(vm_id_range)
-        new_vm_ip = nodectl.new_vm_ip(ip_pool, preserved_ips)
+        new_vm_id = reserved_vm_id
+        new_vm_ip = reserved_vm_ip
+        if not new_vm_id or not new_vm_ip:
+            inventory = nodectl.inventory()
+            new_vm_id = new_vm_id or nodectl.new_vm_id(vm_id_range,
+                                                       inventory=inventory)
+            new_vm_ip = new_vm_ip or nodectl.new_vm_ip(
+                ip_pool, preserved_ips, inventory=inventory)
         new_vm_name = f"{vm_name_prefix}{new_vm_id}"
-        nodectl.clone(lb_template_id, new_vm_id)
+        target = nodectl.place(lb_template_id,
+                               new_vm_id,
+                               storage=clone_storage)
+        nodectl.clone(lb_template_id,
+                      new_vm_id,
+                      strategy=clone_strategy,
+                      storage=clone_storage,
+                      target=target).wait()
 
         vmctl = nodectl.vmctl(new_vm_id)
         vmctl.update_config(
@@ -50,11 +63,12 @@ class LbService:
             sshkeys=util.ProxmoxUtil.encode_sshkeys(vm_ssh_keys),
             agent="enabled=1,fstrim_cloned_disks=1",
             net0=f"virtio,bridge={vm_network_name}",
-            ipconfig0=f"ip={new_vm_ip}/24,gw={network_gw_ip}",
+            ipconfig0=f"ip={new_vm_ip}/{network_prefixlen},gw={network_gw_ip}",
+            tags=config.LB_TAG,
         )
 
         vmctl.resize_disk(disk="scsi0", size="+20G")
-        vmctl.startup()
+        vmctl.startup().wait()
         vmctl.wait_for_guest_agent()
 
         if not haproxy_cfg:
@@ -66,5 +80,5 @@ class LbService:
             raise FileNotFoundError(haproxy_cfg)
 
         with open(haproxy_cfg, "r", encoding="utf8") as f:
-            vmctl.write_file(haproxy_cfg_path, f.read())
+            vmctl.upload_file(haproxy_cfg_path, f.read())
         return new_vm_id
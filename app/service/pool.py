@@ -0,0 +1,202 @@
+import threading
+import contextlib
+
+from concurrent.futures import ThreadPoolExecutor
+from proxmoxer import ResourceException
+from app.controller.node import NodeController
+from app.controller.inventory import Inventory
+from app.service.worker import WorkerService
+from app.service.vm import VmService
+from app.logger import Logger
+from app.error import *
+from app import config
+from app import metrics
+from app import util
+
+BOOTING_TAG = config.WARM_POOL_TAG + "-booting"
+
+# NOTE: fills of this process, the lease covers the other processes
+fill_lock = threading.Lock()
+
+
+class WarmPoolService:
+    """
+    Keeps workers cloned and booted, but not joined.
+    """
+
+    def __init__(self, nodectl: NodeController, log=Logger.DEBUG) -> None:
+        self.nodectl = nodectl
+        self.log = log
+        self.workerservice = WorkerService(nodectl, log=log)
+        self.vmservice = VmService(nodectl, log=log)
+
+    def list_warm(self, inventory: Inventory = None, booting=False):
+        nodectl = self.nodectl
+        inventory = inventory or nodectl.inventory()
+        if booting:
+            return inventory.tagged(config.WARM_POOL_TAG, BOOTING_TAG)
+        return inventory.tagged(config.WARM_POOL_TAG)
+
+    @contextlib.contextmanager
+    def fill_lease(self):
+        """
+        Yield True if no other fill runs on this host.
+        """
+        leases = self.nodectl.leases
+        if not leases:
+            # NOTE: without it a fill of another process would take our booting workers for leftovers
+            raise LeasesRequiredError("warm pool fill")
+        if not fill_lock.acquire(blocking=False):
+            yield False
+            return
+        try:
+            values = leases.acquire("warm_pool",
+                                    1,
+                                    lambda i: "fill",
+                                    ttl=config.WARM_POOL_FILL_TTL)
+            try:
+                yield bool(values)
+            finally:
+                if values:
+                    leases.release("warm_pool", values)
+        finally:
+            fill_lock.release()
+
+    def delete(self, vm_ids):
+        nodectl = self.nodectl
+        log = self.log
+        inventory = nodectl.inventory()
+        existing = inventory.ids()
+        vm_ids = [x for x in vm_ids if int(x) in existing]
+        if not vm_ids:
+            return
+        log.info("warm_pool", "delete", vm_ids)
+        for r in self.vmservice.delete_vms(vm_ids, inventory=inventory):
+            if r["error"]:
+                log.error("warm_pool", "delete", r["vm_id"], r["error"])
+
+    def fill(self, warm_pool_size=0, **kwargs):
+        """
+        Create the missing warm workers, one fill at a time.
+        """
+        nodectl = self.nodectl
+        log = self.log
+        with self.fill_lease() as leased:
+            if not leased:
+                log.info("warm_pool", "another fill is running")
+                return []
+            inventory = nodectl.inventory()
+            current = len(self.list_warm(inventory))
+            # NOTE: no other fill runs, so booting workers are leftovers of a failed one
+            stale = [vm["vmid"] for vm in inventory.tagged(BOOTING_TAG)]
+            missing = warm_pool_size - current
+            log.debug("warm_pool", "size", warm_pool_size, "current", current,
+                      "stale", stale)
+            metrics.warm_pool_size.set(current)
+            if stale:
+                self.delete(stale)
+            if missing <= 0:
+                return []
+            results = self.workerservice.create_workers(
+                missing,
+                tags=";".join([config.WORKER_TAG, BOOTING_TAG]),
+                join=False,
+                **kwargs)
+            for r in results:
+                if r["error"]:
+                    continue
+                try:
+                    nodectl.vmctl(r["vm_id"]).update_config(tags=";".join(
+                        [config.WORKER_TAG, config.WARM_POOL_TAG]))
+                except Exception as err:
+                    log.error("warm_pool", "tag", r["vm_id"], err)
+                    r["error"] = err
+            failed = [r["vm_id"] for r in results if r["error"]]
+            if failed:
+                self.delete(failed)
+            metrics.warm_pool_size.set(current + len(results) - len(failed))
+            log.info("warm_pool", "filled",
+                     [r["vm_id"] for r in results if not r["error"]])
+            return results
+
+    def refill_in_background(self, warm_pool_size=0, **kwargs):
+        """
+        Not a daemon thread, a refill killed at exit would leave booting workers behind.
+        """
+        log = self.log
+
+        def refill():
+            try:
+                self.fill(warm_pool_size, **kwargs)
+            except Exception as err:
+                log.error("warm_pool", "refill", err)
+
+        log.info("warm_pool", "refill in the background")
+        thread = threading.Thread(target=refill,
+                                  name="warm-pool-refill",
+                                  daemon=False)
+        thread.start()
+        return thread
+
+    def claim(self):
+        """
+        Take one ready worker out of the pool, None if the pool is empty.
+        """
+        nodectl = self.nodectl
+        log = self.log
+        for vm in self.list_warm():
+            if vm.get("status") != "running":
+                continue
+            vm_id = vm["vmid"]
+            vmctl = nodectl.vmctl(vm_id)
+            r = vmctl.current_config()
+            tags = util.ProxmoxUtil.split_tags(r.get("tags", None))
+            if config.WARM_POOL_TAG not in tags:
+                continue
+            tags.remove(config.WARM_POOL_TAG)
+            try:
+                if tags:
+                    vmctl.update_config(tags=";".join(tags),
+                                        digest=r["digest"])
+                else:
+                    vmctl.update_config(delete="tags", digest=r["digest"])
+            except ResourceException as err:
+                log.debug("warm_pool", "claim", vm_id, err)
+                continue
+            log.info("warm_pool", "claimed", vm_id)
+            return vm_id
+        return None
+
+    def create_worker(self,
+                      control_plane_vm_id: int,
+                      warm_pool_size=0,
+                      **kwargs):
+        """
+        Join a worker of the pool, or a new one, then refill the pool.
+        """
+        workerservice = self.workerservice
+        log = self.log
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                join_cmd_future = workerservice.prefetch_join_command(
+                    executor, control_plane_vm_id)
+                vm_id = self.claim()
+                if not vm_id:
+                    return workerservice.create_worker(
+                        control_plane_vm_id=control_plane_vm_id,
+                        join_cmd_future=join_cmd_future,
+                        **kwargs)
+                try:
+                    workerservice.join_worker(vm_id,
+                                              control_plane_vm_id,
+                                              join_cmd_future=join_cmd_future)
+                except Exception as err:
+                    # NOTE: a half joined vm must not go back to the pool
+                    log.error("warm_pool", "join", vm_id, err)
+                    self.delete([vm_id])
+                    raise
+                return vm_id
+        finally:
+            self.refill_in_background(warm_pool_size,
+                                      control_plane_vm_id=control_plane_vm_id,
+                                      **kwargs)
@@ -0,0 +1,223 @@
+from typing import List
+from app.controller.node import NodeController
+from app.controller.inventory import Inventory
+from app.service.ctlpl import ControlPlaneService
+from app.service.lb import LbService
+from app.service.worker import WorkerService
+from app.logger import Logger
+from app.error import *
+from app import config
+from app import util
+
+ROLE_TAGS = {
+    "lb": config.LB_TAG,
+    "control-plane": config.CONTROL_PLANE_TAG,
+    "worker": config.WORKER_TAG,
+}
+
+SPEC_KEYS = ["load_balancer", "control_plane_count", "worker_count"]
+
+
+class ReconcileService:
+    """
+    Example: {"control_plane_count": 1, "worker_count": 2, "load_balancer": false}
+    """
+
+    def __init__(self, nodectl: NodeController, log=Logger.DEBUG) -> None:
+        self.nodectl = nodectl
+        self.log = log
+
+    def current_state(self, inventory: Inventory, configured_ids={}):
+        """
+        Return {role: [vm ids]}, configured ids first, then by id.
+        """
+        state = {role: [] for role in ROLE_TAGS}
+        configured = {
+            int(vm_id): role
+            for role, vm_id in configured_ids.items() if vm_id
+        }
+        warm_tags = set(
+            [config.WARM_POOL_TAG, config.WARM_POOL_TAG + "-booting"])
+        for vm in inventory.managed_vms():
+            vm_id = int(vm["vmid"])
+            tags = util.ProxmoxUtil.split_tags(vm.get("tags", None))
+            if vm_id in configured:
+                state[configured[vm_id]].append(vm_id)
+                continue
+            if warm_tags.intersection(tags):
+                continue
+            for role, tag in ROLE_TAGS.items():
+                if tag in tags:
+                    state[role].append(vm_id)
+        for role in state:
+            state[role].sort(key=lambda x: (x not in configured, x))
+        return state
+
+    @staticmethod
+    def check_spec(cluster_spec: dict):
+        """
+        Every count is required, a missing one must not plan the deletion of every vm of its role.
+        """
+        missing = [x for x in SPEC_KEYS if x not in cluster_spec]
+        if missing:
+            raise InvalidClusterSpec(f"missing {', '.join(missing)}")
+
+    def plan(self,
+             cluster_spec: dict,
+             vm_network_name: str,
+             preserved_ips=[],
+             vm_id_range=[0, 9999],
+             control_plane_vm_id=None,
+             load_balancer_vm_id=None,
+             inventory: Inventory = None,
+             **kwargs):
+        """
+        Return the steps that bring the current state to cluster_spec, the new ids and ips are not leased.
+        """
+        nodectl = self.nodectl
+        log = self.log
+        ReconcileService.check_spec(cluster_spec)
+        want_lb = 1 if cluster_spec["load_balancer"] else 0
+        want_cp = cluster_spec["control_plane_count"]
+        want_wk = cluster_spec["worker_count"]
+        if want_cp > 1 and not want_lb:
+            raise ValueError("multiple control planes need a load balancer")
+
+        inventory = inventory or nodectl.inventory()
+        state = self.current_state(inventory, {
+            "control-plane": control_plane_vm_id,
+            "lb": load_balancer_vm_id
+        })
+        log.debug("reconcile", "state", state)
+
+        create_count = max(want_lb - len(state["lb"]), 0) + max(
+            want_cp - len(state["control-plane"]), 0) + max(
+                want_wk - len(state["worker"]), 0)
+        new_ids = []
+        new_ips = []
+        if create_count:
+            ip_pool, _, preserved_ips = nodectl.vm_network(
+                vm_network_name, preserved_ips)
+            new_ids = nodectl.new_vm_ids(create_count,
+                                         vm_id_range,
+                                         inventory=inventory,
+                                         reserve=False)
+            new_ips = nodectl.new_vm_ips(create_count,
+                                         ip_pool,
+                                         preserved_ips,
+                                         inventory=inventory,
+                                         reserve=False)
+
+        steps = []
+
+        def add(action, role, vm_id, deps=[]):
+            vm_ip = None
+            if action == "create":
+                vm_id = new_ids.pop(0)
+                vm_ip = new_ips.pop(0)
+            step = {
+                "name": f"{action} {role} {vm_id}",
+                "action": action,
+                "role": role,
+                "vm_id": vm_id,
+                "vm_ip": vm_ip,
+                "deps": list(deps),
+            }
+            steps.append(step)
+            return step["name"]
+
+        # SECTION: deletions, workers are drained before the control planes go away
+        wk_deletes = [
+            add("delete", "worker", x)
+            for x in reversed(state["worker"][want_wk:])
+        ]
+        # NOTE: one etcd member leaves at a time
+        cp_deletes = []
+        for x in reversed(state["control-plane"][want_cp:]):
+            cp_deletes = [
+                add("delete", "control-plane", x, wk_deletes + cp_deletes)
+            ]
+        for x in state["lb"][want_lb:]:
+            add("delete", "lb", x, cp_deletes)
+
+        # SECTION: creations, control planes join one by one, workers only wait for the first one
+        lb_deps = []
+        if want_lb and not state["lb"]:
+            lb_deps = [add("create", "lb", None)]
+        first_cp_deps = []
+        previous = lb_deps
+        for i in range(len(state["control-plane"]), want_cp):
+            previous = [add("create", "control-plane", None, previous)]
+            if not first_cp_deps:
+                first_cp_deps = previous
+        wk_deps = [] if state["control-plane"] else first_cp_deps
+        for i in range(len(state["worker"]), want_wk):
+            add("create", "worker", None, wk_deps)
+        return steps
+
+    def apply(self,
+              steps: List[dict],
+              concurrency=config.PROVISION_CONCURRENCY,
+              control_plane_vm_id=None,
+              load_balancer_vm_id=None,
+              inventory: Inventory = None,
+              **kwargs):
+        """
+        Return {step name: {"result", "error"}}, the ids and ips of the create steps are leased first.
+        """
+        nodectl = self.nodectl
+        log = self.log
+        inventory = inventory or nodectl.inventory()
+        state = self.current_state(inventory, {
+            "control-plane": control_plane_vm_id,
+            "lb": load_balancer_vm_id
+        })
+        deleted = set(x["vm_id"] for x in steps if x["action"] == "delete")
+        kept_cps = [x for x in state["control-plane"] if x not in deleted]
+        kept_lbs = [x for x in state["lb"] if x not in deleted]
+        context = {
+            "control-plane": kept_cps[0] if kept_cps else None,
+            "lb": kept_lbs[0] if kept_lbs else None,
+        }
+
+        def run(step):
+            role = step["role"]
+            vm_id = step["vm_id"]
+            params = dict(kwargs)
+            params["control_plane_vm_id"] = context["control-plane"]
+            params["load_balancer_vm_id"] = context["lb"]
+            if step["action"] == "create":
+                params["reserved_vm_id"] = vm_id
+                params["reserved_vm_ip"] = step["vm_ip"]
+            log.info("reconcile", step["name"])
+            if step["action"] == "create" and role == "lb":
+                context["lb"] = LbService(nodectl, log=log).create_lb(**params)
+                return context["lb"]
+            if step["action"] == "create" and role == "control-plane":
+                new_vm_id = ControlPlaneService(
+                    nodectl, log=log).create_control_plane(**params)
+                if not context["control-plane"]:
+                    context["control-plane"] = new_vm_id
+                return new_vm_id
+            if step["action"] == "create" and role == "worker":
+                return WorkerService(nodectl, log=log).create_worker(**params)
+            if role == "worker":
+                return WorkerService(nodectl,
+                                     log=log).delete_worker(vm_id, **params)
+            if role == "control-plane":
+                return ControlPlaneService(nodectl,
+                                           log=log).delete_control_plane(
+                                               vm_id, **params)
+            vmctl = nodectl.vmctl(vm_id)
+            vmctl.shutdown().wait()
+            vmctl.delete().wait()
+            return vm_id
+
+        creates = [x for x in steps if x["action"] == "create"]
+        nodectl.claim_leases([x["vm_id"] for x in creates],
+                             [x["vm_ip"] for x in creates])
+        results = util.run_graph(steps, run, concurrency=concurrency, log=log)
+        failed = [x for x in creates if results[x["name"]]["error"]]
+        nodectl.release_leases([x["vm_id"] for x in failed],
+                               [x["vm_ip"] for x in failed])
+        return results
@@ -0,0 +1,143 @@
+import time
+import threading
+
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from app.controller.node import NodeController
+from app.controller.cluster import PowerWatcher
+from app.controller.inventory import Inventory
+from app.poll import Backoff
+from app.logger import Logger
+from app.error import *
+from app import config
+from app import metrics
+from app import trace
+
+
+class VmService:
+
+    def __init__(self, nodectl: NodeController, log=Logger.DEBUG) -> None:
+        self.nodectl = nodectl
+        self.log = log
+
+    def delete_vms(self,
+                   vm_ids: List[int],
+                   concurrency=config.DELETE_CONCURRENCY,
+                   max_unavailable=None,
+                   shutdown_timeout=config.DELETE_SHUTDOWN_TIMEOUT,
+                   before_shutdown=None,
+                   inventory: Inventory = None):
+        """
+        Return one {"vm_id", "error", "duration"} per vm.
+        """
+        nodectl = self.nodectl
+        log = self.log
+        budget = threading.Semaphore(max(1, max_unavailable or concurrency))
+        watcher = PowerWatcher(nodectl.api, log=log)
+        # NOTE: also tells every vm controller the node of its vm
+        inventory = inventory or nodectl.inventory()
+
+        def delete(vm_id):
+            result = {"vm_id": vm_id, "error": None, "duration": None}
+            started_at = time.monotonic()
+            try:
+                vm = inventory.find(vm_id)
+                with budget, trace.span("delete_vm", vm_id=vm_id):
+                    if before_shutdown:
+                        before_shutdown(vm_id)
+                    vmctl = nodectl.vmctl(vm_id)
+                    if vm.get("status") != "stopped":
+                        vmctl.shutdown(timeout=shutdown_timeout,
+                                       force_stop=True)
+                    if not watcher.wait_stopped(vm_id,
+                                                timeout=shutdown_timeout + 60):
+                        raise TimeoutError(f"{vm_id} did not stop")
+                    vmctl.delete().wait()
+            except Exception as err:
+                log.error("delete_vm", vm_id, err)
+                result["error"] = err
+            result["duration"] = round(time.monotonic() - started_at, 1)
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            return list(pool.map(delete, vm_ids))
+
+    def exec_vms(self,
+                 vm_ids: List[int],
+                 cmd: List[str],
+                 concurrency=config.EXEC_CONCURRENCY,
+                 timeout=config.TIMEOUT,
+                 max_interval=None,
+                 on_result=None):
+        """
+        Return one {"vm_id", "exitcode", "stdout", "stderr", "error", "duration"} per vm.
+        """
+        nodectl = self.nodectl
+        log = self.log
+        results = {}
+        pending = {}
+        # NOTE: also tells every vm controller the node of its vm
+        nodectl.inventory()
+
+        def done(result):
+            results[result["vm_id"]] = result
+            if on_result:
+                on_result(result)
+
+        def start(vm_id):
+            started_at = time.monotonic()
+            vmctl = nodectl.vmctl(vm_id)
+            return vmctl, vmctl.exec_start(cmd), started_at
+
+        def check(item):
+            vm_id, (vmctl, pid, started_at) = item
+            try:
+                return vmctl.exec_status(pid), None
+            except Exception as err:
+                return None, err
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = [(vm_id, pool.submit(start, vm_id)) for vm_id in vm_ids]
+            for vm_id, future in futures:
+                try:
+                    pending[vm_id] = future.result()
+                except Exception as err:
+                    log.error("exec_vms", vm_id, err)
+                    done({
+                        "vm_id": vm_id,
+                        "exitcode": None,
+                        "stdout": None,
+                        "stderr": None,
+                        "error": err,
+                        "duration": 0,
+                    })
+            backoff = Backoff(
+                max_interval=max_interval or config.POLL_MAX_INTERVAL)
+            while pending:
+                time.sleep(backoff.next())
+                items = list(pending.items())
+                for (vm_id, (vmctl, pid, started_at)), (status, err) in zip(
+                        items, pool.map(check, items)):
+                    duration = round(time.monotonic() - started_at, 1)
+                    if err:
+                        log.debug("exec_vms", vm_id, pid, err)
+                    if status:
+                        err = None
+                    elif duration < timeout:
+                        # NOTE: a failing exec-status is retried until the timeout
+                        continue
+                    else:
+                        err = TimeoutError(f"{vm_id} exec {pid} timeout")
+                        metrics.timeouts.inc(op="exec")
+                        log.error("exec_vms", vm_id, err)
+                        status = {}
+                    del pending[vm_id]
+                    done({
+                        "vm_id": vm_id,
+                        "exitcode": status.get("exitcode", None),
+                        "stdout": status.get("out-data", None),
+                        "stderr": status.get("err-data", None),
+                        "error": err,
+                        "duration": duration,
+                    })
+        return [results[vm_id] for vm_id in vm_ids]
@@ -1,10 +1,16 @@
 import os
-import ipaddress
 
+from concurrent.futures import ThreadPoolExecutor
 from app.controller.node import NodeController
+from app.controller.kube import KubeApiController
+from app.service.vm import VmService
 from app.logger import Logger
 from app.error import *
+from app import config
+from app import metrics
+from app import trace
 from app import util
+from app import cloudinit
 
 
 class WorkerService:
@@ -14,52 +20,294 @@ class WorkerService:
         self.log = log
         pass
 
-    def create_worker(self,
-                      vm_network_name: str,
-                      worker_template_id: int,
-                      control_plane_vm_id: int,
-                      preserved_ips=[],
-                      vm_id_range=[0, 9999],
-                      vm_name_prefix="i-",
-                      vm_username="u",
-                      vm_password="1",
-                      vm_ssh_keys=None,
-                      **kwargs):
+    @trace.traced("provision_worker", vm_id_arg="new_vm_id")
+    def _provision_worker(self,
+                          new_vm_id: int,
+                          new_vm_ip: str,
+                          network_gw_ip: str,
+                          vm_network_name: str,
+                          worker_template_id: int,
+                          control_plane_vm_id: int,
+                          vm_name_prefix="i-",
+                          vm_username="u",
+                          vm_password="1",
+                          vm_ssh_keys=None,
+                          clone_strategy=config.CLONE_STRATEGY,
+                          clone_storage=None,
+                          tags=config.WORKER_TAG,
+                          join=True,
+                          network_prefixlen=24,
+                          join_cmd_future=None,
+                          join_mode=config.JOIN_MODE,
+                          snippets_storage=config.SNIPPETS_STORAGE,
+                          snippets_dir=config.SNIPPETS_DIR):
+        """
+        join_mode "exec" or "cloud-init".
+        """
         nodectl = self.nodectl
         log = self.log
-        r = nodectl.describe_network(vm_network_name)
-        network_interface = ipaddress.IPv4Interface(r["cidr"])
-        network_gw_ip = str(network_interface.ip) or r["address"]
-        vm_network = network_interface.network
-        ip_pool = []
-        for ip in vm_network.hosts():
-            ip_pool.append(str(ip))
-        preserved_ips.append(network_gw_ip)
-        log.debug("preserved_ips", preserved_ips)
-
-        new_vm_id = nodectl.new_vm_id(vm_id_range)
-        new_vm_ip = nodectl.new_vm_ip(ip_pool, preserved_ips)
+        if join_mode not in ["exec", "cloud-init"]:
+            raise InvalidJoinMode(join_mode)
         new_vm_name = f"{vm_name_prefix}{new_vm_id}"
-        nodectl.clone(worker_template_id, new_vm_id)
+        target = nodectl.place(worker_template_id,
+                               new_vm_id,
+                               storage=clone_storage)
+        if join and join_mode == "cloud-init":
+            nodectl.check_snippets_storage(
+                target or nodectl.locate(worker_template_id), snippets_storage,
+                snippets_dir)
+        nodectl.clone(worker_template_id,
+                      new_vm_id,
+                      strategy=clone_strategy,
+                      storage=clone_storage,
+                      target=target).wait()
 
         wkctl = nodectl.wkctl(new_vm_id)
-        wkctl.update_config(
+        params = dict(
             name=new_vm_name,
             ciuser=vm_username,
             cipassword=vm_password,
             sshkeys=util.ProxmoxUtil.encode_sshkeys(vm_ssh_keys),
             agent="enabled=1,fstrim_cloned_disks=1",
             net0=f"virtio,bridge={vm_network_name}",
-            ipconfig0=f"ip={new_vm_ip}/24,gw={network_gw_ip}",
+            ipconfig0=f"ip={new_vm_ip}/{network_prefixlen},gw={network_gw_ip}",
         )
+        if tags:
+            params["tags"] = tags
+
+        if join and join_mode == "cloud-init":
+            join_cmd = self._resolve_join_command(control_plane_vm_id,
+                                                  join_cmd_future)
+            snippet = f"kp-join-{new_vm_id}.yaml"
+            cloudinit.write_snippet(
+                snippets_dir, snippet,
+                cloudinit.render_join_user_data(new_vm_name, vm_username,
+                                                vm_password, vm_ssh_keys,
+                                                join_cmd))
+            params["cicustom"] = f"user={snippets_storage}:snippets/{snippet}"
+            try:
+                wkctl.update_config(**params)
+                wkctl.resize_disk(disk="scsi0", size="+20G")
+                wkctl.startup().wait()
+                KubeApiController.from_credentials(
+                    util.KubeUtil.parse_join_command(" ".join(join_cmd)),
+                    log=log).wait_for_node(new_vm_name)
+            except Exception:
+                if nodectl.join_cache:
+                    # NOTE: a stale cached token would fail every following join too
+                    nodectl.join_cache.invalidate(
+                        nodectl.join_cache_key(control_plane_vm_id))
+                raise
+            finally:
+                # NOTE: the vm can not start with a missing snippet, drop the reference before the file
+                try:
+                    wkctl.update_config(delete="cicustom")
+                except Exception as err:
+                    log.error(new_vm_id, "delete cicustom", err)
+                cloudinit.remove_snippet(snippets_dir, snippet)
+            return new_vm_id
+
+        wkctl.update_config(**params)
         wkctl.resize_disk(disk="scsi0", size="+20G")
-        wkctl.startup()
+        wkctl.startup().wait()
         wkctl.wait_for_guest_agent()
-        join_cmd = nodectl.ctlplvmctl(
-            control_plane_vm_id).kubeadm().create_join_command()
-        wkctl.exec(join_cmd)
+        if join:
+            self.join_worker(new_vm_id,
+                             control_plane_vm_id,
+                             join_cmd_future=join_cmd_future)
         return new_vm_id
 
+    def prefetch_join_command(self, executor, control_plane_vm_id):
+        """
+        Start creating the join command on the executor, so it is ready by the time the worker boots.
+        """
+        nodectl = self.nodectl
+        if not control_plane_vm_id:
+            return None
+        return executor.submit(nodectl.join_command, control_plane_vm_id)
+
+    def _resolve_join_command(self, control_plane_vm_id, join_cmd_future=None):
+        nodectl = self.nodectl
+        log = self.log
+        if join_cmd_future:
+            try:
+                return join_cmd_future.result()
+            except Exception as err:
+                # NOTE: the prefetch is an optimization, retry on the critical path
+                log.error("prefetch join_cmd", control_plane_vm_id, err)
+        return nodectl.join_command(control_plane_vm_id)
+
+    @trace.traced(vm_id_arg="vm_id")
+    def join_worker(self, vm_id, control_plane_vm_id, join_cmd_future=None):
+        nodectl = self.nodectl
+        log = self.log
+        join_cmd = self._resolve_join_command(control_plane_vm_id,
+                                              join_cmd_future)
+        wkctl = nodectl.wkctl(vm_id)
+        exitcode, stdout, stderr = wkctl.exec(join_cmd)
+        if exitcode != 0 and nodectl.join_cache:
+            # NOTE: the cached token may be gone, e.g. deleted or the control plane was recreated
+            log.error("join", vm_id, "retry with new credentials", stderr)
+            metrics.retries.inc(op="join")
+            nodectl.join_cache.invalidate(
+                nodectl.join_cache_key(control_plane_vm_id))
+            join_cmd = nodectl.join_command(control_plane_vm_id)
+            exitcode, stdout, stderr = wkctl.exec(join_cmd)
+        if exitcode != 0:
+            raise JoinFailedError(vm_id, exitcode, stderr)
+        return exitcode, stdout, stderr
+
+    def create_worker(self,
+                      vm_network_name: str,
+                      worker_template_id: int,
+                      control_plane_vm_id: int,
+                      preserved_ips=[],
+                      vm_id_range=[0, 9999],
+                      vm_name_prefix="i-",
+                      vm_username="u",
+                      vm_password="1",
+                      vm_ssh_keys=None,
+                      clone_strategy=config.CLONE_STRATEGY,
+                      clone_storage=None,
+                      join_mode=config.JOIN_MODE,
+                      snippets_storage=config.SNIPPETS_STORAGE,
+                      snippets_dir=config.SNIPPETS_DIR,
+                      reserved_vm_id=None,
+                      reserved_vm_ip=None,
+                      join_cmd_future=None,
+                      **kwargs):
+        """
+        The join command is prepared while the worker clones and boots.
+        """
+        nodectl = self.nodectl
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            join_cmd_future = join_cmd_future or self.prefetch_join_command(
+                executor, control_plane_vm_id)
+            network_future = executor.submit(nodectl.vm_network,
+                                             vm_network_name, preserved_ips)
+            inventory_future = None
+            if not reserved_vm_id or not reserved_vm_ip:
+                inventory_future = executor.submit(nodectl.inventory)
+            ip_pool, network_gw_ip, preserved_ips = network_future.result()
+
+            new_vm_id = reserved_vm_id
+            new_vm_ip = reserved_vm_ip
+            if inventory_future:
+                inventory = inventory_future.result()
+                new_vm_id = new_vm_id or nodectl.new_vm_id(vm_id_range,
+                                                           inventory=inventory)
+                new_vm_ip = new_vm_ip or nodectl.new_vm_ip(
+                    ip_pool, preserved_ips, inventory=inventory)
+            try:
+                return self._provision_worker(
+                    new_vm_id,
+                    new_vm_ip,
+                    network_gw_ip,
+                    vm_network_name,
+                    worker_template_id,
+                    control_plane_vm_id,
+                    vm_name_prefix=vm_name_prefix,
+                    vm_username=vm_username,
+                    vm_password=vm_password,
+                    vm_ssh_keys=vm_ssh_keys,
+                    clone_strategy=clone_strategy,
+                    clone_storage=clone_storage,
+                    network_prefixlen=ip_pool.network.prefixlen,
+                    join_cmd_future=join_cmd_future,
+                    join_mode=join_mode,
+                    snippets_storage=snippets_storage,
+                    snippets_dir=snippets_dir)
+            except Exception:
+                # NOTE: the reserved ones belong to the caller
+                nodectl.release_leases(
+                    [new_vm_id] if new_vm_id != reserved_vm_id else [],
+                    [new_vm_ip] if new_vm_ip != reserved_vm_ip else [])
+                raise
+
+    def create_workers(self,
+                       count: int,
+                       vm_network_name: str,
+                       worker_template_id: int,
+                       control_plane_vm_id: int,
+                       concurrency=config.PROVISION_CONCURRENCY,
+                       preserved_ips=[],
+                       vm_id_range=[0, 9999],
+                       vm_name_prefix="i-",
+                       vm_username="u",
+                       vm_password="1",
+                       vm_ssh_keys=None,
+                       clone_strategy=config.CLONE_STRATEGY,
+                       clone_storage=None,
+                       join_mode=config.JOIN_MODE,
+                       snippets_storage=config.SNIPPETS_STORAGE,
+                       snippets_dir=config.SNIPPETS_DIR,
+                       tags=config.WORKER_TAG,
+                       join=True,
+                       **kwargs):
+        """
+        Return one {"vm_id", "vm_ip", "error"} per worker.
+        """
+        nodectl = self.nodectl
+        log = self.log
+        with ThreadPoolExecutor(max_workers=2) as prefetch:
+            join_cmd_future = None
+            if join:
+                join_cmd_future = self.prefetch_join_command(
+                    prefetch, control_plane_vm_id)
+            network_future = prefetch.submit(nodectl.vm_network,
+                                             vm_network_name, preserved_ips)
+            inventory = nodectl.inventory()
+            ip_pool, network_gw_ip, preserved_ips = network_future.result()
+            new_vm_ids = nodectl.new_vm_ids(count,
+                                            vm_id_range,
+                                            inventory=inventory)
+            new_vm_ips = nodectl.new_vm_ips(count,
+                                            ip_pool,
+                                            preserved_ips,
+                                            inventory=inventory)
+
+            def provision(new_vm_id, new_vm_ip):
+                result = {
+                    "vm_id": new_vm_id,
+                    "vm_ip": new_vm_ip,
+                    "error": None
+                }
+                try:
+                    self._provision_worker(
+                        new_vm_id,
+                        new_vm_ip,
+                        network_gw_ip,
+                        vm_network_name,
+                        worker_template_id,
+                        control_plane_vm_id,
+                        vm_name_prefix=vm_name_prefix,
+                        vm_username=vm_username,
+                        vm_password=vm_password,
+                        vm_ssh_keys=vm_ssh_keys,
+                        clone_strategy=clone_strategy,
+                        clone_storage=clone_storage,
+                        tags=tags,
+                        join=join,
+                        network_prefixlen=ip_pool.network.prefixlen,
+                        join_cmd_future=join_cmd_future,
+                        join_mode=join_mode,
+                        snippets_storage=snippets_storage,
+                        snippets_dir=snippets_dir)
+                except Exception as err:
+                    log.error("create_worker", new_vm_id, new_vm_ip, err)
+                    result["error"] = err
+                return result
+
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+                results = list(pool.map(provision, new_vm_ids, new_vm_ips))
+            failed = [r for r in results if r["error"]]
+            if failed:
+                # NOTE: no need to wait for the ttl, a vm left behind keeps its id and ip taken
+                nodectl.release_leases([r["vm_id"] for r in failed],
+                                       [r["vm_ip"] for r in failed])
+            return results
+
+    @trace.traced(vm_id_arg="vm_id")
     def delete_worker(self,
                       vm_id,
                       control_plane_vm_id,
@@ -80,7 +328,39 @@ class WorkerService:
                 log.error(err)
 
         vmctl = nodectl.vmctl(vm_id)
-        vmctl.shutdown()
-        vmctl.wait_for_shutdown()
-        vmctl.delete()
+        vmctl.shutdown().wait()
+        vmctl.delete().wait()
         return vm_id
+
+    def delete_workers(self,
+                       vm_ids,
+                       control_plane_vm_id,
+                       drain_first=True,
+                       concurrency=config.DELETE_CONCURRENCY,
+                       max_unavailable=None,
+                       **kwargs):
+        """
+        Return one result per worker, see VmService.delete_vms.
+        """
+        nodectl = self.nodectl
+        log = self.log
+        inventory = nodectl.inventory()
+
+        def drain(vm_id):
+            if not control_plane_vm_id:
+                return
+            vm_name = inventory.find(vm_id)["name"]
+            ctlplctl = nodectl.ctlplvmctl(control_plane_vm_id)
+            try:
+                if drain_first:
+                    ctlplctl.drain_node(vm_name)
+                ctlplctl.delete_node(vm_name)
+            except Exception as err:
+                log.error(err)
+
+        return VmService(nodectl,
+                         log=log).delete_vms(vm_ids,
+                                             concurrency=concurrency,
+                                             max_unavailable=max_unavailable,
+                                             before_shutdown=drain,
+                                             inventory=inventory)
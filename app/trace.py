@@ -0,0 +1,213 @@
+import os
+import re
+import json
+import time
+import atexit
+import inspect
+import threading
+import functools
+
+from typing import List, Mapping
+from app import config
+from app import metrics
+
+
+class Span:
+
+    def __init__(self, tracer, name: str, args: dict) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __exit__(self, exc_type, exc, tb):
+        outcome = "ok" if exc_type is None else f"{exc_type.__name__}: {exc}"
+        self.tracer.record(self.name,
+                           self.started_at,
+                           time.time() - self.started_at,
+                           outcome=outcome,
+                           **self.args)
+        return False
+
+
+class NoopSpan:
+
+    def __enter__(self):
+        return self
+
+    def set(self, **args):
+        pass
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer:
+    """
+    Spans and proxmox http call timings, in the Chrome trace format.
+    """
+
+    def __init__(self, enabled=False) -> None:
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.events: List[dict] = []
+        # NOTE: "GET nodes/{node}/qemu/{id}/agent/exec-status" -> [count, total seconds]
+        self.http_calls: Mapping[str, list] = {}
+
+    def span(self, name: str, **args):
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, args)
+
+    def record(self, name: str, started_at: float, duration: float, **args):
+        event = {
+            "name": name,
+            "cat": args.pop("cat", "kp"),
+            "ph": "X",
+            "ts": int(started_at * 1e6),
+            "dur": int(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def record_http(self, method: str, url: str, status: int, duration: float):
+        path = http_path(url)
+        key = f"{method} {path}"
+        with self.lock:
+            calls = self.http_calls.setdefault(key, [0, 0.0])
+            calls[0] += 1
+            calls[1] += duration
+        self.record(key,
+                    time.time() - duration,
+                    duration,
+                    cat="http",
+                    status=status)
+
+    def instrument_session(self, session):
+        """
+        Time every request of a requests session, e.g. the one of a ProxmoxAPI.
+        """
+
+        def on_response(r, *args, **kwargs):
+            if self.enabled:
+                self.record_http(r.request.method, r.request.url,
+                                 r.status_code, r.elapsed.total_seconds())
+
+        session.hooks["response"].append(on_response)
+
+    def export(self):
+        with self.lock:
+            events = list(self.events)
+            http_calls = {
+                k: {
+                    "count": v[0],
+                    "seconds": round(v[1], 3)
+                }
+                for k, v in self.http_calls.items()
+            }
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "http_calls": http_calls
+            },
+        }
+
+    def write(self, filepath: str):
+        with open(filepath, "w", encoding="utf-8") as f:
+            json.dump(self.export(), f, default=str)
+
+
+def http_path(url: str):
+    """
+    Example: https://pve:8006/api2/json/nodes/pve/qemu/101/agent/exec -> nodes/{node}/qemu/{id}/agent/exec
+    """
+    path = url.split("?")[0].split("/api2/json/", 1)[-1]
+    path = re.sub(r"^nodes/[^/]+", "nodes/{node}", path)
+    path = re.sub(r"/UPID:[^/]+", "/{upid}", path)
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+tracer = Tracer(enabled=bool(config.TRACE_FILE))
+
+if config.TRACE_FILE:
+    atexit.register(lambda: tracer.write(config.TRACE_FILE))
+
+
+def span(name: str, **args):
+    return tracer.span(name, **args)
+
+
+def traced(name: str = None, vm_id_arg: str = None):
+    """
+    Record every call as a span and in kp_phase_duration_seconds.
+    """
+
+    def decorator(fn):
+        span_name = name or fn.__name__
+        signature = inspect.signature(fn)
+
+        def span(self, args, kwargs):
+            if not tracer.enabled:
+                return NOOP_SPAN
+            span_args = {}
+            for attr in ["vm_id", "node", "upid"]:
+                if hasattr(self, attr):
+                    span_args[attr] = getattr(self, attr)
+            if vm_id_arg:
+                bound = signature.bind_partial(self, *args, **kwargs)
+                span_args["vm_id"] = bound.arguments.get(vm_id_arg)
+            return tracer.span(span_name, **span_args)
+
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(self, *args, **kwargs):
+                started_at = time.monotonic()
+                outcome = "error"
+                try:
+                    with span(self, args, kwargs):
+                        r = await fn(self, *args, **kwargs)
+                    outcome = "ok"
+                    return r
+                finally:
+                    metrics.phase_duration.observe(time.monotonic() -
+                                                   started_at,
+                                                   phase=span_name,
+                                                   outcome=outcome)
+
+            return async_wrapper
+
+        def call(self, *args, **kwargs):
+            with span(self, args, kwargs):
+                return fn(self, *args, **kwargs)
+
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            # NOTE: the phase duration is always observed, it is cheap unlike the spans
+            started_at = time.monotonic()
+            outcome = "error"
+            try:
+                r = call(self, *args, **kwargs)
+                outcome = "ok"
+                return r
+            finally:
+                metrics.phase_duration.observe(time.monotonic() - started_at,
+                                               phase=span_name,
+                                               outcome=outcome)
+
+        return wrapper
+
+    return decorator
@@ -1,7 +1,11 @@
+import re
 import urllib
 import random
 import string
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from app.error import DependencyFailedError
+
 characters = string.ascii_lowercase + string.digits  # includes uppercase letters, lowercase letters, and digits
 
 
@@ -25,6 +29,55 @@ def find_missing(arr: list, existed: set):
     return None
 
 
+def run_graph(steps: list, run, concurrency=4, log=None):
+    """
+    Return {name: {"result", "error"}}, steps whose dependency failed are skipped.
+    """
+    results = {}
+    pending = list(steps)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        while pending or running:
+            changed = True
+            while changed:
+                changed = False
+                for step in list(pending):
+                    deps = step.get("deps", [])
+                    failed = [
+                        d for d in deps
+                        if d in results and results[d]["error"] is not None
+                    ]
+                    if failed:
+                        error = DependencyFailedError(failed[0])
+                        results[step["name"]] = {
+                            "result": None,
+                            "error": error
+                        }
+                        pending.remove(step)
+                        changed = True
+                        continue
+                    if all(d in results for d in deps):
+                        running[pool.submit(run, step)] = step
+                        pending.remove(step)
+            if not running:
+                for step in pending:
+                    error = DependencyFailedError(",".join(step["deps"]))
+                    results[step["name"]] = {"result": None, "error": error}
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    results[step["name"]] = {
+                        "result": future.result(),
+                        "error": None
+                    }
+                except Exception as err:
+                    if log: log.error(step["name"], err)
+                    results[step["name"]] = {"result": None, "error": err}
+    return results
+
+
 def gen_characters(length: int):
     random_string = ''.join(random.choice(characters) for _ in range(length))
     return random_string
@@ -43,8 +96,114 @@ class ProxmoxUtil:
         ip = parts[0]
         return ip
 
+    @staticmethod
+    def split_tags(tags: str):
+        """
+        Example: "kp-warm;k8s" -> ["kp-warm", "k8s"]
+        """
+        if not tags: return []
+        return [x for x in re.split(r"[;, ]", tags) if x]
+
+    @staticmethod
+    def disk_storages(vm_config: dict):
+        """
+        Example: {"scsi0": "local-lvm:base-100-disk-0,size=32G", "ide2": "local:iso/a.iso,media=cdrom"} -> {"local-lvm"}
+        """
+        storages = set()
+        for key, value in vm_config.items():
+            if not re.match(r"^(ide|sata|scsi|virtio|efidisk|tpmstate)\d+$",
+                            key):
+                continue
+            volume = str(value).split(",")[0]
+            # NOTE: a cloud-init drive is a cdrom proxmox copies like a disk
+            if "media=cdrom" in str(value) and "cloudinit" not in volume:
+                continue
+            if ":" in volume:
+                storages.add(volume.split(":")[0])
+        return storages
+
     @staticmethod
     def encode_sshkeys(sshkeys: str):
         if not sshkeys: return None
         # NOTE: https://github.com/proxmoxer/proxmoxer/issues/153
         return urllib.parse.quote(sshkeys, safe="")
+
+
+class KubeUtil:
+    UNITS = {
+        "n": 1e-9,
+        "u": 1e-6,
+        "m": 1e-3,
+        "": 1,
+        "k": 1e3,
+        "M": 1e6,
+        "G": 1e9,
+        "T": 1e12,
+        "P": 1e15,
+        "E": 1e18,
+        "Ki": 2**10,
+        "Mi": 2**20,
+        "Gi": 2**30,
+        "Ti": 2**40,
+        "Pi": 2**50,
+        "Ei": 2**60,
+    }
+    # NOTE: "1E" is exa, "1E3" a decimal exponent
+    QUANTITY = re.compile(
+        r"^([+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))([eE][+-]?[0-9]+|[KMGTPE]i|[numkMGTPE]?)$"
+    )
+
+    @staticmethod
+    def parse_quantity(quantity: str):
+        """
+        Example: "100m" -> 0.1, "1Gi" -> 1073741824, "1e3" -> 1000, raise ValueError on anything else.
+        """
+        if quantity is None or quantity == "": return 0
+        m = KubeUtil.QUANTITY.match(str(quantity).strip())
+        if not m:
+            raise ValueError(f"invalid quantity: {quantity!r}")
+        number, suffix = m.groups()
+        if suffix not in KubeUtil.UNITS:
+            return float(number + suffix)
+        return float(number) * KubeUtil.UNITS[suffix]
+
+    @staticmethod
+    def parse_join_command(join_cmd: str):
+        """
+        Example: "kubeadm join 10.0.0.1:6443 --token abc.def ..." -> {"endpoint", "token", "ca_cert_hash"}
+        """
+        args = join_cmd.split()
+        if len(args) < 3 or args[:2] != ["kubeadm", "join"]:
+            raise ValueError(f"not a kubeadm join command: {join_cmd}")
+        credentials = {"endpoint": args[2]}
+        flags = {
+            "--token": "token",
+            "--discovery-token-ca-cert-hash": "ca_cert_hash",
+        }
+        for i, arg in enumerate(args):
+            if arg in flags and i + 1 < len(args):
+                credentials[flags[arg]] = args[i + 1]
+            elif "=" in arg and arg.split("=", 1)[0] in flags:
+                key, value = arg.split("=", 1)
+                credentials[flags[key]] = value
+        if "token" not in credentials or "ca_cert_hash" not in credentials:
+            raise ValueError(f"no token or ca cert hash in: {join_cmd}")
+        return credentials
+
+    @staticmethod
+    def build_join_command(credentials: dict, is_control_plane=False):
+        join_cmd = [
+            "kubeadm",
+            "join",
+            credentials["endpoint"],
+            "--token",
+            credentials["token"],
+            "--discovery-token-ca-cert-hash",
+            credentials["ca_cert_hash"],
+        ]
+        if is_control_plane:
+            join_cmd.append("--control-plane")
+            if credentials.get("certificate_key"):
+                join_cmd.extend(
+                    ["--certificate-key", credentials["certificate_key"]])
+        return join_cmd
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import shutil
+import socket
 import argparse
+import subprocess
 
 from typing import List, Mapping
 
@@ -89,10 +93,299 @@ class Cmd:
                 child.tree(current_level + 1)
 
 
+INDENT = " " * 2  # two spaces
+ADMIN_SOCKET = "/run/haproxy/admin.sock"
+
+SECTION_KEYWORDS = [
+    "global", "defaults", "frontend", "backend", "listen", "resolvers",
+    "peers", "userlist", "program", "http-errors", "ring", "cache", "mailers"
+]
+
+
+class Section:
+
+    def __init__(self, keyword: str, name: str, header: str) -> None:
+        self.keyword = keyword
+        self.name = name
+        self.header = header
+        self.lines: List[str] = []
+
+    def find_server(self, server_name: str):
+        for i, line in enumerate(self.lines):
+            parts = line.split()
+            if len(parts
+                   ) > 2 and parts[0] == "server" and parts[1] == server_name:
+                return i
+        return None
+
+
+class HaproxyConfig:
+    """
+    The config file parsed once into sections, lines outside the servers are kept as they are.
+    """
+
+    def __init__(self, content: str) -> None:
+        self.head: List[str] = []
+        self.sections: List[Section] = []
+        current = None
+        for line in content.split("\n"):
+            parts = line.split()
+            if parts and not line[0].isspace(
+            ) and parts[0] in SECTION_KEYWORDS:
+                name = parts[1] if len(parts) > 1 else None
+                current = Section(parts[0], name, line)
+                self.sections.append(current)
+                continue
+            if current:
+                current.lines.append(line)
+            else:
+                self.head.append(line)
+
+    def server(self, backend_name: str, server_name: str):
+        """
+        Return the server line split, ["server", NAME, ENDPOINT, OPTS...], None if there is none.
+        """
+        section = self.backend(backend_name)
+        i = section.find_server(server_name)
+        return section.lines[i].split() if i is not None else None
+
+    def backend(self, backend_name: str):
+        for section in self.sections:
+            if section.keyword in ["backend", "listen"
+                                   ] and section.name == backend_name:
+                return section
+        raise KeyError(f"backend \"{backend_name}\" not found")
+
+    def add_server(self,
+                   backend_name: str,
+                   server_name: str,
+                   server_endpoint: str,
+                   opts=["check"]):
+        """
+        Add the server or update its endpoint.
+        Return "add" or "update" if the config changed, None otherwise.
+        """
+        section = self.backend(backend_name)
+        i = section.find_server(server_name)
+        if i is not None:
+            parts = section.lines[i].split()
+            if parts[2] == server_endpoint:
+                return None
+            parts[2] = server_endpoint
+            section.lines[i] = INDENT + " ".join(parts)
+            return "update"
+        end = len(section.lines)
+        while end > 0 and not section.lines[end - 1].strip():
+            end -= 1
+        section.lines.insert(
+            end,
+            INDENT + " ".join(["server", server_name, server_endpoint, *opts]))
+        return "add"
+
+    def rm_server(self, backend_name: str, server_name: str):
+        section = self.backend(backend_name)
+        i = section.find_server(server_name)
+        if i is None:
+            return False
+        section.lines.pop(i)
+        return True
+
+    def dump(self):
+        lines = list(self.head)
+        for section in self.sections:
+            lines.append(section.header)
+            lines.extend(section.lines)
+        return "\n".join(lines).strip() + "\n"
+
+
+def parse_ops(tokens: List[str]):
+    """
+    Example: ["add", "control-plane", "i-121", "10.0.0.21:6443", "rm", "control-plane", "i-122"]
+    "drain BACKEND NAME" only stops new connections to the server through the runtime api,
+    the config is left as it is.
+    """
+    ops = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == "add" and i + 3 < len(tokens):
+            ops.append(tuple(tokens[i:i + 4]))
+            i += 4
+        elif tokens[i] in ["rm", "delete", "drain"] and i + 2 < len(tokens):
+            op = "drain" if tokens[i] == "drain" else "rm"
+            ops.append((op, tokens[i + 1], tokens[i + 2]))
+            i += 3
+        else:
+            raise ValueError(
+                f"invalid operation at \"{' '.join(tokens[i:])}\"")
+    return ops
+
+
+def runtime_command(socket_path: str, command: str):
+    """
+    Send one command to the haproxy runtime api and return its answer.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(10)
+        s.connect(socket_path)
+        s.sendall((command + "\n").encode())
+        chunks = []
+        while True:
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b"".join(chunks).decode().strip()
+
+
+def runtime_commands(op: tuple, change: str, old: List[str] = None):
+    """
+    Return the runtime api commands of one operation, each with the answers that mean success
+    and the commands that undo it, old is the server line before the change.
+    Dynamic servers (add server, del server) need haproxy 2.4 or later, their health checks (check) 2.5.
+    """
+    server = f"{op[1]}/{op[2]}"
+    ready = (f"set server {server} state ready", [""])
+    if op[0] == "drain":
+        return [(f"set server {server} state drain", [""], [ready])]
+    if op[0] == "rm":
+        add_back = []
+        if old:
+            add_back = [
+                (f"add server {server} {' '.join(old[2:])}",
+                 ["New server registered."]),
+                (f"enable health {server}", [""]),
+            ]
+        return [
+            (f"set server {server} state maint", [""], [ready]),
+            # NOTE: closed sessions stay closed
+            (f"shutdown sessions server {server}", [""], []),
+            (f"del server {server}", ["Server deleted."], add_back),
+        ]
+    if change == "update":
+        host, port = op[3].rsplit(":", 1)
+        changed = ["changed", "no need to change"]
+        undo = []
+        if old:
+            old_host, old_port = old[2].rsplit(":", 1)
+            undo = [(f"set server {server} addr {old_host} port {old_port}",
+                     changed)]
+        return [(f"set server {server} addr {host} port {port}", changed, undo)
+                ]
+    return [
+        (f"add server {server} {op[3]} check", ["New server registered."], [
+            (f"set server {server} state maint", [""]),
+            (f"del server {server}", ["Server deleted."]),
+        ]),
+        (f"enable health {server}", [""], []),
+        (f"set server {server} state ready", [""], []),
+    ]
+
+
+def run_runtime(socket_path: str, command: str, answers: List[str]):
+    try:
+        answer = runtime_command(socket_path, command)
+    except OSError as err:
+        print("runtime", command, err, file=sys.stderr)
+        return False
+    if not any(answer == x if x == "" else x in answer for x in answers):
+        print("runtime", command, answer, file=sys.stderr)
+        return False
+    print("runtime", command, "ok")
+    return True
+
+
+def apply_runtime(socket_path: str, commands: List[tuple]):
+    """
+    Return True if every command succeeded, stop at the first one that did not and undo the ones before.
+    Return False once they are undone, None if an undo failed too and haproxy is left half changed.
+    """
+    done = []
+    for command, answers, undo in commands:
+        if not run_runtime(socket_path, command, answers):
+            for command, answers in reversed(done):
+                if not run_runtime(socket_path, command, answers):
+                    return None
+            return False
+        done.extend(undo[::-1])
+    return True
+
+
+def write_new(config_path: str, content: str):
+    new_path = config_path + ".new"
+    with open(new_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    shutil.copymode(config_path, new_path)
+    return new_path
+
+
+def apply_ops(config_path: str,
+              ops: List[tuple],
+              validate=False,
+              reload=False,
+              runtime_socket=None):
+    """
+    Apply every operation on one parse of the file, validate the result with haproxy -c
+    before it replaces the file and reload haproxy once. Return the exit code.
+    With runtime_socket the running haproxy is changed through its runtime api instead,
+    the reload is only the fallback when the runtime api refuses a change,
+    without reload the changes already made are undone and the file is put back so that a retry applies the change again.
+    """
+    with open(config_path, "r", encoding="utf-8") as f:
+        original = f.read()
+    cfg = HaproxyConfig(original)
+    changed = False
+    commands = []
+    for op in ops:
+        if op[0] == "drain":
+            cfg.backend(op[1])
+            commands.extend(runtime_commands(op, None))
+            continue
+        old = cfg.server(op[1], op[2])
+        if op[0] == "add":
+            change = cfg.add_server(op[1], op[2], op[3])
+        else:
+            change = cfg.rm_server(op[1], op[2])
+        print(" ".join(op), "changed" if change else "unchanged")
+        if change:
+            commands.extend(runtime_commands(op, change, old))
+        changed = changed or bool(change)
+
+    if changed:
+        new_path = write_new(config_path, cfg.dump())
+        if validate:
+            r = subprocess.run(["haproxy", "-c", "-f", new_path],
+                               capture_output=True,
+                               text=True)
+            if r.returncode != 0:
+                os.remove(new_path)
+                print(r.stdout, r.stderr, file=sys.stderr)
+                return r.returncode
+        os.replace(new_path, config_path)
+    print("is_need_to_save", changed)
+
+    need_reload = changed
+    if runtime_socket and commands:
+        applied = apply_runtime(runtime_socket, commands)
+        if applied:
+            need_reload = False
+        elif not (reload and changed):
+            if changed:
+                os.replace(write_new(config_path, original), config_path)
+                print("is_need_to_save", False)
+            if applied is None:
+                # NOTE: only a reload of the restored file brings the running haproxy back in line
+                subprocess.run(["systemctl", "reload", "haproxy"])
+            return 1
+    if reload and need_reload:
+        return subprocess.run(["systemctl", "reload", "haproxy"]).returncode
+    return 0
+
+
 class MainCmd(Cmd):
 
     def __init__(self) -> None:
-        super().__init__("config_haproxy.py", childs=[BackendCmd()])
+        super().__init__("config_haproxy.py",
+                         childs=[BackendCmd(), ApplyCmd()])
 
     def _setup(self):
         self.parser.add_argument('-c',
@@ -101,6 +394,44 @@ class MainCmd(Cmd):
                                  default="/etc/haproxy/haproxy.cfg")
 
 
+class ApplyCmd(Cmd):
+
+    def __init__(self) -> None:
+        super().__init__("apply")
+
+    def _setup(self):
+        self.parser.add_argument('--validate',
+                                 action="store_true",
+                                 help='Check the new config with haproxy -c')
+        self.parser.add_argument('--reload',
+                                 action="store_true",
+                                 help='Reload haproxy if the config changed')
+        self.parser.add_argument(
+            '--runtime',
+            action="store_true",
+            help='Change the running haproxy through its admin socket')
+        self.parser.add_argument('--socket',
+                                 help='Path to the haproxy admin socket',
+                                 default=ADMIN_SOCKET)
+        self.parser.add_argument(
+            'ops',
+            nargs=argparse.REMAINDER,
+            help=
+            'add BACKEND NAME ENDPOINT | rm BACKEND NAME | drain BACKEND NAME, repeated'
+        )
+
+    def _run(self):
+        config_path = self.parent.parsed_args.config
+        ops = parse_ops(self.parsed_args.ops)
+        exit(
+            apply_ops(config_path,
+                      ops,
+                      validate=self.parsed_args.validate,
+                      reload=self.parsed_args.reload,
+                      runtime_socket=self.parsed_args.socket
+                      if self.parsed_args.runtime else None))
+
+
 class BackendCmd(Cmd):
 
     def __init__(self) -> None:
@@ -128,96 +459,9 @@ class AddBackendCmd(Cmd):
     def _run(self):
         config_path = self.parent.parent.parsed_args.config
         backend_name = self.parent.parsed_args.backend
-        server_name = self.parsed_args.name
-        server_endpoint = self.parsed_args.endpoint
-
-        print("config_path", config_path)
-        print("backend_name", backend_name)
-        print("server_name", server_name)
-        print("server_endpoint", server_endpoint)
-
-        with open(config_path, "r", encoding="utf-8") as f:
-            content = f.read()
-
-        target_server_name = server_name
-        target_server_endpoint = server_endpoint
-        target_backend_name = backend_name
-
-        lines = content.split("\n")
-        line_count = len(lines)
-        current_line_number = 0
-        tab_size = " " * 2  # two spaces
-        is_need_to_save = False
-        found_backend_line_number = None
-
-        while current_line_number < line_count:
-            line = lines[current_line_number]
-            parts = line.split()
-            if len(parts) != 2:
-                current_line_number += 1
-                continue
-            if parts[0] != "backend":
-                current_line_number += 1
-                continue
-            if parts[1] != target_backend_name:
-                current_line_number += 1
-                continue
-            print(
-                f"found backend: \"{target_backend_name}\" at line {current_line_number}"
-            )
-            found_backend_line_number = current_line_number
-            current_line_number += 1
-            is_server_existed = False
-            while (current_line_number < line_count):
-                line: str = lines[current_line_number]
-                if not line or line.isspace():
-                    current_line_number += 1
-                    continue
-                if not line.startswith(tab_size):
-                    break
-                parts = line.split()
-                if not len(parts):
-                    current_line_number += 1
-                    continue
-                if parts[0] != "server":
-                    current_line_number += 1
-                    continue
-                server_name = parts[1]
-                server_endpoint = parts[2]
-                opts = parts[3:]
-                print(
-                    f"found server at line {current_line_number} server_name: {server_name} server_endpoint: {server_endpoint} opts: {opts}"
-                )
-                if server_name != target_server_name:
-                    current_line_number += 1
-                    continue
-                is_server_existed = True
-                if server_endpoint != target_server_endpoint:
-                    parts[2] = target_server_endpoint
-                    # begin space is missing when doing the .split()
-                    lines[current_line_number] = tab_size + " ".join(parts)
-                    is_need_to_save = True
-                break
-            print("is_server_existed", is_server_existed)
-            if not is_server_existed:
-                new_line = tab_size + " ".join([
-                    "server", target_server_name, target_server_endpoint,
-                    "check"
-                ])
-                lines.insert(current_line_number, new_line)
-                is_need_to_save = True
-            break
-
-        print("is_need_to_save", is_need_to_save)
-
-        if not is_need_to_save:
-            exit(0)
-
-        new_content = "\n".join(lines).strip()
-        print(new_content)
-
-        with open(config_path, "w") as f:
-            f.write(new_content)
+        op = ("add", backend_name, self.parsed_args.name,
+              self.parsed_args.endpoint)
+        exit(apply_ops(config_path, [op]))
 
 
 class RmBackendCmd(Cmd):
@@ -231,77 +475,8 @@ class RmBackendCmd(Cmd):
     def _run(self):
         config_path = self.parent.parent.parsed_args.config
         backend_name = self.parent.parsed_args.backend
-        server_name = self.parsed_args.name
-        print("config_path", config_path)
-        print("backend_name", backend_name)
-        print("server_name", server_name)
-
-        with open(config_path, "r", encoding="utf-8") as f:
-            content = f.read()
-
-        target_server_name = server_name
-        target_backend_name = backend_name
-
-        lines = content.split("\n")
-        line_count = len(lines)
-        current_line_number = 0
-        tab_size = " " * 2  # two spaces
-        is_need_to_save = False
-
-        while current_line_number < line_count:
-            line = lines[current_line_number]
-            parts = line.split()
-            if len(parts) != 2:
-                current_line_number += 1
-                continue
-            if parts[0] != "backend":
-                current_line_number += 1
-                continue
-            if parts[1] != target_backend_name:
-                current_line_number += 1
-                continue
-            print(
-                f"found backend: \"{target_backend_name}\" at line {current_line_number}"
-            )
-            current_line_number += 1
-            while (current_line_number < line_count):
-                line: str = lines[current_line_number]
-                if not line or line.isspace():
-                    current_line_number += 1
-                    continue
-                if not line.startswith(tab_size):
-                    break
-                parts = line.split()
-                if not len(parts):
-                    current_line_number += 1
-                    continue
-                if parts[0] != "server":
-                    current_line_number += 1
-                    continue
-                server_name = parts[1]
-                server_endpoint = parts[2]
-                opts = parts[3:]
-                print(
-                    f"found server at line {current_line_number} server_name: {server_name} server_endpoint: {server_endpoint} opts: {opts}"
-                )
-                if server_name != target_server_name:
-                    current_line_number += 1
-                    continue
-                lines.pop(current_line_number)
-                is_need_to_save = True
-                break
-            break
-
-        print("is_need_to_save", is_need_to_save)
-
-        if not is_need_to_save:
-            exit(0)
-
-        new_content = "\n".join(lines).strip()
-        print(new_content)
-
-        with open(config_path, "w") as f:
-            f.write(new_content)
+        op = ("rm", backend_name, self.parsed_args.name)
+        exit(apply_ops(config_path, [op]))
 
 
 def main():
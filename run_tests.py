@@ -1,6 +1,28 @@
 import unittest
 
 from tests.util import *
+from tests.inventory import *
+from tests.task import *
+from tests.poll import *
+from tests.lease import *
+from tests.ippool import *
+from tests.autoscaler import *
+from tests.joincache import *
+from tests.cloudinit import *
+from tests.worker import *
+from tests.transfer import *
+from tests.placement import *
+from tests.pool import *
+from tests.reconcile import *
+from tests.cluster import *
+from tests.ctlpl import *
+from tests.daemon import *
+from tests.node import *
+from tests.haproxy import *
+from tests.aio import *
+from tests.vm import *
+from tests.trace import *
+from tests.metrics import *
 
 if __name__ == '__main__':
     unittest.main()
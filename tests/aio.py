@@ -0,0 +1,209 @@
+import time
+import asyncio
+import threading
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from app.controller.aio import *
+from app.controller.vm import _KubeadmExecutor
+from app.logger import Logger
+from app import metrics
+from app import poll
+
+
+class StubExecStatus:
+
+    def __init__(self, agent) -> None:
+        self.agent = agent
+
+    def get(self, pid):
+        agent = self.agent
+        with agent.lock:
+            agent.checks[pid] = agent.checks.get(pid, 0) + 1
+            exited = agent.checks[pid] > agent.polls
+        if not exited:
+            return {"exited": 0}
+        return {
+            "exited": 1,
+            "exitcode": 0,
+            "out-data": agent.out.get(pid, str(pid))
+        }
+
+
+class StubAgent:
+
+    def __init__(self, polls) -> None:
+        self.polls = polls
+        self.out = {}
+        self.lock = threading.Lock()
+        self.checks = {}
+        self.exec = self
+        self.threads = set()
+        self.commands = []
+
+    def post(self, command):
+        with self.lock:
+            self.threads.add(threading.current_thread().name)
+            self.commands.append(command)
+            if not command[-1].isdigit():
+                return {"pid": 0}
+            return {"pid": 1000 + int(command[-1])}
+
+    def __call__(self, path):
+        return StubExecStatus(self)
+
+
+class StubApi:
+
+    def __init__(self, polls=2) -> None:
+        self.agent = StubAgent(polls)
+
+    def nodes(self, node):
+        return self
+
+    def qemu(self, vm_id):
+        return self
+
+
+class TestApoll(unittest.TestCase):
+
+    def test_apoll(self):
+        calls = []
+
+        async def check():
+            calls.append(1)
+            return len(calls) == 3 and "done"
+
+        r = asyncio.run(poll.apoll(check, initial=0.01, jitter=0))
+        self.assertEqual(r, "done")
+        with self.assertRaises(TimeoutError):
+            asyncio.run(
+                poll.apoll(lambda: asyncio.sleep(0, result=False),
+                           timeout=0.05,
+                           initial=0.01))
+
+
+class TestAsyncVmController(unittest.TestCase):
+
+    def test_many_execs_few_threads(self):
+        api = StubApi(polls=3)
+        executor = ThreadPoolExecutor(max_workers=4)
+
+        async def run():
+            vmctls = [
+                AsyncVmController(api,
+                                  "pve",
+                                  i,
+                                  log=Logger.ERROR,
+                                  executor=executor) for i in range(200)
+            ]
+            return await asyncio.gather(*[
+                x.exec(["echo", str(i)], interval_check=0.05)
+                for i, x in enumerate(vmctls)
+            ])
+
+        started_at = time.monotonic()
+        results = asyncio.run(run())
+        executor.shutdown()
+        self.assertEqual(len(results), 200)
+        self.assertTrue(all(exitcode == 0 for exitcode, _, _ in results))
+        self.assertEqual(sum(api.agent.checks.values()), 200 * 4)
+        # NOTE: the polls of every exec overlap, one after another would take 200x longer
+        self.assertLess(time.monotonic() - started_at, 5)
+        self.assertLessEqual(len(api.agent.threads), 4)
+
+    def test_exec_polls_and_timeouts_counted(self):
+        api = StubApi(polls=2)
+        vmctl = AsyncVmController(api, "pve", 100, log=Logger.ERROR)
+        polls = sum(metrics.exec_polls.values.values())
+        asyncio.run(vmctl.exec(["echo", "1"], interval_check=0.01))
+        self.assertEqual(sum(metrics.exec_polls.values.values()), polls + 3)
+        timeouts = metrics.timeouts.values.get(("exec", ), 0)
+        api.agent.polls = 1000
+        with self.assertRaises(TimeoutError):
+            asyncio.run(
+                vmctl.exec(["echo", "2"], timeout=0.05, interval_check=0.01))
+        self.assertEqual(metrics.timeouts.values[("exec", )], timeouts + 1)
+
+    def test_same_commands_as_sync(self):
+        api = StubApi(polls=0)
+        api.agent.out[0] = ("kubeadm join 10.0.0.2:6443 --token abc.def"
+                            " --discovery-token-ca-cert-hash sha256:123")
+        ctlplctl = AsyncControlPlaneVmController(api,
+                                                 "pve",
+                                                 100,
+                                                 log=Logger.ERROR)
+        credentials = asyncio.run(ctlplctl.kubeadm().create_join_credentials(
+            ttl=60, interval_check=0.01))
+        self.assertEqual(credentials["token"], "abc.def")
+        self.assertEqual(api.agent.commands[-1],
+                         _KubeadmExecutor.token_create_cmd(60))
+        lbctl = AsyncLbVmController(api,
+                                    "pve",
+                                    101,
+                                    log=Logger.ERROR,
+                                    update_mode="runtime")
+        ops = [("add", "control-plane", 102, "10.0.0.12:6443")]
+        asyncio.run(lbctl.apply_backends(ops))
+        self.assertEqual(api.agent.commands[-1],
+                         lbctl.sync.apply_backends_cmd(ops))
+        self.assertIn("--runtime", api.agent.commands[-1])
+
+
+class TestAsyncNodeController(unittest.TestCase):
+
+    def test_drain_node_same_as_sync(self):
+        calls = []
+
+        def exec_stream(cmd, **kwargs):
+            calls.append((cmd, kwargs))
+            return 0, "", ""
+
+        async def aexec_stream(cmd, **kwargs):
+            return exec_stream(cmd, **kwargs)
+
+        ctlplctl = ControlPlaneVmController(None, "pve", 100, log=Logger.ERROR)
+        ctlplctl.exec_stream = exec_stream
+        ctlplctl.drain_node("i-101")
+        actlplctl = AsyncControlPlaneVmController(None,
+                                                  "pve",
+                                                  100,
+                                                  log=Logger.ERROR)
+        actlplctl.exec_stream = aexec_stream
+        asyncio.run(actlplctl.drain_node("i-101"))
+        self.assertEqual(calls[0], calls[1])
+
+    def test_locate_off_the_loop(self):
+        threads = []
+
+        class LocatingNodeController(NodeController):
+
+            def locate(self, vm_id):
+                threads.append(threading.current_thread().name)
+                return "pve2"
+
+        nodectl = LocatingNodeController(StubApi(), "pve", log=Logger.ERROR)
+
+        async def run():
+            async with AsyncNodeController(nodectl) as asyncnodectl:
+                return await asyncnodectl.wkctl(100)
+
+        wkctl = asyncio.run(run())
+        self.assertEqual(wkctl.node, "pve2")
+        self.assertTrue(threads[0].startswith("kp-http"))
+
+    def test_context_manager_shuts_executor_down(self):
+        nodectl = NodeController(StubApi(), "pve", log=Logger.ERROR)
+
+        async def run():
+            async with AsyncNodeController(nodectl) as asyncnodectl:
+                pass
+            return asyncnodectl
+
+        asyncnodectl = asyncio.run(run())
+        with self.assertRaises(RuntimeError):
+            asyncnodectl.executor.submit(print)
+        with AsyncNodeController(nodectl) as asyncnodectl:
+            pass
+        with self.assertRaises(RuntimeError):
+            asyncnodectl.executor.submit(print)
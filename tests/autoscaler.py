@@ -0,0 +1,109 @@
+import unittest
+
+from app.service import autoscaler
+from app.logger import Logger
+
+
+def node(name, cpu="2", memory="4Gi"):
+    return {
+        "kind": "Node",
+        "metadata": {
+            "name": name
+        },
+        "status": {
+            "allocatable": {
+                "cpu": cpu,
+                "memory": memory
+            }
+        }
+    }
+
+
+def pod(node_name=None, cpu="100m", memory="128Mi", unschedulable=False):
+    status = {"phase": "Running" if node_name else "Pending"}
+    if unschedulable:
+        status["conditions"] = [{
+            "type": "PodScheduled",
+            "status": "False",
+            "reason": "Unschedulable"
+        }]
+    return {
+        "kind": "Pod",
+        "spec": {
+            "nodeName":
+            node_name,
+            "containers": [{
+                "resources": {
+                    "requests": {
+                        "cpu": cpu,
+                        "memory": memory
+                    }
+                }
+            }]
+        },
+        "status": status
+    }
+
+
+class TestAutoscaler(unittest.TestCase):
+
+    def test_summarize(self):
+        summary = autoscaler.summarize({
+            "items":
+            [node("i-1"),
+             pod("i-1", cpu="1"),
+             pod(unschedulable=True),
+             pod()]
+        })
+        self.assertEqual(summary["pending"], 1)
+        self.assertEqual(summary["nodes"]["i-1"]["cpu_requests"], 1)
+        self.assertEqual(autoscaler.utilization(summary["nodes"]["i-1"]), 0.5)
+
+    def test_summarize_skip_invalid_quantities(self):
+        summary = autoscaler.summarize(
+            {
+                "items": [
+                    node("i-1", memory="1Pi"),
+                    node("i-2", cpu="lots"),
+                    pod("i-1", cpu="1", memory="huge"),
+                ]
+            },
+            log=Logger.ERROR)
+        self.assertEqual(summary["nodes"]["i-1"]["memory"], 2**50)
+        self.assertEqual(summary["nodes"]["i-1"]["cpu_requests"], 1)
+        self.assertEqual(summary["nodes"]["i-1"]["memory_requests"], 0)
+        self.assertEqual(summary["nodes"]["i-2"]["cpu"], 0)
+        self.assertEqual(autoscaler.utilization(summary["nodes"]["i-2"]), 1)
+
+    def test_decide_scale_up_on_pending(self):
+        summary = {"pending": 2, "nodes": {}}
+        decision = autoscaler.decide(summary, {"i-1": 1}, max_workers=2)
+        self.assertEqual(decision["action"], "up")
+
+    def test_decide_respect_max_and_cooldown(self):
+        summary = {"pending": 2, "nodes": {}}
+        decision = autoscaler.decide(summary, {"i-1": 1}, max_workers=1)
+        self.assertEqual(decision["action"], "none")
+        decision = autoscaler.decide(summary, {"i-1": 1},
+                                     last_scale_up=100,
+                                     scale_up_cooldown=60,
+                                     now=130)
+        self.assertEqual(decision["action"], "none")
+
+    def test_decide_scale_down_least_utilized(self):
+        summary = autoscaler.summarize({
+            "items": [
+                node("i-1"),
+                node("i-2"),
+                node("i-3"),
+                pod("i-1", cpu="1500m"),
+                pod("i-2", cpu="200m"),
+                pod("i-3", cpu="100m"),
+            ]
+        })
+        workers = {"i-1": 1, "i-2": 2, "i-3": 3}
+        decision = autoscaler.decide(summary, workers, min_workers=1)
+        self.assertEqual(decision["action"], "down")
+        self.assertEqual(decision["vm_id"], 3)
+        decision = autoscaler.decide(summary, workers, min_workers=3)
+        self.assertEqual(decision["action"], "none")
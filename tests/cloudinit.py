@@ -0,0 +1,157 @@
+import os
+import json
+import socket
+import tempfile
+import threading
+import unittest
+import http.server
+
+from app.controller.kube import KubeApiController
+from app.controller.node import NodeController
+from app.error import *
+from app.logger import Logger
+from app import cloudinit
+from app import util
+from tests.node import FakeApi
+
+
+class TestCloudInit(unittest.TestCase):
+
+    def test_render_join_user_data(self):
+        user_data = cloudinit.render_join_user_data(
+            "i-102", "u", 'p"1', "ssh-rsa A a@a\n\nssh-rsa B b@b\n",
+            ["kubeadm", "join", "10.0.0.1:6443", "--token", "abc.def"])
+        lines = user_data.splitlines()
+        self.assertEqual(lines[0], "#cloud-config")
+        self.assertIn('hostname: "i-102"', lines)
+        self.assertIn('    plain_text_passwd: "p\\"1"', lines)
+        self.assertIn('      - "ssh-rsa B b@b"', lines)
+        self.assertEqual(
+            json.loads(lines[-1][len("  - "):]),
+            ["kubeadm", "join", "10.0.0.1:6443", "--token", "abc.def"])
+
+    def test_write_and_remove_snippet(self):
+        with tempfile.TemporaryDirectory() as d:
+            filepath = cloudinit.write_snippet(d, "kp-join-102.yaml", "x")
+            self.assertEqual(os.stat(filepath).st_mode & 0o777, 0o600)
+            cloudinit.remove_snippet(d, "kp-join-102.yaml")
+            cloudinit.remove_snippet(d, "kp-join-102.yaml")
+            self.assertEqual(os.listdir(d), [])
+
+
+class NodesHandler(http.server.BaseHTTPRequestHandler):
+    registered_after = 2
+    calls = []
+
+    def do_GET(self):
+        NodesHandler.calls.append(self.headers.get("Authorization"))
+        if self.headers.get("Authorization") != "Bearer abc.def":
+            self.send_response(401)
+            self.end_headers()
+            return
+        if len(NodesHandler.calls) < NodesHandler.registered_after:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps({"metadata": {"name": self.path.split("/")[-1]}})
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestKubeApiController(unittest.TestCase):
+
+    def setUp(self):
+        NodesHandler.calls = []
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                                      NodesHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint = f"127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_wait_for_node_with_the_join_token(self):
+        credentials = util.KubeUtil.parse_join_command(
+            f"kubeadm join {self.endpoint} --token abc.def"
+            " --discovery-token-ca-cert-hash sha256:123")
+        kubeapi = KubeApiController.from_credentials(credentials,
+                                                     log=Logger.ERROR)
+        kubeapi.scheme = "http"
+        node = kubeapi.wait_for_node("i-101", timeout=5, interval=0.05)
+        self.assertEqual(node["metadata"]["name"], "i-101")
+        self.assertEqual(len(NodesHandler.calls), 2)
+
+    def test_wait_for_node_bad_token(self):
+        kubeapi = KubeApiController(self.endpoint,
+                                    "stale.token",
+                                    scheme="http",
+                                    log=Logger.ERROR)
+        with self.assertRaises(KubectlFailedError):
+            kubeapi.wait_for_node("i-101", timeout=5, interval=0.05)
+
+
+class TestSnippetsStorage(unittest.TestCase):
+
+    def nodectl(self):
+        storages = [
+            {
+                "storage": "local",
+                "node": "pve2",
+                "shared": 0
+            },
+            {
+                "storage": "cephfs",
+                "node": "pve2",
+                "shared": 1
+            },
+        ]
+        configs = {
+            "local": {
+                "path": "/var/lib/vz",
+                "content": "iso,snippets"
+            },
+            "cephfs": {
+                "path": "/mnt/pve/cephfs",
+                "content": "snippets"
+            },
+            "nosnippets": {
+                "path": "/mnt/pve/nosnippets",
+                "content": "iso"
+            },
+            "nopath": {
+                "content": "snippets"
+            },
+        }
+
+        def handler(method, path, params):
+            if path == "cluster/resources":
+                return storages
+            return configs[path.split("/")[1]]
+
+        return NodeController(FakeApi(handler), "pve1", log=Logger.ERROR)
+
+    def test_check_snippets_storage(self):
+        nodectl = self.nodectl()
+        nodectl.check_snippets_storage(socket.gethostname(), "local",
+                                       "/var/lib/vz/snippets")
+        nodectl.check_snippets_storage("pve2", "cephfs",
+                                       "/mnt/pve/cephfs/snippets/")
+        with self.assertRaises(SnippetStorageError):
+            nodectl.check_snippets_storage("pve2", "local",
+                                           "/var/lib/vz/snippets")
+
+    def test_check_snippets_dir(self):
+        nodectl = self.nodectl()
+        with self.assertRaisesRegex(SnippetStorageError, "is not its"):
+            nodectl.check_snippets_storage("pve2", "cephfs",
+                                           "/var/lib/vz/snippets")
+        with self.assertRaisesRegex(SnippetStorageError, "content type"):
+            nodectl.check_snippets_storage("pve2", "nosnippets",
+                                           "/mnt/pve/nosnippets/snippets")
+        with self.assertRaisesRegex(SnippetStorageError, "file storage"):
+            nodectl.check_snippets_storage("pve2", "nopath", "/snippets")
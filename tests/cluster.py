@@ -0,0 +1,59 @@
+import time
+import threading
+import unittest
+
+from app.controller.cluster import PowerWatcher
+from app.logger import Logger
+
+
+class StubResources:
+
+    def __init__(self, status) -> None:
+        self.status = status
+        self.calls = 0
+
+    def get(self, type=None):
+        self.calls += 1
+        return [{"vmid": k, "status": v} for k, v in self.status.items()]
+
+
+class StubApi:
+
+    def __init__(self, status) -> None:
+        self.cluster = type("Cluster", (), {})()
+        self.cluster.resources = StubResources(status)
+
+
+class TestPowerWatcher(unittest.TestCase):
+
+    def test_wait_stopped_together(self):
+        api = StubApi({100: "running", 101: "running", 102: "stopped"})
+        watcher = PowerWatcher(api, max_interval=0.05, log=Logger.ERROR)
+        threading.Timer(
+            0.2, lambda: api.cluster.resources.status.update({
+                100: "stopped",
+                101: "stopped"
+            })).start()
+        results = {}
+
+        def wait(vm_id):
+            results[vm_id] = watcher.wait_stopped(vm_id, timeout=2)
+
+        threads = [
+            threading.Thread(target=wait, args=(x, )) for x in [100, 101, 102]
+        ]
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+        self.assertEqual(results, {100: True, 101: True, 102: True})
+        # NOTE: one poll serves every watched vm, a poll per vm would be 3x more
+        self.assertLess(api.cluster.resources.calls, 20)
+
+    def test_gone_is_stopped_and_timeout(self):
+        api = StubApi({100: "running"})
+        watcher = PowerWatcher(api, max_interval=0.05, log=Logger.ERROR)
+        self.assertTrue(watcher.wait_stopped(999, timeout=1))
+        self.assertFalse(watcher.wait_stopped(100, timeout=0.2))
+        time.sleep(0.1)
+        self.assertEqual(watcher.watched, {})
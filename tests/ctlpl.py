@@ -0,0 +1,135 @@
+import ipaddress
+import threading
+import unittest
+
+from app.service.ctlpl import ControlPlaneService
+from app.logger import Logger
+
+
+class StubTask:
+
+    def __init__(self, events, name, error=None) -> None:
+        self.events = events
+        self.name = name
+        self.error = error
+
+    def wait(self):
+        self.events.append(self.name)
+        if self.error:
+            raise self.error
+
+
+class StubIpPool:
+    network = ipaddress.ip_network("10.0.0.0/24")
+
+
+class StubLbVmController:
+
+    def __init__(self, events, cloned) -> None:
+        self.events = events
+        self.cloned = cloned
+
+    def apply_backends(self, ops):
+        op, backend, vm_id, *_ = ops[0]
+        # NOTE: the backend is added without waiting for the clone
+        if op == "add":
+            self.cloned.wait(1)
+        self.events.append(f"lb {op} {vm_id} cloned {self.cloned.is_set()}")
+        return 0, "", ""
+
+    def current_config(self):
+        return {"ipconfig0": "ip=10.0.0.2/24,gw=10.0.0.1"}
+
+
+class StubVmController:
+
+    def __init__(self, events, vm_id) -> None:
+        self.events = events
+        self.vm_id = vm_id
+
+    def __getattr__(self, name):
+
+        def call(*args, **kwargs):
+            self.events.append(f"{self.vm_id} {name}")
+            if name in ["startup"]:
+                return StubTask(self.events, f"{self.vm_id} started")
+            if name == "kubeadm":
+                return self
+            if name == "pack_files":
+                return "payload", "sha256"
+            return 0, "", ""
+
+        return call
+
+
+class StubNodeController:
+
+    def __init__(self, clone_error=None) -> None:
+        self.events = []
+        self.cloned = threading.Event()
+        self.clone_error = clone_error
+
+    def vm_network(self, vm_network_name, preserved_ips=[]):
+        return StubIpPool(), "10.0.0.1", preserved_ips
+
+    def lbctl(self, vm_id):
+        return StubLbVmController(self.events, self.cloned)
+
+    def join_command(self, control_plane_vm_id, is_control_plane=False):
+        return ["kubeadm", "join", "--control-plane"]
+
+    def place(self, template_id, vm_id, **kwargs):
+        return None
+
+    def clone(self, template_id, vm_id, **kwargs):
+        if not self.clone_error:
+            self.cloned.set()
+        return StubTask(self.events, f"clone {vm_id}", self.clone_error)
+
+    def vmctl(self, vm_id):
+        return StubVmController(self.events, vm_id)
+
+    def ctlplvmctl(self, vm_id):
+        return StubVmController(self.events, vm_id)
+
+
+def create_control_plane(nodectl, **kwargs):
+    return ControlPlaneService(nodectl, log=Logger.ERROR).create_control_plane(
+        "vmbr0",
+        9000,
+        "10.244.0.0/16",
+        load_balancer_vm_id=100,
+        reserved_vm_id=102,
+        reserved_vm_ip="10.0.0.12",
+        **kwargs)
+
+
+class TestCreateControlPlane(unittest.TestCase):
+
+    def test_join_stacked_control_plane(self):
+        nodectl = StubNodeController()
+        self.assertEqual(
+            create_control_plane(nodectl, control_plane_vm_id=101), 102)
+        events = nodectl.events
+        self.assertIn("lb add 102 cloned True", events)
+        self.assertIn("101 pack_files", events)
+        self.assertIn("102 unpack_files", events)
+        self.assertEqual(events[-1], "102 exec")
+        self.assertNotIn("lb rm 102", " ".join(events))
+
+    def test_init_first_stacked_control_plane(self):
+        nodectl = StubNodeController()
+        create_control_plane(nodectl)
+        events = nodectl.events
+        self.assertIn("102 init", events)
+        # NOTE: kubeadm init goes through the load balancer
+        self.assertLess(events.index("lb add 102 cloned True"),
+                        events.index("102 init"))
+
+    def test_remove_backend_when_clone_fails(self):
+        nodectl = StubNodeController(clone_error=Exception("clone failed"))
+        with self.assertRaises(Exception):
+            create_control_plane(nodectl, control_plane_vm_id=101)
+        events = nodectl.events
+        self.assertEqual(events[-2:],
+                         ["lb add 102 cloned False", "lb rm 102 cloned False"])
@@ -0,0 +1,132 @@
+import io
+import contextlib
+import os
+import json
+import sys
+import socket
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+from concurrent.futures import ThreadPoolExecutor
+from app.cmd.daemon import DaemonCmd
+from app.daemon import Daemon, forward, FORWARDED_ENV, _peer_uid
+from app.error import *
+from app.logger import Logger
+
+
+def run_command(argv, stdout, stderr):
+    if argv[0] == "fail":
+        raise SystemExit(3)
+    print("request", argv[0], file=stdout)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # NOTE: one write per line, print writes the newline apart
+        list(pool.map(lambda x: stdout.write(f"worker {x}\n"), [1, 2]))
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.dir.name, "kp.sock")
+        self.daemon = Daemon(self.socket_path, log=Logger.ERROR)
+        self.server = self.daemon.listen(run_command=run_command)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def test_forward_relays_output_of_worker_threads(self):
+        stdout = io.StringIO()
+        exitcode = forward(["hello"], self.socket_path, stdout=stdout)
+        self.assertEqual(exitcode, 0)
+        lines = sorted(stdout.getvalue().splitlines())
+        self.assertEqual(lines, ["request hello", "worker 1", "worker 2"])
+
+    def test_forward_exitcode(self):
+        stdout = io.StringIO()
+        self.assertEqual(forward(["fail"], self.socket_path, stdout=stdout), 3)
+
+    def request(self, request: dict):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.socket_path)
+        with client, client.makefile("rwb") as f:
+            f.write((json.dumps(request) + "\n").encode())
+            f.flush()
+            return [json.loads(x) for x in f]
+
+    def test_refuse_other_env_or_cwd(self):
+        env = {x: os.getenv(x) for x in FORWARDED_ENV}
+        other_cwd = dict(argv=["hello"], cwd="/elsewhere", env=env)
+        self.assertEqual(self.request(other_cwd), [{"refused": "cwd"}])
+        other_env = dict(argv=["hello"],
+                         cwd=os.getcwd(),
+                         env=dict(env, CONFIG_PATH="/elsewhere/config.json"))
+        self.assertEqual(self.request(other_env), [{"refused": "CONFIG_PATH"}])
+        same = dict(argv=["fail"], cwd=os.getcwd(), env=env)
+        self.assertEqual(self.request(same), [{"exitcode": 3}])
+
+    def test_no_daemon(self):
+        self.assertIsNone(forward(["hello"], self.socket_path + ".missing"))
+
+    def test_refuse_to_start_twice(self):
+        with self.assertRaises(DaemonRunningError):
+            Daemon(self.socket_path, log=Logger.ERROR).listen()
+
+    def test_remove_stale_socket(self):
+        path = os.path.join(self.dir.name, "stale.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        server = Daemon(path, log=Logger.ERROR).listen()
+        server.server_close()
+
+    def test_peer_uid(self):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with client:
+            client.connect(self.socket_path)
+            self.assertIn(_peer_uid(client), [None, os.getuid()])
+
+    def test_refuse_shared_dir(self):
+        shared = os.path.join(self.dir.name, "shared")
+        os.mkdir(shared)
+        os.chmod(shared, 0o777)
+        with self.assertRaises(DaemonSocketError):
+            Daemon(os.path.join(shared, "kp.sock"), log=Logger.ERROR).listen()
+
+    def test_create_private_dir(self):
+        path = os.path.join(self.dir.name, "run", "kp.sock")
+        server = Daemon(path, log=Logger.ERROR).listen()
+        server.server_close()
+        mode = os.stat(os.path.dirname(path)).st_mode
+        self.assertEqual(mode & 0o077, 0)
+
+    def test_refuse_other_owner(self):
+        path = os.path.join(self.dir.name, "other.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        # NOTE: the socket file is owned by the test user, pretend to be someone else
+        with mock.patch("app.daemon._private_dir"):
+            with mock.patch("os.getuid", return_value=os.getuid() + 1):
+                with self.assertRaises(DaemonSocketError):
+                    Daemon(path, log=Logger.ERROR).listen()
+                stderr = io.StringIO()
+                self.assertIsNone(forward(["hello"], path, stderr=stderr))
+        self.assertIn("owned by uid", stderr.getvalue())
+
+
+class TestDaemonCmd(unittest.TestCase):
+
+    def test_metrics_port(self):
+        parser = DaemonCmd().parser
+        self.assertEqual(
+            parser.parse_args(["--metrics-port", "9100"]).metrics_port, 9100)
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            with self.assertRaises(SystemExit):
+                parser.parse_args(["--metrics-port", "nine"])
+        self.assertIn("KP_METRICS_PORT", err.getvalue())
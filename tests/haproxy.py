@@ -0,0 +1,197 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+import importlib.util
+
+from unittest import mock
+
+spec = importlib.util.spec_from_file_location(
+    "config_haproxy",
+    os.path.join(os.path.dirname(__file__), "..", "examples", "vm-templates",
+                 "haproxy", "config_haproxy.py"))
+config_haproxy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(config_haproxy)
+
+CONFIG = """global
+  log /dev/log local0
+backend control-plane
+  mode tcp
+  server i-121 10.0.0.21:6443 check
+
+backend ingress
+  mode tcp"""
+
+
+class TestConfigHaproxy(unittest.TestCase):
+
+    def test_parse_ops(self):
+        self.assertEqual(
+            config_haproxy.parse_ops(
+                ["add", "be", "a", "1.1.1.1:1", "rm", "be", "b"]),
+            [("add", "be", "a", "1.1.1.1:1"), ("rm", "be", "b")])
+        with self.assertRaises(ValueError):
+            config_haproxy.parse_ops(["add", "be", "a"])
+
+    def test_apply_ops(self):
+        with tempfile.TemporaryDirectory() as d:
+            filepath = os.path.join(d, "haproxy.cfg")
+            with open(filepath, "w") as f:
+                f.write(CONFIG)
+            exitcode = config_haproxy.apply_ops(filepath, [
+                ("add", "control-plane", "i-122", "10.0.0.22:6443"),
+                ("add", "control-plane", "i-121", "10.0.0.31:6443"),
+                ("rm", "control-plane", "i-123"),
+                ("add", "ingress", "i-201", "10.0.0.41:80"),
+            ])
+            self.assertEqual(exitcode, 0)
+            with open(filepath) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[2:], [
+                "backend control-plane",
+                "  mode tcp",
+                "  server i-121 10.0.0.31:6443 check",
+                "  server i-122 10.0.0.22:6443 check",
+                "",
+                "backend ingress",
+                "  mode tcp",
+                "  server i-201 10.0.0.41:80 check",
+            ])
+            self.assertEqual(os.listdir(d), ["haproxy.cfg"])
+
+    def test_unknown_backend(self):
+        cfg = config_haproxy.HaproxyConfig(CONFIG)
+        with self.assertRaises(KeyError):
+            cfg.add_server("api", "i-121", "10.0.0.21:6443")
+
+
+class FakeAdminSocket:
+
+    def __init__(self, path, answers={}) -> None:
+        self.answers = answers
+        self.commands = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            with conn:
+                command = conn.recv(4096).decode().strip()
+                self.commands.append(command)
+                answer = ""
+                for prefix, x in self.answers.items():
+                    if command.startswith(prefix):
+                        answer = x
+                conn.sendall(answer.encode())
+
+    def close(self):
+        self.server.close()
+
+
+class TestConfigHaproxyRuntime(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cfg_path = os.path.join(self.dir.name, "haproxy.cfg")
+        self.socket_path = os.path.join(self.dir.name, "admin.sock")
+        with open(self.cfg_path, "w") as f:
+            f.write(CONFIG)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_runtime(self):
+        admin = FakeAdminSocket(
+            self.socket_path, {
+                "add server": "New server registered.",
+                "del server": "Server deleted.",
+                "set server control-plane/i-121 addr": "IP changed from",
+            })
+        exitcode = config_haproxy.apply_ops(self.cfg_path, [
+            ("add", "control-plane", "i-122", "10.0.0.22:6443"),
+            ("add", "control-plane", "i-121", "10.0.0.31:6443"),
+            ("rm", "control-plane", "i-123"),
+            ("drain", "ingress", "i-201"),
+        ],
+                                            reload=True,
+                                            runtime_socket=self.socket_path)
+        admin.close()
+        self.assertEqual(exitcode, 0)
+        self.assertEqual(admin.commands, [
+            "add server control-plane/i-122 10.0.0.22:6443 check",
+            "enable health control-plane/i-122",
+            "set server control-plane/i-122 state ready",
+            "set server control-plane/i-121 addr 10.0.0.31 port 6443",
+            "set server ingress/i-201 state drain",
+        ])
+        with open(self.cfg_path) as f:
+            self.assertIn("  server i-122 10.0.0.22:6443 check", f.read())
+
+    def test_runtime_refused(self):
+        admin = FakeAdminSocket(self.socket_path,
+                                {"del server": "Unknown command."})
+        exitcode = config_haproxy.apply_ops(self.cfg_path,
+                                            [("rm", "control-plane", "i-121")],
+                                            runtime_socket=self.socket_path)
+        admin.close()
+        self.assertEqual(exitcode, 1)
+        self.assertEqual(admin.commands[-2:], [
+            "del server control-plane/i-121",
+            "set server control-plane/i-121 state ready",
+        ])
+        # NOTE: the file is put back, a retry does not see "unchanged"
+        with open(self.cfg_path) as f:
+            self.assertEqual(f.read(), CONFIG)
+
+    def test_runtime_undo(self):
+        admin = FakeAdminSocket(
+            self.socket_path, {
+                "add server control-plane/i-122": "New server registered.",
+                "add server control-plane/i-121": "New server registered.",
+                "del server control-plane/i-122": "Server deleted.",
+                "del server control-plane/i-121": "Server deleted.",
+                "set server control-plane/i-121 addr": "IP changed from",
+            })
+        exitcode = config_haproxy.apply_ops(self.cfg_path, [
+            ("add", "control-plane", "i-122", "10.0.0.22:6443"),
+            ("rm", "control-plane", "i-121"),
+            ("add", "control-plane", "i-124", "10.0.0.24:6443"),
+        ],
+                                            runtime_socket=self.socket_path)
+        admin.close()
+        self.assertEqual(exitcode, 1)
+        self.assertEqual(admin.commands[-6:], [
+            "add server control-plane/i-124 10.0.0.24:6443 check",
+            "add server control-plane/i-121 10.0.0.21:6443 check",
+            "enable health control-plane/i-121",
+            "set server control-plane/i-121 state ready",
+            "set server control-plane/i-122 state maint",
+            "del server control-plane/i-122",
+        ])
+        with open(self.cfg_path) as f:
+            self.assertEqual(f.read(), CONFIG)
+
+    def test_runtime_undo_fails(self):
+        admin = FakeAdminSocket(
+            self.socket_path,
+            {"add server control-plane/i-122": "New server registered."})
+        with mock.patch.object(config_haproxy.subprocess, "run") as run:
+            exitcode = config_haproxy.apply_ops(
+                self.cfg_path, [
+                    ("add", "control-plane", "i-122", "10.0.0.22:6443"),
+                    ("add", "control-plane", "i-124", "10.0.0.24:6443"),
+                ],
+                runtime_socket=self.socket_path)
+        admin.close()
+        self.assertEqual(exitcode, 1)
+        self.assertEqual(admin.commands[-1], "del server control-plane/i-122")
+        run.assert_called_once_with(["systemctl", "reload", "haproxy"])
+        with open(self.cfg_path) as f:
+            self.assertEqual(f.read(), CONFIG)
@@ -0,0 +1,84 @@
+import unittest
+
+from app.controller.inventory import Inventory
+from app.error import *
+from app.logger import Logger
+from tests.node import FakeApi
+
+VMS = [
+    {
+        "vmid": 101,
+        "node": "pve1",
+        "tags": "kp-worker;kp-warm"
+    },
+    {
+        "vmid": 102,
+        "node": "pve1",
+        "tags": "kp-control-plane"
+    },
+    {
+        "vmid": 103,
+        "node": "pve1"
+    },
+    {
+        "vmid": 201,
+        "node": "pve2",
+        "tags": "kp-warm"
+    },
+]
+
+
+def config_handler(method, path, params):
+    vm_id = path.split("/")[3]
+    if vm_id == "103":
+        return {}
+    return {"ipconfig0": f"ip=10.0.0.{vm_id[0]}{vm_id[-1]}/24,gw=10.0.0.1"}
+
+
+class TestInventory(unittest.TestCase):
+
+    def inventory(self, cluster_wide=False):
+        api = FakeApi(config_handler)
+        inventory = Inventory(api,
+                              "pve1", [dict(x) for x in VMS],
+                              log=Logger.ERROR,
+                              cluster_wide=cluster_wide)
+        return api, inventory
+
+    def test_filter_by_node(self):
+        _, inventory = self.inventory()
+        self.assertEqual([x["vmid"] for x in inventory.managed_vms()],
+                         [101, 102, 103])
+        self.assertEqual([x["vmid"] for x in inventory.node_vms("pve2")],
+                         [201])
+        _, inventory = self.inventory(cluster_wide=True)
+        self.assertEqual(len(inventory.managed_vms()), 4)
+
+    def test_filter_by_tag(self):
+        _, inventory = self.inventory()
+        self.assertEqual([x["vmid"] for x in inventory.tagged("kp-warm")],
+                         [101])
+        self.assertEqual([
+            x["vmid"] for x in inventory.tagged("kp-warm", "kp-control-plane")
+        ], [101, 102])
+        self.assertEqual(inventory.tagged("kp-lb"), [])
+        _, inventory = self.inventory(cluster_wide=True)
+        self.assertEqual([x["vmid"] for x in inventory.tagged("kp-warm")],
+                         [101, 201])
+
+    def test_ids_and_ips(self):
+        api, inventory = self.inventory()
+        # NOTE: every vm id is taken, whatever its node
+        self.assertEqual(inventory.ids(), set([101, 102, 103, 201]))
+        self.assertEqual(inventory.ips(), {101: "10.0.0.11", 102: "10.0.0.12"})
+        # NOTE: fetched once per snapshot
+        inventory.ips()
+        self.assertEqual(len(api.calls), 3)
+
+    def test_find(self):
+        _, inventory = self.inventory()
+        self.assertEqual(inventory.find("102")["node"], "pve1")
+        with self.assertRaises(VmNotFoundError):
+            inventory.find(201)
+        with self.assertRaises(VmNotFoundError):
+            inventory.find(999)
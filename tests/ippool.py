@@ -0,0 +1,36 @@
+import ipaddress
+import unittest
+
+from app.ippool import IpPool
+
+
+class TestIpPool(unittest.TestCase):
+
+    def test_allocate_skip_preserved(self):
+        pool = IpPool.from_cidr("192.168.56.1/24", ["192.168.56.1"])
+        self.assertEqual(len(pool), 254)
+        self.assertEqual(pool.allocate(), "192.168.56.2")
+        self.assertEqual(pool.allocate(), "192.168.56.3")
+
+    def test_preserved_ranges(self):
+        pool = IpPool.from_cidr(
+            "10.0.0.0/16", ["10.0.0.0/24", "10.0.1.0-10.0.1.9", "10.0.1.11"])
+        self.assertEqual(pool.free_count(), 65534 - 255 - 10 - 1)
+        self.assertEqual(pool.allocate(), "10.0.1.10")
+        self.assertEqual(pool.allocate(), "10.0.1.12")
+
+    def test_release_and_exhaust(self):
+        pool = IpPool(ipaddress.IPv4Network("10.0.0.0/29"))
+        ips = [pool.allocate() for _ in range(6)]
+        self.assertEqual(ips[0], "10.0.0.1")
+        self.assertEqual(ips[-1], "10.0.0.6")
+        self.assertIsNone(pool.allocate())
+        pool.release("10.0.0.3")
+        self.assertTrue(pool.is_free("10.0.0.3"))
+        self.assertEqual(pool.allocate(), "10.0.0.3")
+        self.assertIsNone(pool.allocate())
+
+    def test_outside_ips_are_ignored(self):
+        pool = IpPool.from_cidr("10.0.0.0/30", ["192.168.0.1", "10.0.0.0"])
+        self.assertEqual(pool.free_count(), 2)
+        self.assertIsNone(pool.offset("10.0.0.3"))
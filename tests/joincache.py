@@ -0,0 +1,104 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from app.joincache import JoinCache
+from app.logger import Logger
+
+
+class TestJoinCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "join.json")
+        self.now = 1000
+        self.calls = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def cache(self, **kwargs):
+        return JoinCache(self.path,
+                         clock=lambda: self.now,
+                         log=Logger.ERROR,
+                         **kwargs)
+
+    def create(self, ttl, with_certificate_key):
+        self.calls.append(with_certificate_key)
+        return {
+            "endpoint":
+            "10.0.0.1:6443",
+            "token":
+            f"token-{len(self.calls)}",
+            "ca_cert_hash":
+            "sha256:123",
+            "expires_at":
+            self.now + ttl,
+            "certificate_key":
+            "key" if with_certificate_key else None,
+            "certificate_key_expires_at":
+            self.now + 100 if with_certificate_key else None,
+        }
+
+    def test_reuse_across_instances(self):
+        first = self.cache(ttl=3600).get(122, self.create)
+        second = self.cache(ttl=3600).get(122, self.create)
+        self.assertEqual(first["token"], "token-1")
+        self.assertEqual(second["token"], "token-1")
+        self.assertEqual(self.cache().get(123, self.create)["token"],
+                         "token-2")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_expired_and_missing_certificate_key(self):
+        cache = self.cache(ttl=3600, refresh_margin=0)
+        cache.get(122, self.create)
+        self.assertEqual(
+            cache.get(122, self.create, with_certificate_key=True)["token"],
+            "token-2")
+        self.now += 3601
+        self.assertEqual(cache.get(122, self.create)["token"], "token-3")
+        self.assertEqual(self.calls, [False, True, False])
+
+    def test_refresh_in_background(self):
+        cache = self.cache(ttl=3600, refresh_margin=600)
+        cache.get(122, self.create)
+        self.now += 3300
+        release = threading.Event()
+
+        def create(ttl, with_certificate_key):
+            release.wait()
+            return self.create(ttl, with_certificate_key)
+
+        self.assertEqual(cache.get(122, create)["token"], "token-1")
+        self.assertIsNone(cache.refresh_in_background(122, create))
+        release.set()
+        for x in threading.enumerate():
+            if x.name == "join-cache-refresh":
+                x.join()
+        self.assertEqual(cache.get(122, self.create)["token"], "token-2")
+
+    def test_invalidate(self):
+        cache = self.cache()
+        cache.get(122, self.create)
+        cache.invalidate(122)
+        self.assertEqual(cache.get(122, self.create)["token"], "token-2")
+
+    def test_key_per_host_and_endpoint(self):
+        cache = self.cache(ttl=3600)
+        keys = [
+            JoinCache.key("pve-a", 122, "10.0.0.2"),
+            JoinCache.key("pve-b", 122, "10.0.0.2"),
+            JoinCache.key("pve-a", 122, "10.0.1.2"),
+        ]
+        tokens = [cache.get(x, self.create)["token"] for x in keys]
+        self.assertEqual(tokens, ["token-1", "token-2", "token-3"])
+
+    def test_failed_write_keeps_the_file(self):
+        cache = self.cache(ttl=3600)
+        cache.get(122, self.create)
+        with self.assertRaises(TypeError):
+            cache.put(123, {"token": object()})
+        self.assertEqual(os.listdir(self.dir.name), ["join.json"])
+        self.assertEqual(self.cache().get(122, self.create)["token"],
+                         "token-1")
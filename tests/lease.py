@@ -0,0 +1,71 @@
+import os
+import time
+import tempfile
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from app.lease import LeaseStore
+from app.logger import Logger
+
+
+class TestLeaseStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "leases.db")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_acquire_skip_taken_and_leased(self):
+        store = LeaseStore(self.path, log=Logger.ERROR)
+        first = store.acquire("vm_id", 10, lambda i: 100 + i, set([100]), 2)
+        second = store.acquire("vm_id", 10, lambda i: 100 + i, set([100]), 2)
+        self.assertEqual(first, [101, 102])
+        self.assertEqual(second, [103, 104])
+
+    def test_acquire_wrap_and_exhaust(self):
+        store = LeaseStore(self.path, log=Logger.ERROR)
+        self.assertEqual(store.acquire("vm_id", 3, lambda i: i, count=2),
+                         [0, 1])
+        store.release("vm_id", [0])
+        self.assertEqual(store.acquire("vm_id", 3, lambda i: i, count=3),
+                         [2, 0])
+
+    def test_expired_leases_are_free_again(self):
+        store = LeaseStore(self.path, ttl=0.01, log=Logger.ERROR)
+        store.acquire("vm_ip", 1, lambda i: "10.0.0.2")
+        time.sleep(0.02)
+        self.assertEqual(store.acquire("vm_ip", 1, lambda i: "10.0.0.2"),
+                         ["10.0.0.2"])
+
+    def test_concurrent_callers_get_distinct_values(self):
+        store = LeaseStore(self.path, log=Logger.ERROR)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(
+                pool.map(lambda _: store.acquire("vm_id", 100, lambda i: i),
+                         range(50)))
+        values = [x for r in results for x in r]
+        self.assertEqual(len(values), 50)
+        self.assertEqual(len(set(values)), 50)
+
+    def test_acquire_does_not_walk_the_range(self):
+        store = LeaseStore(self.path, log=Logger.ERROR)
+        store.acquire("vm_id", 10**9, lambda i: i, count=3)
+        calls = []
+
+        def value_at(i):
+            calls.append(i)
+            return i
+
+        self.assertEqual(store.acquire("vm_id", 10**9, value_at, count=2),
+                         [3, 4])
+        self.assertEqual(calls, [3, 4])
+
+    def test_reconcile_only_drops_expired(self):
+        store = LeaseStore(self.path, ttl=0.05, log=Logger.ERROR)
+        store.acquire("vm_id", 1, lambda i: 100)
+        store.acquire("vm_id", 1, lambda i: 101, ttl=60)
+        time.sleep(0.1)
+        store.reconcile("vm_id")
+        self.assertEqual([x[1] for x in store.list("vm_id")], ["101"])
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+
+from app import metrics
+from app import trace
+
+
+class Service:
+
+    @trace.traced("test_provision")
+    def provision(self, fail=False):
+        if fail:
+            raise ValueError()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.register(
+            metrics.Counter("kp_retries_total", "Retried operations", ["op"]))
+        histogram = registry.register(
+            metrics.Histogram("kp_phase_duration_seconds",
+                              "Phases", ["phase"],
+                              buckets=[1, 5]))
+        counter.inc(op="join")
+        counter.inc(2, op="join")
+        histogram.observe(0.5, phase="clone")
+        histogram.observe(1, phase="clone")
+        histogram.observe(7, phase="clone")
+        self.assertEqual(registry.render().splitlines(), [
+            "# HELP kp_retries_total Retried operations",
+            "# TYPE kp_retries_total counter",
+            'kp_retries_total{op="join"} 3',
+            "# HELP kp_phase_duration_seconds Phases",
+            "# TYPE kp_phase_duration_seconds histogram",
+            'kp_phase_duration_seconds_bucket{phase="clone",le="1"} 2',
+            'kp_phase_duration_seconds_bucket{phase="clone",le="5"} 2',
+            'kp_phase_duration_seconds_bucket{phase="clone",le="+Inf"} 3',
+            'kp_phase_duration_seconds_sum{phase="clone"} 8.5',
+            'kp_phase_duration_seconds_count{phase="clone"} 3',
+        ])
+
+    def test_traced_phase(self):
+        Service().provision()
+        with self.assertRaises(ValueError):
+            Service().provision(fail=True)
+        values = metrics.phase_duration.values
+        counts, total = values[("test_provision", "ok")]
+        self.assertEqual(sum(counts), 1)
+        self.assertIn(("test_provision", "error"), values)
+
+    def test_textfile_and_http(self):
+        registry = metrics.Registry()
+        gauge = registry.register(metrics.Gauge("kp_workers", "Worker vms"))
+        gauge.set(3)
+        with tempfile.TemporaryDirectory() as d:
+            filepath = os.path.join(d, "kp.prom")
+            registry.write_textfile(filepath)
+            self.assertEqual(os.listdir(d), ["kp.prom"])
+            with open(filepath) as f:
+                self.assertIn("kp_workers 3\n", f.read())
+        server = registry.serve(0, host="127.0.0.1")
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(
+                    f"http://127.0.0.1:{port}/metrics") as r:
+                self.assertIn("kp_workers 3", r.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
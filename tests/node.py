@@ -0,0 +1,279 @@
+import unittest
+
+from proxmoxer import ResourceException
+from app.controller.node import NodeController
+from app.error import *
+from app.logger import Logger
+
+
+class FakePath:
+
+    def __init__(self, api, path) -> None:
+        self.api = api
+        self.path = path
+
+    def __getattr__(self, name):
+        return FakePath(self.api, self.path + [name])
+
+    def __call__(self, *args):
+        return FakePath(self.api, self.path + [str(x) for x in args])
+
+    def get(self, **params):
+        return self.api.request("GET", self.path, params)
+
+    def post(self, **params):
+        return self.api.request("POST", self.path, params)
+
+    def put(self, **params):
+        return self.api.request("PUT", self.path, params)
+
+    def delete(self, **params):
+        return self.api.request("DELETE", self.path, params)
+
+
+class FakeApi:
+    """
+    api.nodes("pve").qemu(100).clone.post(newid=101) calls handler("POST", "nodes/pve/qemu/100/clone", {"newid": 101}),
+    every call is kept in calls.
+    """
+
+    def __init__(self, handler) -> None:
+        self.handler = handler
+        self.calls = []
+
+    def __getattr__(self, name):
+        return FakePath(self, [name])
+
+    def request(self, method, path, params):
+        path = "/".join(path)
+        self.calls.append((method, path, params))
+        return self.handler(method, path, params)
+
+
+def upid(node, type, vm_id):
+    return f"UPID:{node}:0001:0002:0003:{type}:{vm_id}:root@pam:"
+
+
+class CloneHandler:
+
+    def __init__(self, template=1, has_feature=1, linked="OK") -> None:
+        self.template = template
+        self.has_feature = has_feature
+        # NOTE: exitstatus of the linked clone task, or an exception raised by the post
+        self.linked = linked
+        self.tasks = {}
+
+    def __call__(self, method, path, params):
+        if path == "nodes/pve/qemu/9000/config":
+            return {"template": self.template}
+        if path == "nodes/pve/qemu/9000/feature":
+            return {"hasFeature": self.has_feature}
+        if path == "nodes/pve/qemu/9000/clone":
+            if params["full"]:
+                r = upid("pve", "qmclone-full", params["newid"])
+                self.tasks[r] = "OK"
+                return r
+            if isinstance(self.linked, Exception):
+                raise self.linked
+            r = upid("pve", "qmclone-linked", params["newid"])
+            self.tasks[r] = self.linked
+            return r
+        if path.startswith("nodes/pve/tasks/"):
+            return {"status": "stopped", "exitstatus": self.tasks[path[16:-7]]}
+        raise AssertionError(f"unexpected {method} {path}")
+
+
+def clone_posts(api):
+    return [x[2]["full"] for x in api.calls if x[1].endswith("/clone")]
+
+
+class TestNodeControllerClone(unittest.TestCase):
+
+    def nodectl(self, handler):
+        api = FakeApi(handler)
+        return api, NodeController(api, "pve", log=Logger.ERROR)
+
+    def test_auto_linked_when_template_allows(self):
+        api, nodectl = self.nodectl(CloneHandler())
+        taskctl = nodectl.clone(9000, 101, strategy="auto")
+        self.assertIn("qmclone-linked", taskctl.upid)
+        self.assertEqual(clone_posts(api), [0])
+        taskctl.wait(interval_check=0.01)
+        self.assertEqual(len(nodectl.clone_timings["linked"]), 1)
+
+    def test_auto_full_when_not_a_template_or_storage(self):
+        api, nodectl = self.nodectl(CloneHandler(template=0))
+        taskctl = nodectl.clone(9000, 101, strategy="auto")
+        self.assertIn("qmclone-full", taskctl.upid)
+        api, nodectl = self.nodectl(CloneHandler())
+        taskctl = nodectl.clone(9000, 101, strategy="auto", storage="ceph")
+        self.assertIn("qmclone-full", taskctl.upid)
+        self.assertEqual(api.calls[-1][2]["storage"], "ceph")
+
+    def test_auto_fallback_when_linked_refused(self):
+        handler = CloneHandler(linked=ResourceException(500, "", "no"))
+        api, nodectl = self.nodectl(handler)
+        taskctl = nodectl.clone(9000, 101, strategy="auto")
+        self.assertIn("qmclone-full", taskctl.upid)
+        self.assertEqual(clone_posts(api), [0, 1])
+
+    def test_auto_fallback_when_linked_task_fails(self):
+        api, nodectl = self.nodectl(CloneHandler(linked="clone failed"))
+        taskctl = nodectl.clone(9000, 101, strategy="auto")
+        self.assertIn("qmclone-full", taskctl.upid)
+        self.assertEqual(clone_posts(api), [0, 1])
+
+    def test_linked_does_not_fallback(self):
+        api, nodectl = self.nodectl(CloneHandler(linked="clone failed"))
+        taskctl = nodectl.clone(9000, 101, strategy="linked")
+        with self.assertRaises(TaskFailedError):
+            taskctl.wait(interval_check=0.01)
+        self.assertEqual(clone_posts(api), [0])
+        api, nodectl = self.nodectl(
+            CloneHandler(linked=ResourceException(500, "", "no")))
+        with self.assertRaises(ResourceException):
+            nodectl.clone(9000, 101, strategy="linked")
+
+    def test_invalid_strategy(self):
+        api, nodectl = self.nodectl(CloneHandler())
+        with self.assertRaises(InvalidCloneStrategy):
+            nodectl.clone(9000, 101, strategy="snapshot")
+
+
+class ClusterHandler:
+
+    def __init__(self) -> None:
+        self.resources = [
+            {
+                "type": "node",
+                "node": "pve1",
+                "status": "online"
+            },
+            {
+                "type": "node",
+                "node": "pve2",
+                "status": "online"
+            },
+            {
+                "type": "qemu",
+                "vmid": 101,
+                "node": "pve1"
+            },
+            {
+                "type": "qemu",
+                "vmid": 201,
+                "node": "pve2"
+            },
+        ]
+
+    def __call__(self, method, path, params):
+        if path == "cluster/resources":
+            return self.resources
+        if path.endswith("/config"):
+            vm_id = path.split("/")[3]
+            return {"ipconfig0": f"ip=10.0.0.{vm_id[0]}{vm_id[-1]}/24"}
+        if path == "nodes/pve1/network/vmbr1":
+            raise ResourceException(400, "", "interface does not exist")
+        if path == "nodes/pve2/network/vmbr1":
+            return {"cidr": "10.0.1.1/24"}
+        raise AssertionError(f"unexpected {method} {path}")
+
+
+class TestNodeControllerPlacement(unittest.TestCase):
+
+    def test_inventory_scoped_to_node_without_placement(self):
+        api = FakeApi(ClusterHandler())
+        inventory = NodeController(api, "pve1", log=Logger.ERROR).inventory()
+        self.assertEqual(inventory.ids(), set([101, 201]))
+        self.assertEqual(inventory.ips(), {101: "10.0.0.11"})
+        with self.assertRaises(VmNotFoundError):
+            inventory.find(201)
+        nodectl = NodeController(api,
+                                 "pve1",
+                                 log=Logger.ERROR,
+                                 placement="spread")
+        inventory = nodectl.inventory()
+        self.assertEqual(inventory.ips(), {101: "10.0.0.11", 201: "10.0.0.21"})
+        self.assertEqual(inventory.find(201)["node"], "pve2")
+
+    def test_locate_looks_up_a_missing_vm_once(self):
+        api = FakeApi(ClusterHandler())
+        nodectl = NodeController(api,
+                                 "pve1",
+                                 log=Logger.ERROR,
+                                 placement="spread")
+        self.assertEqual(nodectl.locate(201), "pve2")
+        self.assertEqual(nodectl.locate(999), "pve1")
+        self.assertEqual(nodectl.locate(999), "pve1")
+        self.assertEqual(nodectl.locate(201), "pve2")
+        self.assertEqual(len(api.calls), 2)
+
+    def test_locate_expires(self):
+        handler = ClusterHandler()
+        nodectl = NodeController(FakeApi(handler),
+                                 "pve1",
+                                 log=Logger.ERROR,
+                                 placement="spread")
+        self.assertEqual(nodectl.locate(201), "pve2")
+        # NOTE: migrated
+        handler.resources[3]["node"] = "pve1"
+        self.assertEqual(nodectl.locate(201), "pve2")
+        self.assertEqual(nodectl.locate(201, ttl=0), "pve1")
+
+    def test_place_template_on_local_storage(self):
+        handler = ClusterHandler()
+        handler.resources[0].update(maxcpu=8, maxmem=32 * 2**30)
+        handler.resources[1].update(maxcpu=8, maxmem=64 * 2**30)
+        template = {
+            "type": "qemu",
+            "vmid": 100,
+            "node": "pve1",
+            "template": 1,
+            "maxcpu": 2,
+            "maxmem": 2**30
+        }
+        handler.resources += [
+            template,
+            {
+                "type": "storage",
+                "node": "pve1",
+                "storage": "local-lvm",
+                "shared": 0
+            },
+            {
+                "type": "storage",
+                "node": "pve2",
+                "storage": "ceph",
+                "shared": 1
+            },
+        ]
+        disks = {"scsi0": "local-lvm:base-100-disk-0,size=32G"}
+
+        def handle(method, path, params):
+            if path == "nodes/pve1/qemu/100/config":
+                return disks
+            return handler(method, path, params)
+
+        nodectl = NodeController(FakeApi(handle),
+                                 "pve1",
+                                 log=Logger.ERROR,
+                                 placement="spread")
+        # NOTE: spread picks pve2, the one with more memory, once the disks are shared
+        self.assertEqual(nodectl.place(100, 300), "pve1")
+        template["maxmem"] = 48 * 2**30
+        with self.assertRaisesRegex(NoNodeAvailableError, "not shared"):
+            nodectl.place(100, 301)
+        disks["scsi0"] = "ceph:base-100-disk-0,size=32G"
+        self.assertEqual(nodectl.place(100, 302), "pve2")
+
+    def test_describe_network_on_another_node(self):
+        api = FakeApi(ClusterHandler())
+        nodectl = NodeController(api, "pve1", log=Logger.ERROR)
+        with self.assertRaises(ResourceException):
+            nodectl.describe_network("vmbr1")
+        nodectl = NodeController(api,
+                                 "pve1",
+                                 log=Logger.ERROR,
+                                 placement="binpack")
+        self.assertEqual(
+            nodectl.describe_network("vmbr1")["cidr"], "10.0.1.1/24")
@@ -0,0 +1,95 @@
+import unittest
+
+from app.placement import Scheduler
+from app.error import *
+
+GiB = 2**30
+
+
+def node(name, cpu=8, memory=32):
+    return {
+        "type": "node",
+        "node": name,
+        "status": "online",
+        "maxcpu": cpu,
+        "maxmem": memory * GiB
+    }
+
+
+def vm(vmid, node, cpu=2, memory=4, tags=None):
+    return {
+        "vmid": vmid,
+        "node": node,
+        "maxcpu": cpu,
+        "maxmem": memory * GiB,
+        "tags": tags
+    }
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_binpack_and_spread(self):
+        nodes = [node("pve1"), node("pve2")]
+        vms = [vm(100, "pve1", memory=8)]
+        binpack = Scheduler(nodes, vms=vms, strategy="binpack")
+        spread = Scheduler(nodes, vms=vms, strategy="spread")
+        self.assertEqual(binpack.place(cpu=2, memory=4 * GiB), "pve1")
+        self.assertEqual(spread.place(cpu=2, memory=4 * GiB), "pve2")
+
+    def test_capacity(self):
+        scheduler = Scheduler(
+            [node("pve1", memory=8),
+             node("pve2", memory=16)],
+            vms=[vm(100, "pve1", memory=6)],
+            strategy="binpack",
+            cpu_overcommit=1)
+        self.assertEqual(scheduler.place(cpu=2, memory=4 * GiB), "pve2")
+        self.assertEqual(scheduler.place(cpu=6, memory=4 * GiB), "pve2")
+        with self.assertRaises(NoNodeAvailableError):
+            scheduler.place(cpu=2, memory=4 * GiB)
+
+    def test_storage(self):
+        storages = [{
+            "node": "pve1",
+            "storage": "local-lvm",
+            "maxdisk": 100 * GiB,
+            "disk": 90 * GiB
+        }, {
+            "node": "pve2",
+            "storage": "local-lvm",
+            "maxdisk": 100 * GiB,
+            "disk": 10 * GiB
+        }]
+        scheduler = Scheduler([node("pve1"), node("pve2")], storages)
+        self.assertEqual(
+            scheduler.place(memory=GiB, disk=20 * GiB, storage="local-lvm"),
+            "pve2")
+        with self.assertRaises(NoNodeAvailableError):
+            scheduler.place(memory=GiB, disk=20 * GiB, storage="ceph")
+
+    def test_anti_affinity(self):
+        nodes = [node("pve1"), node("pve2"), node("pve3")]
+        vms = [vm(100, "pve1", tags="kp-control-plane")]
+        scheduler = Scheduler(nodes, vms=vms, strategy="binpack")
+        placed = [
+            scheduler.place(cpu=2,
+                            memory=4 * GiB,
+                            anti_affinity_tag="kp-control-plane")
+            for _ in range(3)
+        ]
+        self.assertEqual(sorted(placed[:2]), ["pve2", "pve3"])
+        self.assertEqual(placed[2], "pve1")
+
+    def test_only_given_nodes(self):
+        scheduler = Scheduler([node("pve1"), node("pve2", memory=64)])
+        self.assertEqual(
+            scheduler.place(cpu=2, memory=4 * GiB, nodes=["pve1"]), "pve1")
+        with self.assertRaisesRegex(NoNodeAvailableError, "template 100"):
+            scheduler.place(cpu=2,
+                            memory=40 * GiB,
+                            nodes=["pve1"],
+                            reason="template 100 disks are not shared")
+
+    def test_invalid_strategy(self):
+        with self.assertRaises(InvalidPlacementStrategy):
+            Scheduler([node("pve1")], strategy="random")
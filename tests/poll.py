@@ -0,0 +1,71 @@
+import unittest
+
+from app import poll
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_backoff_grows_up_to_cap(self):
+        backoff = poll.Backoff(initial=0.1, max_interval=0.5, jitter=0)
+        delays = [backoff.next() for _ in range(5)]
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.5, 0.5])
+
+    def test_backoff_jitter_in_range(self):
+        backoff = poll.Backoff(initial=1, max_interval=1, jitter=0.1)
+        for _ in range(100):
+            self.assertTrue(0.9 <= backoff.next() <= 1.1)
+
+
+class TestPoll(unittest.TestCase):
+
+    def test_poll_checks_right_away(self):
+        fake = FakeClock()
+        r = poll.poll(lambda: "done", sleep=fake.sleep, clock=fake.clock)
+        self.assertEqual(r, "done")
+        self.assertEqual(fake.sleeps, [])
+
+    def test_poll_backs_off_until_ready(self):
+        fake = FakeClock()
+        results = iter([None, None, None, 1])
+        r = poll.poll(lambda: next(results),
+                      jitter=0,
+                      initial=0.1,
+                      sleep=fake.sleep,
+                      clock=fake.clock)
+        self.assertEqual(r, 1)
+        self.assertEqual(fake.sleeps, [0.1, 0.2, 0.4])
+
+    def test_poll_respects_cap(self):
+        fake = FakeClock()
+        results = iter([None] * 6 + [True])
+        poll.poll(lambda: next(results),
+                  jitter=0,
+                  initial=1,
+                  max_interval=3,
+                  sleep=fake.sleep,
+                  clock=fake.clock)
+        self.assertEqual(fake.sleeps, [1, 2, 3, 3, 3, 3])
+
+    def test_poll_timeout(self):
+        fake = FakeClock()
+        with self.assertRaises(TimeoutError):
+            poll.poll(lambda: False,
+                      timeout=5,
+                      jitter=0,
+                      sleep=fake.sleep,
+                      clock=fake.clock)
+        self.assertAlmostEqual(sum(fake.sleeps), 5)
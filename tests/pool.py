@@ -0,0 +1,208 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from app.controller.inventory import Inventory
+from app.service.pool import WarmPoolService
+from app.lease import LeaseStore
+from app.error import *
+from app.logger import Logger
+
+READY = "kp-worker;kp-warm"
+BOOTING = "kp-worker;kp-warm-booting"
+
+
+class StubVmController:
+
+    def __init__(self, nodectl, vm_id) -> None:
+        self.nodectl = nodectl
+        self.vm_id = vm_id
+
+    def current_config(self):
+        return {"tags": self.nodectl.vms[self.vm_id]["tags"], "digest": "1"}
+
+    def update_config(self, tags=None, **kwargs):
+        if self.vm_id in self.nodectl.untaggable:
+            raise Exception("vm is locked")
+        self.nodectl.vms[self.vm_id]["tags"] = tags
+
+
+class StubNodeController:
+
+    def __init__(self, vms={}, leases=None) -> None:
+        self.vms = {
+            k: {
+                "vmid": k,
+                "node": "pve",
+                "tags": v,
+                "status": "running"
+            }
+            for k, v in vms.items()
+        }
+        self.leases = leases
+        self.untaggable = set()
+
+    def inventory(self):
+        return Inventory(None,
+                         "pve",
+                         list(dict(x) for x in self.vms.values()),
+                         log=Logger.ERROR)
+
+    def vmctl(self, vm_id):
+        return StubVmController(self, vm_id)
+
+
+class StubWorkerService:
+
+    def __init__(self, nodectl, failing=set(), blocked=None) -> None:
+        self.nodectl = nodectl
+        self.failing = failing
+        self.blocked = blocked
+        self.calls = []
+        self.joined = []
+        self.failing_joins = set()
+
+    def prefetch_join_command(self, executor, control_plane_vm_id):
+        return None
+
+    def join_worker(self, vm_id, control_plane_vm_id, join_cmd_future=None):
+        if vm_id in self.failing_joins:
+            raise JoinFailedError(vm_id, 1, "connection refused")
+        self.joined.append(vm_id)
+
+    def create_workers(self, count, tags=None, join=True, **kwargs):
+        self.calls.append(count)
+        if self.blocked:
+            self.blocked.wait()
+        results = []
+        for i in range(count):
+            vm_id = 200 + len(self.nodectl.vms)
+            self.nodectl.vms[vm_id] = {
+                "vmid": vm_id,
+                "node": "pve",
+                "tags": tags,
+                "status": "running"
+            }
+            error = Exception("boot failed") if i in self.failing else None
+            results.append({"vm_id": vm_id, "vm_ip": None, "error": error})
+        return results
+
+
+class StubVmService:
+
+    def __init__(self, nodectl) -> None:
+        self.nodectl = nodectl
+        self.deleted = []
+
+    def delete_vms(self, vm_ids, inventory=None):
+        for vm_id in vm_ids:
+            self.nodectl.vms.pop(vm_id)
+        self.deleted.extend(vm_ids)
+        return [{"vm_id": x, "error": None} for x in vm_ids]
+
+
+def warm_pool(nodectl, **kwargs):
+    service = WarmPoolService(nodectl, log=Logger.ERROR)
+    service.workerservice = StubWorkerService(nodectl, **kwargs)
+    service.vmservice = StubVmService(nodectl)
+    return service
+
+
+def tags(nodectl):
+    return sorted(x["tags"] for x in nodectl.vms.values())
+
+
+class TestWarmPool(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.leases = LeaseStore(os.path.join(self.dir.name, "leases.db"),
+                                 log=Logger.ERROR)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def nodectl(self, vms={}):
+        return StubNodeController(vms, leases=self.leases)
+
+    def test_fill_missing(self):
+        nodectl = self.nodectl({100: READY, 101: "kp-worker"})
+        service = warm_pool(nodectl)
+        results = service.fill(3)
+        self.assertEqual(service.workerservice.calls, [2])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(tags(nodectl), ["kp-worker"] + [READY] * 3)
+        self.assertEqual(service.fill(3), [])
+
+    def test_fill_drops_stale_booting(self):
+        nodectl = self.nodectl({100: READY, 101: BOOTING})
+        service = warm_pool(nodectl)
+        service.fill(2)
+        self.assertEqual(service.vmservice.deleted, [101])
+        self.assertEqual(service.workerservice.calls, [1])
+        self.assertEqual(tags(nodectl), [READY] * 2)
+
+    def test_fill_deletes_failed(self):
+        nodectl = self.nodectl()
+        service = warm_pool(nodectl, failing=set([0]))
+        nodectl.untaggable.add(201)
+        results = service.fill(3)
+        self.assertEqual([r["error"] is None for r in results],
+                         [False, False, True])
+        self.assertEqual(service.vmservice.deleted, [200, 201])
+        self.assertEqual(tags(nodectl), [READY])
+
+    def test_one_fill_at_a_time(self):
+        nodectl = self.nodectl()
+        blocked = threading.Event()
+        service = warm_pool(nodectl, blocked=blocked)
+        thread = service.refill_in_background(2)
+        self.assertFalse(thread.daemon)
+        while not service.workerservice.calls:
+            thread.join(0.01)
+        self.assertEqual(service.fill(2), [])
+        blocked.set()
+        thread.join()
+        self.assertEqual(service.workerservice.calls, [2])
+        self.assertEqual(tags(nodectl), [READY] * 2)
+
+    def test_fill_lease(self):
+        leases = self.leases
+        nodectl = self.nodectl()
+        service = warm_pool(nodectl)
+        # NOTE: a fill of another process
+        other = leases.acquire("warm_pool", 1, lambda i: "fill")
+        self.assertEqual(service.fill(1), [])
+        leases.release("warm_pool", other)
+        self.assertEqual(len(service.fill(1)), 1)
+        self.assertEqual(leases.list("warm_pool"), [])
+
+    def test_fill_needs_leases(self):
+        # NOTE: without leases a fill could delete the booting workers of another process
+        nodectl = StubNodeController({101: BOOTING})
+        service = warm_pool(nodectl)
+        with self.assertRaises(LeasesRequiredError):
+            service.fill(1)
+        self.assertEqual(service.vmservice.deleted, [])
+
+    def test_create_worker_from_pool(self):
+        nodectl = self.nodectl({100: READY})
+        service = warm_pool(nodectl)
+        service.refill_in_background = lambda *args, **kwargs: None
+        self.assertEqual(service.create_worker(101), 100)
+        self.assertEqual(service.workerservice.joined, [100])
+        self.assertEqual(tags(nodectl), ["kp-worker"])
+
+    def test_create_worker_join_fails(self):
+        nodectl = self.nodectl({100: READY})
+        service = warm_pool(nodectl)
+        refills = []
+        service.refill_in_background = lambda *args, **kwargs: refills.append(
+            args)
+        service.workerservice.failing_joins.add(100)
+        with self.assertRaises(JoinFailedError):
+            service.create_worker(101)
+        # NOTE: not put back in the pool, deleted and replaced
+        self.assertEqual(service.vmservice.deleted, [100])
+        self.assertEqual(refills, [(0, )])
@@ -0,0 +1,174 @@
+import os
+import tempfile
+import unittest
+import ipaddress
+
+from app.cmd.reconcile import load_cluster_spec
+from app.controller.inventory import Inventory
+from app.controller.node import NodeController
+from app.ippool import IpPool
+from app.lease import LeaseStore
+from app.service.reconcile import ReconcileService
+from app.error import *
+from app.logger import Logger
+
+
+class StubNodeController:
+
+    def __init__(self, vms) -> None:
+        self.vms = [{
+            "vmid": k,
+            "node": "pve",
+            "tags": v
+        } for k, v in vms.items()]
+
+    def inventory(self):
+        return Inventory(None, "pve", self.vms, log=Logger.ERROR)
+
+    def vm_network(self, vm_network_name, preserved_ips=[]):
+        return None, "10.0.0.1", preserved_ips
+
+    def new_vm_ids(self, count, vm_id_range, inventory=None, reserve=True):
+        return [500 + i for i in range(count)]
+
+    def new_vm_ips(self,
+                   count,
+                   ip_pool,
+                   preserved_ips,
+                   inventory=None,
+                   reserve=True):
+        return [f"10.0.0.{50 + i}" for i in range(count)]
+
+
+class LeasingNodeController(NodeController):
+    """
+    A real NodeController on an empty cluster.
+    """
+
+    def inventory(self):
+        return Inventory(None, "pve", [], log=Logger.ERROR)
+
+    def vm_network(self, vm_network_name, preserved_ips=[]):
+        network = ipaddress.IPv4Network("10.0.0.0/28")
+        return IpPool(network, ["10.0.0.1"]), "10.0.0.1", ["10.0.0.1"]
+
+
+def spec(load_balancer=True, control_plane_count=1, worker_count=0):
+    return dict(load_balancer=load_balancer,
+                control_plane_count=control_plane_count,
+                worker_count=worker_count)
+
+
+def plan(vms, cluster_spec, **kwargs):
+    service = ReconcileService(StubNodeController(vms), log=Logger.ERROR)
+    steps = service.plan(cluster_spec, "vmbr0", **kwargs)
+    return [(x["name"], x["deps"]) for x in steps]
+
+
+class TestReconcilePlan(unittest.TestCase):
+
+    def test_converged(self):
+        vms = {100: "kp-lb", 101: "kp-control-plane", 102: "kp-worker"}
+        self.assertEqual(plan(vms, spec(worker_count=1)), [])
+
+    def test_untagged_configured_vms_count(self):
+        # NOTE: a cluster created before the role tags
+        vms = {100: None, 101: "", 102: "kp-worker"}
+        steps = plan(vms,
+                     spec(worker_count=1),
+                     load_balancer_vm_id=100,
+                     control_plane_vm_id=101)
+        self.assertEqual(steps, [])
+
+    def test_configured_control_plane_kept_first(self):
+        vms = {100: "kp-lb", 101: "kp-control-plane", 105: None}
+        steps = plan(vms,
+                     spec(control_plane_count=1),
+                     load_balancer_vm_id=100,
+                     control_plane_vm_id=105)
+        self.assertEqual(steps, [("delete control-plane 101", [])])
+
+    def test_create_order(self):
+        steps = plan({}, spec(control_plane_count=2, worker_count=2))
+        self.assertEqual(steps, [
+            ("create lb 500", []),
+            ("create control-plane 501", ["create lb 500"]),
+            ("create control-plane 502", ["create control-plane 501"]),
+            ("create worker 503", ["create control-plane 501"]),
+            ("create worker 504", ["create control-plane 501"]),
+        ])
+
+    def test_delete_order(self):
+        vms = {
+            100: "kp-lb",
+            101: "kp-control-plane",
+            102: "kp-control-plane",
+            103: "kp-control-plane",
+            110: "kp-worker",
+            111: "kp-worker",
+            112: "kp-worker;kp-warm",
+        }
+        steps = plan(vms, spec(control_plane_count=1, worker_count=1))
+        self.assertEqual(steps, [
+            ("delete worker 111", []),
+            ("delete control-plane 103", ["delete worker 111"]),
+            ("delete control-plane 102",
+             ["delete worker 111", "delete control-plane 103"]),
+        ])
+
+    def test_spec_counts_are_required(self):
+        vms = {100: "kp-lb", 101: "kp-control-plane", 102: "kp-worker"}
+        with self.assertRaises(InvalidClusterSpec):
+            plan(vms, {"load_balancer": True, "control_plane_count": 1})
+        self.assertEqual(plan(vms, spec(worker_count=0)),
+                         [("delete worker 102", [])])
+
+    def test_multiple_control_planes_need_lb(self):
+        with self.assertRaises(ValueError):
+            plan({}, spec(load_balancer=False, control_plane_count=3))
+
+    def test_load_cluster_spec(self):
+        with self.assertRaises(InvalidClusterSpec):
+            load_cluster_spec({})
+        with self.assertRaises(InvalidClusterSpec):
+            load_cluster_spec({"cluster_spec": {}})
+        self.assertEqual(load_cluster_spec({"cluster_spec": spec()}), spec())
+
+
+class TestReconcileLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.leases = LeaseStore(os.path.join(self.dir.name, "leases.db"),
+                                 log=Logger.ERROR)
+        self.nodectl = LeasingNodeController(None,
+                                             "pve",
+                                             log=Logger.ERROR,
+                                             leases=self.leases)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def plan(self):
+        service = ReconcileService(self.nodectl, log=Logger.ERROR)
+        steps = service.plan(spec(worker_count=1),
+                             "vmbr0",
+                             vm_id_range=[100, 199])
+        return [(x["vm_id"], x["vm_ip"]) for x in steps]
+
+    def test_plan_does_not_lease(self):
+        first = self.plan()
+        self.assertEqual(first, self.plan())
+        self.assertEqual(self.leases.list(), [])
+        self.assertEqual(len(first), 3)
+
+    def test_plan_skips_leased(self):
+        first = self.plan()
+        self.nodectl.claim_leases([x[0] for x in first], [x[1] for x in first])
+        second = self.plan()
+        self.assertFalse(set(first).intersection(second))
+        with self.assertRaises(LeaseTakenError):
+            self.nodectl.claim_leases([first[0][0]], [])
+        self.nodectl.release_leases([x[0] for x in first],
+                                    [x[1] for x in first])
+        self.assertEqual(self.plan(), first)
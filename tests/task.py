@@ -0,0 +1,97 @@
+import unittest
+
+from app.controller.task import TaskController
+from app.error import TaskFailedError
+from app.logger import Logger
+
+UPID = "UPID:pve:0001:0002:0003:qmclone:101:root@pam:"
+
+
+class FakeTaskApi:
+    """
+    api.nodes(node).tasks(upid).status.get() returns the next of statuses, the last one is repeated.
+    """
+
+    def __init__(self, statuses) -> None:
+        self.statuses = list(statuses)
+        self.calls = []
+        self.status = self
+
+    def nodes(self, node):
+        self.calls.append(node)
+        return self
+
+    def tasks(self, upid):
+        self.calls.append(upid)
+        return self
+
+    def get(self):
+        if len(self.statuses) > 1:
+            return self.statuses.pop(0)
+        return self.statuses[0]
+
+
+class TestTaskController(unittest.TestCase):
+
+    def test_is_ok(self):
+        self.assertTrue(TaskController.is_ok("OK"))
+        self.assertTrue(TaskController.is_ok("WARNINGS: 1"))
+        self.assertFalse(TaskController.is_ok("clone failed"))
+        self.assertFalse(TaskController.is_ok(""))
+        self.assertFalse(TaskController.is_ok(None))
+
+    def test_wait_success(self):
+        api = FakeTaskApi([{
+            "status": "running"
+        }, {
+            "status": "stopped",
+            "exitstatus": "OK"
+        }])
+        done = []
+        taskctl = TaskController(api,
+                                 UPID,
+                                 on_done=lambda *args: done.append(args),
+                                 log=Logger.ERROR)
+        exitstatus, duration = taskctl.wait(timeout=5, interval_check=0.01)
+        self.assertEqual(taskctl.node, "pve")
+        self.assertEqual(exitstatus, "OK")
+        self.assertEqual(done, [("OK", duration)])
+        self.assertEqual(api.calls[:2], ["pve", UPID])
+
+    def test_wait_failure_raises(self):
+        api = FakeTaskApi([{
+            "status": "stopped",
+            "exitstatus": "clone failed"
+        }])
+        done = []
+        taskctl = TaskController(api,
+                                 UPID,
+                                 on_done=lambda *args: done.append(args),
+                                 log=Logger.ERROR)
+        with self.assertRaises(TaskFailedError) as ctx:
+            taskctl.wait(timeout=5, interval_check=0.01)
+        self.assertEqual(ctx.exception.exitstatus, "clone failed")
+        # NOTE: on_done is called before the check
+        self.assertEqual(done[0][0], "clone failed")
+
+    def test_wait_failure_without_check(self):
+        api = FakeTaskApi([{
+            "status": "stopped",
+            "exitstatus": "clone failed"
+        }])
+        taskctl = TaskController(api, UPID, log=Logger.ERROR)
+        exitstatus, _ = taskctl.wait(timeout=5,
+                                     interval_check=0.01,
+                                     check=False)
+        self.assertEqual(exitstatus, "clone failed")
+
+    def test_wait_timeout(self):
+        api = FakeTaskApi([{"status": "running"}])
+        done = []
+        taskctl = TaskController(api,
+                                 UPID,
+                                 on_done=lambda *args: done.append(args),
+                                 log=Logger.ERROR)
+        with self.assertRaises(TimeoutError):
+            taskctl.wait(timeout=0.05, interval_check=0.01)
+        self.assertEqual(done, [])
@@ -0,0 +1,75 @@
+import json
+import tempfile
+import unittest
+
+from app import trace
+
+
+class Service:
+
+    @trace.traced("provision_worker", vm_id_arg="new_vm_id")
+    def provision(self, new_vm_id, fail=False):
+        with trace.span("clone", vm_id=new_vm_id):
+            pass
+        if fail:
+            raise ValueError("no ip")
+        return new_vm_id
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.enabled = trace.tracer.enabled
+        trace.tracer = trace.Tracer(enabled=True)
+
+    def tearDown(self):
+        trace.tracer = trace.Tracer(enabled=self.enabled)
+
+    def test_spans(self):
+        service = Service()
+        self.assertEqual(service.provision(101), 101)
+        with self.assertRaises(ValueError):
+            service.provision(new_vm_id=102, fail=True)
+        events = trace.tracer.export()["traceEvents"]
+        self.assertEqual([(x["name"], x["args"]["vm_id"], x["args"]["outcome"])
+                          for x in events],
+                         [("clone", 101, "ok"),
+                          ("provision_worker", 101, "ok"),
+                          ("clone", 102, "ok"),
+                          ("provision_worker", 102, "ValueError: no ip")])
+        self.assertTrue(all(x["ph"] == "X" and x["dur"] >= 0 for x in events))
+
+    def test_http_calls(self):
+        tracer = trace.tracer
+        tracer.record_http(
+            "GET",
+            "https://pve:8006/api2/json/nodes/pve2/qemu/101/agent/exec-status?pid=3",
+            200, 0.02)
+        tracer.record_http(
+            "GET",
+            "https://pve:8006/api2/json/nodes/pve/qemu/102/agent/exec-status",
+            200, 0.03)
+        tracer.record_http(
+            "GET",
+            "https://pve:8006/api2/json/nodes/pve/tasks/UPID:pve:0001:02:03:qmclone:101:root@pam:/status",
+            200, 0.01)
+        with tempfile.NamedTemporaryFile("r") as f:
+            tracer.write(f.name)
+            exported = json.load(f)
+        self.assertEqual(
+            exported["otherData"]["http_calls"], {
+                "GET nodes/{node}/qemu/{id}/agent/exec-status": {
+                    "count": 2,
+                    "seconds": 0.05
+                },
+                "GET nodes/{node}/tasks/{upid}/status": {
+                    "count": 1,
+                    "seconds": 0.01
+                },
+            })
+        self.assertEqual(len(exported["traceEvents"]), 3)
+
+    def test_disabled(self):
+        trace.tracer = trace.Tracer(enabled=False)
+        self.assertEqual(Service().provision(101), 101)
+        self.assertEqual(trace.tracer.events, [])
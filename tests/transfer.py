@@ -0,0 +1,177 @@
+import os
+import base64
+import asyncio
+import hashlib
+import tempfile
+import unittest
+import subprocess
+
+from app.controller.vm import VmController
+from app.controller.aio import AsyncVmController
+from app.error import *
+from app.logger import Logger
+from app import metrics
+
+
+class LocalVmController(VmController):
+    """
+    Runs the guest commands with the local shell, file-write goes to the local disk.
+    """
+
+    def __init__(self, corrupt=[]) -> None:
+        super().__init__(None, "pve", 100, log=Logger.ERROR)
+        self.corrupt = list(corrupt)
+        self.writes = []
+        self.processes = {}
+        self.execs = []
+
+    def exec(self, cmd, timeout=None, interval_check=None):
+        self.execs.append(cmd)
+        p = subprocess.run(cmd, capture_output=True, text=True)
+        return p.returncode, p.stdout, p.stderr
+
+    def exec_start(self, cmd):
+        p = subprocess.Popen(cmd,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             text=True)
+        self.processes[p.pid] = p
+        return p.pid
+
+    def exec_status(self, pid):
+        p = self.processes[pid]
+        if p.poll() is None:
+            return None
+        stdout, stderr = p.communicate()
+        return {
+            "exited": 1,
+            "exitcode": p.returncode,
+            "out-data": stdout,
+            "err-data": stderr
+        }
+
+    def write_file(self, filepath, content, encode=True):
+        self.writes.append(filepath)
+        data = content.encode() if encode else base64.b64decode(content)
+        if filepath in self.corrupt:
+            self.corrupt.remove(filepath)
+            data = data[:-1]
+        with open(filepath, "wb") as f:
+            f.write(data)
+
+
+class TestFileTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.dir.name, "cni.yaml")
+        self.data = os.urandom(10 * 1024 + 7)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_upload_and_download(self):
+        vmctl = LocalVmController()
+        vmctl.upload_file(self.filepath, self.data, chunk_size=1024)
+        self.assertEqual(os.listdir(self.dir.name), ["cni.yaml"])
+        self.assertEqual(vmctl.download_file(self.filepath, chunk_size=4096),
+                         self.data)
+
+    def test_upload_resend_corrupt_part(self):
+        part = self.expected_parts(1024)[3]
+        vmctl = LocalVmController(corrupt=[part])
+        vmctl.upload_file(self.filepath, self.data, chunk_size=1024)
+        self.assertEqual(vmctl.writes.count(part), 2)
+        self.assertEqual(len(vmctl.writes), 12)
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_upload_resume_keeps_good_parts(self):
+        vmctl = LocalVmController()
+        parts = self.expected_parts(1024)
+        for i in range(5):
+            chunk = self.data[i * 1024:(i + 1) * 1024]
+            vmctl.write_file(parts[i], base64.b64encode(chunk).decode(), False)
+        vmctl.writes = []
+        vmctl.upload_file(self.filepath, self.data, chunk_size=1024)
+        self.assertEqual(vmctl.writes, parts[5:])
+
+    def test_upload_gives_up(self):
+        vmctl = LocalVmController()
+        vmctl.write_file = lambda *args, **kwargs: None
+        with self.assertRaises(FileTransferError):
+            vmctl.upload_file(self.filepath,
+                              self.data,
+                              chunk_size=1024,
+                              retries=1)
+
+    def expected_parts(self, chunk_size):
+        prefix = f"{self.filepath}.kp-{hashlib.sha256(self.data).hexdigest()[:12]}"
+        count = -(-len(self.data) // chunk_size)
+        return [f"{prefix}.{i}" for i in range(count)]
+
+
+class TestExecStream(unittest.TestCase):
+
+    def test_exec_stream(self):
+        vmctl = LocalVmController()
+        chunks = []
+        script = (
+            "for i in 1 2 3; do printf 'ligne-%s-é\\n' $i; sleep 0.2; done;"
+            " echo oops >&2; exit 3")
+        with tempfile.NamedTemporaryFile("r") as f:
+            exitcode, stdout, stderr = vmctl.exec_stream(["sh", "-c", script],
+                                                         stdout=chunks.append,
+                                                         stderr=f.name,
+                                                         tail_size=10,
+                                                         interval_check=0.05,
+                                                         chunk_size=5)
+            self.assertEqual(f.read(), "oops\n")
+        self.assertEqual(exitcode, 3)
+        self.assertEqual("".join(chunks), "ligne-1-é\nligne-2-é\nligne-3-é\n")
+        # NOTE: read while running, not in one piece at the end
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(stdout, "ligne-3-é\n")
+        self.assertEqual(stderr, "oops\n")
+
+    def test_exec_stream_reads_without_exec(self):
+        vmctl = LocalVmController()
+        exitcode, stdout, _ = vmctl.exec_stream(["echo", "hello"],
+                                                tail_size=0,
+                                                interval_check=0.05)
+        self.assertEqual(exitcode, 0)
+        self.assertEqual(stdout, "")
+        # NOTE: only the cleanup, the reads do not go through exec
+        self.assertEqual([x[:2] for x in vmctl.execs], [["rm", "-f"]])
+
+    def test_exec_stream_timeout_survives_cleanup_error(self):
+        vmctl = LocalVmController()
+
+        def exec(cmd, timeout=None, interval_check=None):
+            raise ConnectionError("agent gone")
+
+        vmctl.exec = exec
+        timeouts = metrics.timeouts.values.get(("exec_stream", ), 0)
+        with self.assertRaises(TimeoutError):
+            vmctl.exec_stream(["sleep", "1"], timeout=0.1, interval_check=0.02)
+        self.assertEqual(metrics.timeouts.values[("exec_stream", )],
+                         timeouts + 1)
+        for p in vmctl.processes.values():
+            p.kill()
+            p.communicate()
+
+    def test_async_exec_stream(self):
+        vmctl = AsyncVmController(None, "pve", 100, log=Logger.ERROR)
+        vmctl.sync = LocalVmController()
+        chunks = []
+        script = "for i in 1 2; do echo ligne-$i; sleep 0.2; done; exit 3"
+        exitcode, stdout, _ = asyncio.run(
+            vmctl.exec_stream(["sh", "-c", script],
+                              stdout=chunks.append,
+                              tail_size=8,
+                              interval_check=0.05,
+                              chunk_size=4))
+        self.assertEqual(exitcode, 3)
+        self.assertEqual("".join(chunks), "ligne-1\nligne-2\n")
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(stdout, "ligne-2\n")
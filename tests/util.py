@@ -51,3 +51,125 @@ class TestProxmoxUtil(unittest.TestCase):
             util.ProxmoxUtil.extract_ip(
                 "ip=192.168.56.123/24,gw=192.168.56.1"), "192.168.56.123")
 
+    def test_split_tags(self):
+        self.assertEqual(util.ProxmoxUtil.split_tags("kp-warm;k8s"),
+                         ["kp-warm", "k8s"])
+        self.assertEqual(util.ProxmoxUtil.split_tags(None), [])
+
+
+class TestDiskStorages(unittest.TestCase):
+
+    def test_disk_storages(self):
+        vm_config = {
+            "scsi0": "local-lvm:base-100-disk-0,size=32G",
+            "efidisk0": "ceph:base-100-disk-1,size=4M",
+            "ide2": "local:iso/debian.iso,media=cdrom",
+            "ide0": "local-lvm:vm-100-cloudinit,media=cdrom",
+            "sata1": "none,media=cdrom",
+            "net0": "virtio,bridge=vmbr0",
+            "name": "template",
+        }
+        self.assertEqual(util.ProxmoxUtil.disk_storages(vm_config),
+                         {"local-lvm", "ceph"})
+
+
+class TestRunGraph(unittest.TestCase):
+
+    def test_run_graph_order(self):
+        order = []
+        steps = [
+            {
+                "name": "b",
+                "deps": ["a"]
+            },
+            {
+                "name": "a",
+                "deps": []
+            },
+            {
+                "name": "c",
+                "deps": ["b"]
+            },
+        ]
+        results = util.run_graph(steps, lambda s: order.append(s["name"]))
+        self.assertEqual(order, ["a", "b", "c"])
+        self.assertTrue(all(r["error"] is None for r in results.values()))
+
+    def test_run_graph_skip_dependents_of_failed_step(self):
+
+        def run(step):
+            if step["name"] == "a":
+                raise ValueError("a")
+            return step["name"]
+
+        steps = [
+            {
+                "name": "a",
+                "deps": []
+            },
+            {
+                "name": "b",
+                "deps": ["a"]
+            },
+            {
+                "name": "c",
+                "deps": ["b"]
+            },
+            {
+                "name": "d",
+                "deps": []
+            },
+        ]
+        results = util.run_graph(steps, run)
+        self.assertIsInstance(results["a"]["error"], ValueError)
+        self.assertIsInstance(results["b"]["error"],
+                              util.DependencyFailedError)
+        self.assertIsInstance(results["c"]["error"],
+                              util.DependencyFailedError)
+        self.assertEqual(results["d"]["result"], "d")
+
+
+class TestKubeUtil(unittest.TestCase):
+
+    def test_parse_quantity(self):
+        self.assertEqual(util.KubeUtil.parse_quantity("100m"), 0.1)
+        self.assertEqual(util.KubeUtil.parse_quantity("2"), 2)
+        self.assertEqual(util.KubeUtil.parse_quantity("1Gi"), 2**30)
+        self.assertEqual(util.KubeUtil.parse_quantity("500M"), 500e6)
+        self.assertEqual(util.KubeUtil.parse_quantity(None), 0)
+
+    def test_parse_quantity_every_suffix(self):
+        parse = util.KubeUtil.parse_quantity
+        self.assertAlmostEqual(parse("250n"), 250e-9)
+        self.assertAlmostEqual(parse("5u"), 5e-6)
+        self.assertEqual(parse("1.5k"), 1500)
+        self.assertEqual(parse("2T"), 2e12)
+        self.assertEqual(parse("1P"), 1e15)
+        self.assertEqual(parse("1E"), 1e18)
+        self.assertEqual(parse("1Ti"), 2**40)
+        self.assertEqual(parse("1Pi"), 2**50)
+        self.assertEqual(parse("2Ei"), 2**61)
+        self.assertEqual(parse("1e3"), 1000)
+        self.assertEqual(parse("12E6"), 12e6)
+        self.assertEqual(parse(".5"), 0.5)
+        for invalid in ["1Zi", "abc", "1 Gi", "1mi"]:
+            with self.assertRaises(ValueError):
+                parse(invalid)
+
+    def test_parse_and_build_join_command(self):
+        credentials = util.KubeUtil.parse_join_command(
+            "kubeadm join 10.0.0.1:6443 --token abc.def"
+            " --discovery-token-ca-cert-hash sha256:123 \n")
+        self.assertEqual(
+            credentials, {
+                "endpoint": "10.0.0.1:6443",
+                "token": "abc.def",
+                "ca_cert_hash": "sha256:123"
+            })
+        credentials["certificate_key"] = "key"
+        self.assertEqual(
+            util.KubeUtil.build_join_command(credentials,
+                                             is_control_plane=True)[-4:],
+            ["sha256:123", "--control-plane", "--certificate-key", "key"])
+        with self.assertRaises(ValueError):
+            util.KubeUtil.parse_join_command("error: timed out")
@@ -0,0 +1,55 @@
+import time
+import unittest
+
+from app.service.vm import VmService
+from app.logger import Logger
+
+
+class StubVmController:
+
+    def __init__(self, vm_id, exits_after) -> None:
+        self.vm_id = vm_id
+        self.exits_after = exits_after
+        self.started_at = None
+
+    def exec_start(self, cmd):
+        if self.exits_after is None:
+            raise Exception("guest agent is not running")
+        self.started_at = time.monotonic()
+        return 1000 + self.vm_id
+
+    def exec_status(self, pid):
+        if time.monotonic() - self.started_at < self.exits_after:
+            return None
+        return {"exited": 1, "exitcode": 0, "out-data": str(pid)}
+
+
+class StubNodeController:
+
+    def __init__(self, exits_after) -> None:
+        self.exits_after = exits_after
+
+    def inventory(self):
+        return None
+
+    def vmctl(self, vm_id):
+        return StubVmController(vm_id, self.exits_after[vm_id])
+
+
+class TestExecVms(unittest.TestCase):
+
+    def test_exec_vms(self):
+        nodectl = StubNodeController({101: 0.2, 102: 0, 103: None, 104: 5})
+        streamed = []
+        results = VmService(nodectl, log=Logger.ERROR).exec_vms(
+            [101, 102, 103, 104], ["true"],
+            timeout=0.5,
+            max_interval=0.05,
+            on_result=lambda r: streamed.append(r["vm_id"]))
+        # NOTE: results come as the vms finish, returned in the asked order
+        self.assertEqual(streamed, [103, 102, 101, 104])
+        self.assertEqual([r["vm_id"] for r in results], [101, 102, 103, 104])
+        self.assertEqual(results[0]["stdout"], "1101")
+        self.assertIsNone(results[1]["error"])
+        self.assertIsNotNone(results[2]["error"])
+        self.assertIsInstance(results[3]["error"], TimeoutError)
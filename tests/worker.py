@@ -0,0 +1,134 @@
+import ipaddress
+import threading
+import unittest
+
+from app.service.worker import WorkerService
+from app.error import *
+from app.logger import Logger
+
+
+class StubTask:
+
+    def wait(self):
+        pass
+
+
+class StubIpPool:
+    network = ipaddress.ip_network("10.0.0.0/24")
+
+
+class StubWorkerVmController:
+
+    def __init__(self, nodectl, vm_id) -> None:
+        self.nodectl = nodectl
+        self.vm_id = vm_id
+
+    def update_config(self, **kwargs):
+        pass
+
+    def resize_disk(self, disk, size):
+        pass
+
+    def startup(self):
+        return StubTask()
+
+    def wait_for_guest_agent(self):
+        if self.vm_id in self.nodectl.no_agent:
+            raise TimeoutError()
+
+    def exec(self, cmd):
+        with self.nodectl.lock:
+            self.nodectl.joins.append(self.vm_id)
+        if self.vm_id in self.nodectl.failing_joins:
+            return 1, "", "connection refused"
+        return 0, "", ""
+
+
+class StubNodeController:
+
+    def __init__(self, no_agent=set(), failing_joins=set()) -> None:
+        self.no_agent = no_agent
+        self.failing_joins = failing_joins
+        self.lock = threading.Lock()
+        self.joins = []
+        self.released = ([], [])
+        self.join_cache = None
+
+    def vm_network(self, vm_network_name, preserved_ips=[]):
+        return StubIpPool(), "10.0.0.1", preserved_ips
+
+    def inventory(self):
+        return None
+
+    def new_vm_ids(self, count, vm_id_range, inventory=None):
+        return [200 + i for i in range(count)]
+
+    def new_vm_ips(self, count, ip_pool, preserved_ips, inventory=None):
+        return [f"10.0.0.{20 + i}" for i in range(count)]
+
+    def release_leases(self, vm_ids=[], vm_ips=[]):
+        self.released[0].extend(vm_ids)
+        self.released[1].extend(vm_ips)
+
+    def place(self, template_id, vm_id, **kwargs):
+        return None
+
+    def clone(self, template_id, vm_id, **kwargs):
+        return StubTask()
+
+    def join_command(self, control_plane_vm_id):
+        return ["kubeadm", "join", "10.0.0.2:6443"]
+
+    def wkctl(self, vm_id):
+        return StubWorkerVmController(self, vm_id)
+
+
+def create_workers(nodectl, count, **kwargs):
+    return WorkerService(nodectl, log=Logger.ERROR).create_workers(
+        count, "vmbr0", 9000, 101, **kwargs)
+
+
+class TestCreateWorkers(unittest.TestCase):
+
+    def test_all_created(self):
+        nodectl = StubNodeController()
+        results = create_workers(nodectl, 3)
+        self.assertEqual(results, [
+            {
+                "vm_id": 200,
+                "vm_ip": "10.0.0.20",
+                "error": None
+            },
+            {
+                "vm_id": 201,
+                "vm_ip": "10.0.0.21",
+                "error": None
+            },
+            {
+                "vm_id": 202,
+                "vm_ip": "10.0.0.22",
+                "error": None
+            },
+        ])
+        self.assertEqual(sorted(nodectl.joins), [200, 201, 202])
+        self.assertEqual(nodectl.released, ([], []))
+
+    def test_mixed_results(self):
+        nodectl = StubNodeController(no_agent=set([201]),
+                                     failing_joins=set([202]))
+        results = create_workers(nodectl, 4, concurrency=2)
+        # NOTE: one result per worker, in order, a failure does not stop the others
+        self.assertEqual([r["vm_id"] for r in results], [200, 201, 202, 203])
+        self.assertIsNone(results[0]["error"])
+        self.assertIsInstance(results[1]["error"], TimeoutError)
+        self.assertIsInstance(results[2]["error"], JoinFailedError)
+        self.assertEqual(results[2]["error"].exitcode, 1)
+        self.assertIsNone(results[3]["error"])
+        self.assertEqual(nodectl.released,
+                         ([201, 202], ["10.0.0.21", "10.0.0.22"]))
+
+    def test_without_join(self):
+        nodectl = StubNodeController(failing_joins=set([200]))
+        results = create_workers(nodectl, 1, join=False)
+        self.assertIsNone(results[0]["error"])
+        self.assertEqual(nodectl.joins, [])